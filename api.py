@@ -1,10 +1,16 @@
 import os
 
+import copy
 import json
+import hashlib
+import atexit
+import threading
 import logging
+import time
 import datetime
 import itertools
 import pathlib
+import random
 
 import etcd3
 import jinja2
@@ -13,8 +19,15 @@ import nanoid
 
 from pylxd import models
 from etcd3.client import Etcd3Client
-from lxrmq.models import CreateMessage, OperationMessage, OperationsEnum, InstanceStatusMessage
+from lxrmq.models import CreateMessage, Environment, OperationMessage, OperationsEnum, InstanceStatusMessage
+from lxrmq.cache import SingleFlight, TTLCache
+from lxrmq.commands import batch_script, check_batch_result
 from lxrmq.config import settings
+from lxrmq.events import LxdEventListener
+from lxrmq.idempotency import IdempotencyStore
+from lxrmq.inventory import InstanceOwners, LxdInventory, instance_owner
+from lxrmq.ports import PortBlock, PortIndex, proxy_listen_ports
+from lxrmq.saga import Saga
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
               '-35s %(lineno) -5d: %(message)s')
@@ -23,50 +36,243 @@ LOGGER = logging.getLogger(__name__)
 
 NANOID_SET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz-'
 
+
+def template_paths(node, path=()):
+    """Yields the path of every string in node holding a jinja expression."""
+    if isinstance(node, dict):
+        items = node.items()
+    elif isinstance(node, list):
+        items = enumerate(node)
+    else:
+        if isinstance(node, str) and ('{{' in node or '{%' in node):
+            yield path
+        return
+
+    for key, value in items:
+        yield from template_paths(value, path + (key,))
+
+class LxdTemplate(object):
+    """A validated container template and its compiled forms."""
+    name: str
+    config: dict
+    path: str
+    mtime: float
+    digest: str
+
+    def __init__(self, config, path, mtime, digest, env, compile):
+        self.config = config
+        self.path = path
+        self.mtime = mtime
+        self.digest = digest
+        self.validate()
+
+        # The whole template and its leaves belong to this version only, so
+        # they go when it is replaced
+        self.name = config['template']['name']
+        self.compiled = env.from_string(json.dumps(config))
+        self.leaves = [(p, env.from_string(self.value(p))) for p in template_paths(config)]
+
+        # Commands are rendered through the shared cache, where they are
+        # kept only while a loaded template uses them
+        self.sources = set()
+
+        for command in config['template'].get('commands', []):
+            for item in command:
+                self.sources.add(item)
+                compile(item)
+
+    def validate(self):
+        template = self.config.get('template', None)
+
+        if not isinstance(template, dict) or not isinstance(template.get('name', None), str):
+            raise ValueError('template.name is missing')
+
+        if not isinstance(template.get('ports', 0), int):
+            raise ValueError('template.ports is not a number')
+
+        for command in template.get('commands', []):
+            if not isinstance(command, list) or not all(isinstance(i, str) for i in command):
+                raise ValueError(f'Command ({command}) is not a list of strings')
+
+    def value(self, path):
+        node = self.config
+        for key in path:
+            node = node[key]
+        return node
+
+
 class LxdTemplateManager(object):
+    """Container templates, compiled once into a shared jinja environment.
+
+    Whole templates, the strings in them holding expressions and their
+    commands are compiled when loaded, and any other string the first
+    time it is rendered, so rendering only costs the call to the compiled
+    template. render_config() renders just the strings holding
+    expressions, found once per template.
+
+    The template directory is checked for changes at most every
+    reload_interval seconds. Only files whose mtime and content changed
+    are loaded again, and a template is validated and compiled before it
+    replaces the previous version; one that fails keeps the old version.
+    When two files define the same template name, the first path in
+    sorted order wins.
+    """
     template_dir: str
-    container_templates: dict
+    reload_interval: float
 
-    def __init__(self, template_dir="templates"):
+    def __init__(self, template_dir="templates", reload_interval=0):
+        self.template_dir = template_dir
+        self.reload_interval = reload_interval
 
-        self.container_templates = {}
+        self._env = jinja2.Environment(loader=jinja2.BaseLoader())
+        self._sources = {}
+        self._templates = {}
+        self._files = {}
+        self._paths = set()
+        self._checked = 0
+        self._reload_lock = threading.Lock()
+
+        self.reload()
+
+    @property
+    def container_templates(self):
+        return {name: t.config for name, t in self._templates.items()}
+
+    def template_files(self):
         files = []
 
         #Only looks for JSON templates
-        for dirpath, dirnames, filenames in os.walk(template_dir):
-            LOGGER.info(f'Found files in template directory: {filenames}')
-            files = [f for f in filenames if 'json.j2' in f]
-
-        for f in filenames:
-            path = pathlib.Path(template_dir, f)
-            with open(path, 'r') as fd:
-                try:
-                    json_obj = json.load(fd)
-                    self.container_templates[json_obj['template']['name']] = json_obj
-                except Exception as e:
-                    LOGGER.info(f'Cannot load template ({f}): {e}')
+        for dirpath, dirnames, filenames in os.walk(self.template_dir):
+            files.extend(str(pathlib.Path(dirpath, f)) for f in filenames if f.endswith('.json.j2'))
+
+        return sorted(files)
+
+    def reload(self):
+        """Loads the templates that are new or changed since the last call
+        and drops those whose file is gone. The new set of templates
+        replaces the old one in a single assignment.
+        """
+        with self._reload_lock:
+            self._reload()
+
+    def maybe_reload(self):
+        if not self.reload_interval or time.monotonic() - self._checked <= self.reload_interval:
+            return
+
+        # Requests arriving while another thread scans use the current set
+        if self._reload_lock.acquire(blocking=False):
+            try:
+                self._reload()
+            finally:
+                self._reload_lock.release()
+
+    def _reload(self):
+        self._checked = time.monotonic()
+        files = {}
+        paths = self.template_files()
+
+        if set(paths) != self._paths:
+            LOGGER.debug(f'Template files: {paths}')
+            self._paths = set(paths)
+
+        for path in paths:
+            try:
+                files[path] = self.load_file(path, self._files.get(path, None))
+            except Exception as e:
+                LOGGER.info(f'Cannot load template ({path}): {e}')
+                if path in self._files:
+                    files[path] = self._files[path]
+
+        unchanged = files.keys() == self._files.keys() and \
+            all(files[p] is self._files[p] for p in files)
+
+        if unchanged:
+            return
+
+        templates = {}
+
+        for path, t in files.items():
+            if t.name in templates:
+                LOGGER.warning(f'Template ({t.name}) in ({path}) is already defined '
+                               f'by ({templates[t.name].path}), ignoring it')
+                continue
+            templates[t.name] = t
+
+        self._files = files
+        self._templates = templates
+        LOGGER.info(f'Loaded templates: {list(self._templates)}')
+
+        # Drop the compiled commands of replaced and removed templates
+        live = set().union(*(t.sources for t in files.values()))
+        self._sources = {s: t for s, t in list(self._sources.items()) if s in live}
+
+    def load_file(self, path, current=None):
+        mtime = os.stat(path).st_mtime
+
+        if current is not None and current.mtime == mtime:
+            return current
+
+        with open(path, 'rb') as fd:
+            data = fd.read()
+
+        digest = hashlib.sha256(data).hexdigest()
+
+        if current is not None and current.digest == digest:
+            current.mtime = mtime
+            return current
+
+        LOGGER.info(f'Loading template ({path})')
+        return LxdTemplate(json.loads(data), path, mtime, digest, self._env, self.compile)
+
+    def template(self, name):
+        self.maybe_reload()
+        return self._templates[name]
 
     def get(self, name):
-        template = self.container_templates.get(name, None)
+        self.maybe_reload()
+        template = self._templates.get(name, None)
+        return None if template is None else template.config
+
+    def compile(self, source):
+        template = self._sources.get(source, None)
+
+        if template is None:
+            template = self._env.from_string(source)
+            self._sources[source] = template
+
         return template
 
     def render(self, name, properties):
-        template = self.get(name)
-        template_str = json.dumps(template)
-        rendered_template = jinja2.Environment(
-            loader=jinja2.BaseLoader).from_string(template_str)
+        return self.template(name).compiled.render(properties)
 
-        return rendered_template.render(properties)
+    def render_config(self, name, properties):
+        """Renders template name into a dict. Only the dicts and lists on
+        the way to a rendered string are copied, the rest of the result is
+        shared with the template and must not be modified.
+        """
+        template = self.template(name)
+        config = copy.copy(template.config)
+        copied = {(): config}
 
-    def render_list(self, items, properties):
-        output = []
+        for path, compiled in template.leaves:
+            node = config
+
+            for i in range(len(path) - 1):
+                child = copied.get(path[:i + 1], None)
+
+                if child is None:
+                    child = copy.copy(node[path[i]])
+                    node[path[i]] = child
+                    copied[path[:i + 1]] = child
 
-        for i in items:
-            item_template = jinja2.Environment(
-                loader=jinja2.BaseLoader).from_string(i)
-            rendered_item = item_template.render(properties)
-            output.append(rendered_item)
-        return output
+                node = child
+
+            node[path[-1]] = compiled.render(properties)
+
+        return config
+
+    def render_list(self, items, properties):
+        return [self.compile(i).render(properties) for i in items]
 
 
 class LxdHost(object):
@@ -80,16 +286,9 @@ class LxdHost(object):
         self.address = kwargs.get('address', None)
 
     def proxy_ports(self):
-        devices = [i.devices for i in self.instances]
-        proxies = []
-        for d in devices:
-            for k, v in d.items():
-                device_type = v.get('type', None)
-                if device_type == 'proxy':
-                    proxies.append(v)
-        ports = [p['listen'].split(':')[2]
-                 for p in proxies if p.startswith('tcp')]
-        ports = [int(p) for p in ports]
+        ports = []
+        for i in self.instances:
+            ports.extend(proxy_listen_ports(i.devices))
         return ports
 
 
@@ -99,6 +298,22 @@ class LxdApi(object):
     template_manager: LxdTemplateManager
     etcd: Etcd3Client
     lock_name: str
+    pending_prefix: str
+    pending_ttl: int
+    allocation_mode: str
+    allocation_retries: int
+    node_pools: bool
+    block_size: int
+    block_ttl: int
+    port_index: PortIndex
+    events: LxdEventListener
+    inventory: LxdInventory
+    cache_instances: bool
+    owners: InstanceOwners
+    requests: IdempotencyStore
+    status_cache: TTLCache
+    status_cache_ttl: float
+    exec_mode: str
 
     ADMIN_USERS = ['lxconsumer', 'lxadmin', 'lxfrontend']
 
@@ -121,52 +336,165 @@ class LxdApi(object):
         self.ports = config.PORT_RANGE
         self.nodes = config.NODES
         self.lock_name = config.ETCD_LOCK_NAME
-
-        self.template_manager = LxdTemplateManager()
+        self.pending_prefix = config.ETCD_PENDING_PORTS_PREFIX
+        self.pending_ttl = config.ETCD_PENDING_PORTS_TTL
+        self.allocation_mode = config.PORT_ALLOCATION_MODE
+        self.allocation_retries = config.PORT_ALLOCATION_RETRIES
+        self.node_pools = config.PORT_POOLS_PER_NODE
+        self.block_size = config.PORT_BLOCK_SIZE
+        self.block_ttl = config.PORT_BLOCK_TTL
+
+        self._port_blocks = {}
+        self._retired_port_blocks = []
+        self._port_block_lock = threading.Lock()
+        self._pending_leases = {}
+        self._pending_lease_lock = threading.Lock()
+
+        if self.block_size > 0:
+            atexit.register(self.release_port_blocks)
+
+        self.template_manager = LxdTemplateManager(
+            reload_interval=config.TEMPLATE_RELOAD_INTERVAL)
+        self.exec_mode = config.TEMPLATE_EXEC_MODE
+
+        self.events = LxdEventListener(
+            self.client, resync_interval=config.INVENTORY_RESYNC_INTERVAL)
+        self.inventory = None
+        self.port_index = None
+        self.cache_instances = config.INVENTORY_CACHE
+
+        if config.INVENTORY_CACHE or config.PORT_INDEX:
+            self.inventory = LxdInventory(self.client, self.events)
+
+        if config.PORT_INDEX:
+            self.port_index = PortIndex(self.ports)
+            self.inventory.subscribe(self.port_index)
+
+        self.owners = InstanceOwners(
+            maxsize=config.OWNER_CACHE_SIZE, ttl=config.OWNER_CACHE_TTL)
+
+        if self.inventory is not None:
+            self.inventory.subscribe(self.owners)
+
+        self.status_cache_ttl = config.STATUS_CACHE_TTL
+        self.status_cache = TTLCache(
+            maxsize=config.STATUS_CACHE_SIZE, ttl=config.STATUS_CACHE_TTL)
+        self._status_flight = SingleFlight()
+
+        self.requests = None
+
+        if config.IDEMPOTENT_CREATES:
+            self.requests = IdempotencyStore(
+                self.etcd,
+                config.ETCD_REQUESTS_PREFIX,
+                pending_ttl=config.IDEMPOTENCY_PENDING_TTL,
+                result_ttl=config.IDEMPOTENCY_RESULT_TTL,
+                wait_timeout=config.IDEMPOTENCY_WAIT_TIMEOUT)
+
+    def inventory_ready(self):
+        # The inventory is loaded by the event listener once it subscribes
+        self.inventory.start()
+        return self.inventory.ready
 
     @property
     def instances(self):
+        if self.cache_instances and self.inventory_ready():
+            return self.inventory.all()
         return self.client.instances.all()
 
     def get(self, name):
+        if self.cache_instances and self.inventory_ready():
+            return self.inventory.get(name)
         return self.client.instances.get(name)
 
-    def allocated_ports(self):
-        devices = [i.devices for i in self.instances]
-        proxies = []
-        allocated_ports = []
-        for d in devices:
-            for k, v in d.items():
-                device_type = v.get('type', None)
-                if device_type == 'proxy':
-                    proxies.append(v)
+    def allocated_ports(self, node=None):
+        if self.port_index is not None:
+            if self.inventory_ready() and self.port_index.ready:
+                return self.port_index.allocated(node=node)
 
-        ports = [p['listen'].split(':')[2]
-                 for p in proxies if p['listen'].startswith('tcp')]
+        allocated_ports = []
 
-        [allocated_ports.append(int(p)) for p in ports]
+        for i in self.instances:
+            if node is None or str(i.location) == node:
+                allocated_ports.extend(proxy_listen_ports(i.devices))
 
         return allocated_ports
 
-    def available_ports(self):
-        allocated_ports = self.allocated_ports()
-        pending_ports = [int(k) for k in self.pending_ports().keys()]
+    def available_ports(self, node=None, used=None):
+        # Pending ports are read first: a port released after this read
+        # has already been created and shows up in allocated_ports.
+        pending_ports = [int(k) for k in self.pending_ports(node=node).keys()]
+        allocated_ports = self.allocated_ports(node=node) if used is None else used
         available_ports = self.ports - \
             set(allocated_ports) - set(pending_ports)
 
         return list(available_ports)
 
-    def pending_ports(self):
-        result = self.etcd.get('/lxd/pending_ports')
+    def pending_ports(self, node=None):
+        pending_ports = {}
+        prefix = self.pending_port_key('', node=node)
 
-        pending_ports = None
+        for value, meta in self.etcd.get_prefix(prefix):
+            port = meta.key.decode().rsplit('/', 1)[-1]
+            pending_ports[port] = json.loads(value)
+
+        return pending_ports
 
-        if result != (None, None):
-            pending_ports = json.loads(result[0])
+    def pending_port_key(self, port, node=None):
+        if node is None:
+            return f'{self.pending_prefix}{port}'
+        return f'{self.pending_prefix}{node}/{port}'
+
+    def pool_lock_name(self, node=None):
+        if node is None:
+            return self.lock_name
+        return f'{self.lock_name}/{node}'
+
+    def node_ports(self):
+        """Returns the ports in use on each member of NODES, reserved or
+        allocated, or {} when ports are pooled across the whole cluster.
+        Reservations are read first, as in available_ports, so the result
+        can stand in for the instance scan when allocating on a member.
+        """
+        if not self.node_pools or not self.nodes:
+            return {}
+
+        used = {n: set() for n in self.nodes}
+
+        # One read covers the pending ports of every member
+        for _, meta in self.etcd.get_prefix(self.pending_prefix):
+            node, _, port = meta.key.decode()[len(self.pending_prefix):].partition('/')
+            if node in used and port:
+                used[node].add(int(port))
+
+        if self.port_index is not None and self.port_index.ready:
+            for n in self.nodes:
+                used[n].update(self.port_index.allocated(node=n))
         else:
-            pending_ports = {}
+            for i in self.instances:
+                if str(i.location) in used:
+                    used[str(i.location)].update(proxy_listen_ports(i.devices))
 
-        return pending_ports
+        return used
+
+    def select_node(self, used=None):
+        """Returns the cluster member whose port pool has the most free
+        ports, or None when ports are pooled across the whole cluster.
+        Ports reserved for creates in progress count as used, so a burst
+        of creates is spread over the members. Pass used from node_ports()
+        to reuse it for the allocation.
+        """
+        if not self.node_pools:
+            return None
+
+        if not self.nodes:
+            LOGGER.warning('PORT_POOLS_PER_NODE is set but NODES is empty, using the cluster pool')
+            return None
+
+        if used is None:
+            used = self.node_ports()
+
+        return min(used, key=lambda n: len(used[n]))
 
     def set_available_ports(self, ports):
         available_ports = self.available_ports()
@@ -174,20 +502,35 @@ class LxdApi(object):
                                json.dumps(list(available_ports)))
         return result
 
-    def next_proxy_port(self, num=1):
+    def next_proxy_port(self, num=1, node=None, used=None):
+        """Reserves num ports. used, the ports node_ports() found in use on
+        node, saves scanning the instances again; pending reservations are
+        still read fresh.
+        """
+        if self.block_size > 0:
+            return self.take_block_ports(num=num, node=node, used=used)
+
+        if self.allocation_mode == 'transaction':
+            return self.claim_proxy_ports(num=num, node=node, used=used)
+
         ports = []
-        lock = self.etcd.lock(self.lock_name)
+        lock = self.etcd.lock(self.pool_lock_name(node))
         lock_result = lock.acquire()
 
         LOGGER.info(f'next_proxy_port Lock: {lock_result}')
 
-        available_ports = self.available_ports()
+        available_ports = self.available_ports(node=node, used=used)
         count = len(available_ports)
 
         if count >= num:
             ports = list(available_ports)[:num]
-            res = [self.add_pending_port(p) for p in ports]
-            res = [self.remove_available_port(p) for p in ports]
+            # All ports of one allocation share a lease so abandoned
+            # reservations expire together.
+            lease = self.etcd.lease(self.pending_ttl)
+            res = [self.add_pending_port(p, lease=lease, node=node) for p in ports]
+            self._track_pending_lease(ports, lease, node=node)
+            if node is None:
+                res = [self.remove_available_port(p) for p in ports]
 
         lock_result = lock.release()
 
@@ -195,20 +538,159 @@ class LxdApi(object):
 
         return ports
 
-    def add_pending_port(self, port):
-        # Add port to pending_ports
-        now = datetime.datetime.now()
-        result = self.etcd.get('/lxd/pending_ports')
-        new_pending = {f'{port}': {'timestamp': now.strftime('%s')}}
+    def claim_proxy_ports(self, num=1, node=None, used=None):
+        """Reserve ports without the global lock. Each port is claimed with
+        a compare-and-swap transaction that only succeeds if its pending key
+        does not exist, so callers only conflict on the same port.
+        """
+        lease = self.etcd.lease(self.pending_ttl)
+        ports = self.claim_ports(num, lease, node=node, used=used)
 
-        if result == (None, None):
-            result = self.etcd.put('/lxd/pending_ports',
-                                   json.dumps(new_pending))
+        if len(ports) == num:
+            self._track_pending_lease(ports, lease, node=node)
+            return ports
+
+        LOGGER.info(f'claim_proxy_ports unable to claim ({num}) ports')
+        lease.revoke()
+
+        return []
+
+    def claim_ports(self, num, lease, node=None, used=None):
+        """Claims up to num ports under lease, returning the ports claimed."""
+        ports = []
+
+        for attempt in range(self.allocation_retries):
+            available_ports = [p for p in self.available_ports(node=node, used=used)
+                               if p not in ports]
+            needed = min(num - len(ports), len(available_ports))
+
+            if needed == 0:
+                break
+
+            # Random picks spread concurrent allocators across the range
+            for p in random.sample(available_ports, needed):
+                if self.claim_pending_port(p, lease, node=node):
+                    ports.append(p)
+                else:
+                    LOGGER.info(f'claim_proxy_ports conflict on ({p})')
+
+            if len(ports) == num:
+                LOGGER.info(f'claim_ports claimed {ports} (attempt {attempt})')
+                break
+
+        return ports
+
+    def take_block_ports(self, num=1, node=None, used=None):
+        """Hands out ports from this process's leased block for node,
+        leasing a new block of PORT_BLOCK_SIZE ports when the current one
+        cannot satisfy the request.
+        """
+        with self._port_block_lock:
+            block = self._port_blocks.get(node)
+            ports = block.take(num) if block is not None else None
+
+            if ports is None:
+                if block is not None:
+                    self._retire_port_block(block)
+
+                block = self.lease_port_block(num, node=node, used=used)
+                if block is None:
+                    return []
+
+                self._port_blocks[node] = block
+                ports = block.take(num)
+
+            block.keep_alive()
+
+        return ports
+
+    def lease_port_block(self, num, node=None, used=None):
+        lease = self.etcd.lease(self.block_ttl)
+        ports = self.claim_ports(max(num, self.block_size), lease, node=node, used=used)
+
+        if len(ports) < num:
+            LOGGER.info(f'lease_port_block unable to lease ({num}) ports')
+            lease.revoke()
+            return None
+
+        LOGGER.info(f'Leased block of ({len(ports)}) ports (node: {node})')
+
+        return PortBlock(lease, ports, self.block_ttl, node=node)
+
+    def release_block_port(self, port, node=None, used=True):
+        """Returns a port taken from a block. Returns False when the port
+        did not come from one of this process's blocks.
+        """
+        with self._port_block_lock:
+            blocks = [self._port_blocks.get(node)] + self._retired_port_blocks
+            block = next((b for b in blocks if b is not None and port in b), None)
+
+            if block is None:
+                return False
+
+            block.release(port, used=used)
+
+            if block.retired and block.idle:
+                self._retired_port_blocks.remove(block)
+                self._revoke_port_block(block)
+            elif not block.expired:
+                block.keep_alive()
+
+        return True
+
+    def _retire_port_block(self, block):
+        block.retired = True
+        del self._port_blocks[block.node]
+
+        if block.idle:
+            self._revoke_port_block(block)
         else:
-            existing_pending = json.loads(result[0])
-            existing_pending.update(new_pending)
-            result = self.etcd.put('/lxd/pending_ports',
-                                   json.dumps(existing_pending))
+            self._retired_port_blocks.append(block)
+
+    def _revoke_port_block(self, block):
+        block.close()
+
+        # A block left idle past its TTL has lost its lease in etcd, and its
+        # pending keys with it, so there is nothing left to revoke.
+        if block.expired:
+            LOGGER.info(f'Dropping expired port block (node: {block.node})')
+            return
+
+        try:
+            block.lease.revoke()
+        except Exception as e:
+            LOGGER.info(f'Unable to revoke port block lease: {e}')
+
+    def release_port_blocks(self):
+        """Revokes every block lease, returning unused ports to the pool."""
+        with self._port_block_lock:
+            blocks = list(self._port_blocks.values()) + self._retired_port_blocks
+            self._port_blocks = {}
+            self._retired_port_blocks = []
+
+        for block in blocks:
+            self._revoke_port_block(block)
+
+    def claim_pending_port(self, port, lease=None, node=None):
+        now = datetime.datetime.now()
+        key = self.pending_port_key(port, node=node)
+        pending = {'timestamp': now.strftime('%s')}
+
+        succeeded, _ = self.etcd.transaction(
+            compare=[self.etcd.transactions.version(key) == 0],
+            success=[self.etcd.transactions.put(key, json.dumps(pending), lease)],
+            failure=[]
+        )
+
+        return succeeded
+
+    def add_pending_port(self, port, lease=None, node=None):
+        # Each pending port is its own key, expiring with its lease
+        now = datetime.datetime.now()
+        pending = {'timestamp': now.strftime('%s')}
+
+        result = self.etcd.put(self.pending_port_key(port, node=node),
+                               json.dumps(pending), lease=lease)
 
         return result
 
@@ -226,27 +708,63 @@ class LxdApi(object):
 
         return result
 
-    def remove_pending_port(self, port):
-        lock = self.etcd.lock(self.lock_name)
-        lock_result = lock.acquire()
-        LOGGER.info(f'remove_pending_port Lock: {lock_result}')
-        result = self.etcd.get('/lxd/pending_ports')
+    def remove_pending_port(self, port, node=None):
+        # Block ports stay reserved until their block lease is revoked
+        if self.block_size > 0 and self.release_block_port(port, node=node):
+            return None
 
-        if result == (None, None):
-            self.etcd.put('/lxd/pending_ports', json.dumps({}))
-        else:
-            existing_pending = json.loads(result[0])
-            if str(port) in existing_pending:
-                del existing_pending[str(port)]
-                self.etcd.put('/lxd/pending_ports',
-                                json.dumps(existing_pending))
-        lock_result = lock.release()
-        LOGGER.info(f'remove_pending_port Lock Release: {lock_result}')
+        result = self.etcd.delete(self.pending_port_key(port, node=node))
+        LOGGER.info(f'remove_pending_port ({port}): {result}')
+        self._release_pending_leases([port], node=node)
+        return result
+
+    def release_pending_ports(self, ports, node=None, used=True):
+        """Releases all of a create's reservations at once. Block ports go
+        back to their block, the rest are deleted in a single transaction.
+        Pass used=False when the ports were never handed to an instance.
+        """
+        if self.block_size > 0:
+            ports = [p for p in ports
+                     if not self.release_block_port(p, node=node, used=used)]
+
+        if len(ports) == 0:
+            return None
+
+        deletes = [self.etcd.transactions.delete(self.pending_port_key(p, node=node))
+                   for p in ports]
+        succeeded, _ = self.etcd.transaction(compare=[], success=deletes, failure=[])
+
+        LOGGER.info(f'release_pending_ports ({ports}): {succeeded}')
+        self._release_pending_leases(ports, node=node)
+
+        return succeeded
+
+    def _track_pending_lease(self, ports, lease, node=None):
+        with self._pending_lease_lock:
+            for p in ports:
+                self._pending_leases[(node, p)] = lease
+
+    def _release_pending_leases(self, ports, node=None):
+        """Revokes the lease of an allocation once none of its ports are
+        pending, rather than leaving it to run out its TTL in etcd.
+        """
+        with self._pending_lease_lock:
+            leases = [self._pending_leases.pop((node, p), None) for p in ports]
+            remaining = [id(lease) for lease in self._pending_leases.values()]
+            done = {id(lease): lease for lease in leases
+                    if lease is not None and id(lease) not in remaining}
+
+        for lease in done.values():
+            try:
+                lease.revoke()
+            except Exception as e:
+                LOGGER.info(f'Unable to revoke pending port lease: {e}')
 
     def hosts(self):
         hosts = []
         hosts_groups = itertools.groupby(
-            self.instances, key=lambda i: i.location)
+            sorted(self.instances, key=lambda i: str(i.location)),
+            key=lambda i: i.location)
 
         for h in hosts_groups:
             node = self.nodes.get(str(h[0]), None)
@@ -256,17 +774,51 @@ class LxdApi(object):
 
         return hosts
 
-    def create_instance(self, config_name, properties):
-        config_string = self.template_manager.render(config_name, properties)
-
-        config = json.loads(config_string)
+    def create_instance(self, config_name, properties, target=None):
+        config = self.template_manager.render_config(config_name, properties)
 
-        instance = self.client.instances.create(config, wait=True)
+        instance = self.client.instances.create(config, wait=True, target=target)
         
         instance.start(wait=True)
 
         return instance
 
+    def run_commands(self, instance, commands):
+        """Runs the template commands in the instance, one exec each or,
+        in batch mode, all in a single exec that stops at the first
+        failing command and raises TemplateCommandError for it.
+        """
+        if self.exec_mode == 'batch' and commands:
+            LOGGER.info(f'Running ({len(commands)}) commands in one exec')
+            result = instance.execute(['bash', '-c', batch_script(commands)])
+            LOGGER.info(f'Command result: {result}')
+            check_batch_result(result, commands)
+            return
+
+        for command in commands:
+            LOGGER.info(f'Running command: {command}')
+            result = instance.execute(command)
+            LOGGER.info(f'Command result: {result}')
+
+    def delete_instance(self, name, instance_id=None):
+        if not self.client.instances.exists(name):
+            return
+
+        instance = self.client.instances.get(name)
+
+        # Never remove an instance some other create produced
+        if instance_id is not None and \
+                instance.config.get('environment.LX_INSTANCE_ID') != instance_id:
+            LOGGER.info(f'Not deleting instance ({name}), it is not ({instance_id})')
+            return
+
+        if instance.status == 'Running':
+            instance.stop(force=True, wait=True)
+
+        LOGGER.info(f'Deleting instance ({name})')
+        instance.delete(wait=True)
+        self.owners.forget(name)
+
     def start_instance(self, instance_name):
         return self.client.instances.start(instance_name)
 
@@ -279,25 +831,51 @@ class LxdApi(object):
         
         LOGGER.info(f'Permission Check: {operation} {name} {user}')
 
-        instance = self.client.instances.get(name)
-        
-        #Get the user env var
-        instance_user = dict(instance.config).get('environment.LX_USER', None)
+        instance_user = self.owners.get(name)
+
+        if instance_user is None:
+            instance = self.client.instances.get(name)
 
-        if instance_user == user:
+            #Get the user env var
+            instance_user = instance_owner(instance)
+            self.owners.remember(name, instance_user)
+
+        if instance_user and instance_user == user:
             result = True
 
         return result
 
-    def handle_create_message(self, message: CreateMessage, user: str):
-
+    def handle_create_message(self, message: CreateMessage, user: str, request_id: str = None):
+        """Creates the environment's instance. With idempotent creates on, a
+        request already handled (keyed by user, instance name and request_id,
+        else the environment id) returns its stored result instead of being
+        created again.
+        """
         environment = message.environment
 
-        template_name = None
-
         if self.permission_check('create', environment.instance.name, user) is False:
             raise PermissionError('User does not have permission to create this instance')
 
+        if self.requests is None:
+            return self.create_environment(environment)
+
+        def load_result(value):
+            stored = Environment.parse_raw(value)
+            if stored.instance.name != environment.instance.name:
+                raise PermissionError('Stored result is for another instance')
+            return stored
+
+        # Scoped so a reused request id cannot return another user's result
+        return self.requests.run(
+            f'create/{user}/{environment.instance.name}/{request_id or environment.id}',
+            lambda: self.create_environment(environment),
+            dumps=lambda e: e.json(),
+            loads=load_result)
+
+    def create_environment(self, environment: Environment):
+
+        template_name = None
+
         if environment.instance.template is None:
             template_name = f'{environment.course.subject}{environment.course.catalog_number}-{environment.course.semester}'
         else:
@@ -310,51 +888,64 @@ class LxdApi(object):
         LOGGER.info(f'Creating instance ({environment.instance.name})')
         template = self.template_manager.get(template_name)
         ports = []
+        # One pass over the instances picks the member and allocates on it
+        used = self.node_ports()
+        node = self.select_node(used)
+        name = environment.instance.name
 
         LOGGER.info(
             f'Template ({template_name}), Content: ({template})')
 
-        if template['template'].get('ports') is not None:
-            needed_ports = template['template']['ports']
-            LOGGER.info(f'Requesting ({needed_ports}) ports')
-            ports = self.next_proxy_port(num=needed_ports)
-            LOGGER.info(f'Received the ports: {ports}')
-
-        context = {
-            'environment': environment,
-            'ports': ports
-        }
-
-        LOGGER.info(f'Creating instance with context: {context}')
-        instance = self.create_instance(template_name, context)
+        with Saga(f'create {name}') as saga:
+            if template['template'].get('ports') is not None:
+                needed_ports = template['template']['ports']
+                LOGGER.info(f'Requesting ({needed_ports}) ports')
+                # Ports go back to the pool as unused only if the instance
+                # holding them was removed
+                ports = saga.run(
+                    'reserve ports',
+                    lambda: self.next_proxy_port(
+                        num=needed_ports, node=node, used=used.get(node)),
+                    lambda ports: self.release_pending_ports(
+                        ports, node=node, used=len(saga.failed) > 0))
+                LOGGER.info(f'Received the ports: {ports} (node: {node})')
+
+            context = {
+                'environment': environment,
+                'ports': ports
+            }
 
-        LOGGER.info(f'Retrieving the instance location.')
-        location = settings.NODES[str(instance.location)]
+            LOGGER.info(f'Creating instance with context: {context}')
+            # Registered first: a failed create can still leave an instance
+            saga.add('create instance',
+                     lambda: self.delete_instance(name, instance_id=instance_id))
+            instance = self.create_instance(template_name, context, target=node)
 
-        LOGGER.info(f'Instance location {location}')
+            LOGGER.info(f'Retrieving the instance location.')
+            location = settings.NODES[str(instance.location)]
 
-        for name, device in instance.devices.items():
+            LOGGER.info(f'Instance location {location}')
 
-            if device['type'] == 'proxy':
-                LOGGER.info(f'Modifying device {device}')
-                items = device['listen'].split(':')
-                items[1] = location['address']
-                device['listen'] = ':'.join(items)
-                instance.devices.update(
-                    { name: device }
-                )
+            for device_name, device in instance.devices.items():
 
-        LOGGER.info(f'Instance Devices: {instance.devices}')
-        instance.save()
+                if device['type'] == 'proxy':
+                    LOGGER.info(f'Modifying device {device}')
+                    items = device['listen'].split(':')
+                    items[1] = location['address']
+                    device['listen'] = ':'.join(items)
+                    instance.devices.update(
+                        { device_name: device }
+                    )
 
-        for c in template['template'].get('commands', []):
-            command = self.template_manager.render_list(c, context)
-            LOGGER.info(f'Running command: {command}')
-            result = instance.execute(command)
-            LOGGER.info(f'Command result: {result}')
+            LOGGER.info(f'Instance Devices: {instance.devices}')
+            instance.save()
 
+            commands = [self.template_manager.render_list(c, context)
+                        for c in template['template'].get('commands', [])]
+            self.run_commands(instance, commands)
 
-        [ self.remove_pending_port(p) for p in ports ]
+        self.release_pending_ports(ports, node=node)
+        self.owners.remember(name, environment.user.username)
 
         environment.instance.location = location['name']
         environment.instance.devices = instance.devices
@@ -372,21 +963,50 @@ class LxdApi(object):
 
         LOGGER.info(f'Handling ({message.operation}) for instance ({message.instance})')
 
-        instance: models.Instance = self.client.instances.get(message.instance)
-
         if message.operation not in [OperationsEnum.restart, OperationsEnum.status,
                                      OperationsEnum.start, OperationsEnum.stop]:
             raise ValueError('Invalid operation')
 
-        if message.operation == OperationsEnum.start:
-            instance.start(wait=True)
+        if message.operation == OperationsEnum.status:
+            return self.instance_status(message.instance)
+
+        instance: models.Instance = self.client.instances.get(message.instance)
+
+        try:
+            if message.operation == OperationsEnum.start:
+                instance.start(wait=True)
 
-        if message.operation == OperationsEnum.stop:
-            instance.stop(wait=True)
+            if message.operation == OperationsEnum.stop:
+                instance.stop(wait=True)
 
-        if message.operation == OperationsEnum.restart:
-            instance.restart(wait=True)
+            if message.operation == OperationsEnum.restart:
+                instance.restart(wait=True)
+        finally:
+            self.status_cache.pop(message.instance)
+
+        return self.status_response(instance)
+
+    def instance_status(self, name):
+        """Status of an instance. Concurrent requests for one instance share
+        a single LXD lookup and the result is cached for status_cache_ttl
+        seconds, since dashboards poll it heavily.
+        """
+        response = self.status_cache.get(name, None)
+
+        if response is None:
+            response = self._status_flight.do(name, lambda: self.fetch_status(name))
+
+        return response
+
+    def fetch_status(self, name):
+        response = self.status_response(self.client.instances.get(name))
+
+        if self.status_cache_ttl > 0:
+            self.status_cache.set(name, response)
+
+        return response
 
+    def status_response(self, instance):
         response = {
             'id': instance.config['environment.LX_INSTANCE_ID'],
             'type': 'instance_status',
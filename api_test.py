@@ -1,3 +1,6 @@
+import os
+import json
+import tempfile
 import unittest
 import types
 import pylxd
@@ -8,19 +11,21 @@ from etcd3.client import KVMetadata
 
 from unittest import mock
 
-from api import LxdApi
+from api import LxdApi, LxdTemplateManager, template_paths
 from config import Settings
+from lxrmq.commands import TemplateCommandError
 
-import models
+from lxrmq import models
 
 
 class TestLxdApi(unittest.TestCase):
 
-    @mock.patch('etcd3.client.Etcd3Client', autospec=True)
-    def test_lxd_container_provisioner_none_success(self, mock_etcd3):
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_lxd_container_provisioner_none_success(self, mock_etcd3, mock_client):
 
         etcd = mock_etcd3.return_value
-        etcd.get.return_value = (None, None)
+        etcd.get_prefix.return_value = []
 
         settings = Settings()
         api = LxdApi(config=settings)
@@ -29,12 +34,12 @@ class TestLxdApi(unittest.TestCase):
 
         self.assertEqual(pending_ports, {})
 
-    @mock.patch('etcd3.client.Etcd3Client', autospec=True)
-    def test_lxd_container_provisioner_exception_success(self, mock_etcd3):
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_lxd_container_provisioner_exception_success(self, mock_etcd3, mock_client):
 
         etcd = mock_etcd3.return_value
-        etcd.get.side_effect = exceptions.Etcd3Exception()
-        etcd.get.return_value = (None, None)
+        etcd.get_prefix.side_effect = exceptions.Etcd3Exception()
 
         settings = Settings()
         api = LxdApi(config=settings)
@@ -47,15 +52,16 @@ class TestLxdApi(unittest.TestCase):
 
         self.assertEqual(type(exception), exceptions.Etcd3Exception)
 
-    @mock.patch('etcd3.client.Etcd3Client', autospec=True)
-    def test_pending_ports_dict_sucess(self, mock_etcd3):
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_pending_ports_dict_sucess(self, mock_etcd3, mock_client):
 
         etcd = mock_etcd3.return_value
 
         l = leases.Lease(100, 1)
 
         kvm = types.SimpleNamespace()
-        kvm.key = b'/lxd/pending_ports'
+        kvm.key = b'/lxd/pending_ports/9000'
         kvm.create_revision = 3350
         kvm.mod_revision = 3379
         kvm.version = 15
@@ -68,18 +74,209 @@ class TestLxdApi(unittest.TestCase):
         header.raft_term = 25
 
         meta = KVMetadata(kvm, header)
-        etcd.get.return_value = (
-            '{ "9000": {"timestamp": "1686799510"} }', meta)
+        etcd.get_prefix.return_value = [
+            (b'{"timestamp": "1686799510"}', meta)]
 
         settings = Settings()
         api = LxdApi(config=settings)
 
         pending_ports = api.pending_ports()
 
+        etcd.get_prefix.assert_called_once_with('/lxd/pending_ports/')
         self.assertEqual(pending_ports, {"9000": {"timestamp": "1686799510"}})
 
-    @mock.patch('etcd3.client.Etcd3Client', autospec=True)
-    def test_hosts_sucess(self, mock_etcd3):
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_add_remove_pending_port_keys(self, mock_etcd3, mock_client):
+
+        etcd = mock_etcd3.return_value
+        lease = leases.Lease(100, 900)
+
+        settings = Settings()
+        api = LxdApi(config=settings)
+
+        api.add_pending_port(9000, lease=lease)
+        api.remove_pending_port(9000)
+
+        args, kwargs = etcd.put.call_args
+        self.assertEqual(args[0], '/lxd/pending_ports/9000')
+        self.assertIs(kwargs['lease'], lease)
+        etcd.get.assert_not_called()
+        etcd.delete.assert_called_once_with('/lxd/pending_ports/9000')
+
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_claim_proxy_ports_retries_conflict(self, mock_etcd3, mock_client):
+
+        etcd = mock_etcd3.return_value
+        etcd.get_prefix.return_value = []
+        # First claim loses the race, the rest succeed
+        etcd.transaction.side_effect = [(False, []), (True, []), (True, []), (True, []), (True, [])]
+
+        client = mock_client.return_value
+        client.instances = mock.MagicMock()
+        client.instances.all.return_value = []
+
+        settings = Settings(PORT_ALLOCATION_MODE='transaction', PORT_RANGE=set(range(9000, 9010)))
+        api = LxdApi(config=settings)
+
+        ports = api.next_proxy_port(num=3)
+
+        self.assertEqual(len(set(ports)), 3)
+        self.assertEqual(etcd.transaction.call_count, 4)
+        etcd.lock.assert_not_called()
+
+        # The allocation's lease goes with its last port
+        lease = etcd.lease.return_value
+        api.remove_pending_port(ports[0])
+        lease.revoke.assert_not_called()
+
+        api.release_pending_ports(ports[1:])
+        lease.revoke.assert_called_once()
+        self.assertEqual(api._pending_leases, {})
+
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_node_port_pools(self, mock_etcd3, mock_client):
+
+        etcd = mock_etcd3.return_value
+        etcd.get_prefix.return_value = []
+
+        busy = mock.MagicMock(spec=pylxd.models.Instance)
+        busy.location = 'lx1'
+        busy.devices = {'ttyd': {'connect': 'tcp:127.0.0.1:7681',
+                                 'listen': 'tcp:10.0.0.1:9000',
+                                 'type': 'proxy'}}
+
+        client = mock_client.return_value
+        client.instances = mock.MagicMock()
+        client.instances.all.return_value = [busy]
+
+        nodes = {'lx1': {'name': 'lx1', 'address': '10.0.0.1'},
+                 'lx2': {'name': 'lx2', 'address': '10.0.0.2'}}
+        settings = Settings(PORT_POOLS_PER_NODE=True,
+                            PORT_RANGE=set(range(9000, 9001)))
+        settings.NODES = nodes
+        api = LxdApi(config=settings)
+
+        used = api.node_ports()
+        node = api.select_node(used)
+        ports = api.next_proxy_port(num=1, node=node, used=used[node])
+
+        # Port 9000 is taken on lx1 but still free in the lx2 pool
+        self.assertEqual(node, 'lx2')
+        self.assertEqual(ports, [9000])
+        # The instances are listed once for both steps
+        client.instances.all.assert_called_once()
+        etcd.lock.assert_called_once_with('lxd/lx2')
+        self.assertEqual([c.args[0] for c in etcd.get_prefix.call_args_list],
+                         ['/lxd/pending_ports/', '/lxd/pending_ports/lx2/'])
+        self.assertEqual(etcd.put.call_args[0][0], '/lxd/pending_ports/lx2/9000')
+
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_select_node_counts_pending_ports(self, mock_etcd3, mock_client):
+
+        etcd = mock_etcd3.return_value
+
+        def pending(key):
+            meta = types.SimpleNamespace(key=key.encode())
+            return (b'{"timestamp": "1686799510"}', meta)
+
+        # Two creates in flight hold ports on lx1
+        etcd.get_prefix.return_value = [pending('/lxd/pending_ports/lx1/9000'),
+                                        pending('/lxd/pending_ports/lx1/9001')]
+
+        busy = mock.MagicMock(spec=pylxd.models.Instance)
+        busy.location = 'lx2'
+        busy.devices = {'ttyd': {'connect': 'tcp:127.0.0.1:7681',
+                                 'listen': 'tcp:10.0.0.2:9000',
+                                 'type': 'proxy'}}
+
+        client = mock_client.return_value
+        client.instances = mock.MagicMock()
+        client.instances.all.return_value = [busy]
+
+        settings = Settings(PORT_POOLS_PER_NODE=True)
+        settings.NODES = {'lx1': {'name': 'lx1', 'address': '10.0.0.1'},
+                          'lx2': {'name': 'lx2', 'address': '10.0.0.2'}}
+        api = LxdApi(config=settings)
+
+        self.assertEqual(api.select_node(), 'lx2')
+
+        # Without members there is nothing to choose from
+        api.nodes = {}
+        self.assertIsNone(api.select_node())
+
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_port_block_lease(self, mock_etcd3, mock_client):
+
+        etcd = mock_etcd3.return_value
+        etcd.get_prefix.return_value = []
+        etcd.transaction.return_value = (True, [])
+
+        client = mock_client.return_value
+        client.instances = mock.MagicMock()
+        client.instances.all.return_value = []
+
+        settings = Settings(PORT_BLOCK_SIZE=4, PORT_RANGE=set(range(9000, 9010)))
+        api = LxdApi(config=settings)
+
+        first = api.next_proxy_port(num=2)
+        second = api.next_proxy_port(num=2)
+
+        # Both allocations come from one leased block of four ports
+        self.assertEqual(len(set(first + second)), 4)
+        self.assertEqual(etcd.transaction.call_count, 4)
+        etcd.lease.assert_called_once_with(300)
+
+        [api.remove_pending_port(p) for p in first]
+        etcd.delete.assert_not_called()
+
+        api.release_port_blocks()
+        etcd.lease.return_value.revoke.assert_called_once()
+
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_port_block_expires_while_idle(self, mock_etcd3, mock_client):
+
+        etcd = mock_etcd3.return_value
+        etcd.get_prefix.return_value = []
+        etcd.transaction.return_value = (True, [])
+        # etcd has already dropped the lease of the idle block
+        etcd.lease.return_value.revoke.side_effect = Exception('lease not found')
+
+        client = mock_client.return_value
+        client.instances = mock.MagicMock()
+        client.instances.all.return_value = []
+
+        settings = Settings(PORT_BLOCK_SIZE=4, PORT_RANGE=set(range(9000, 9010)))
+        api = LxdApi(config=settings)
+
+        with mock.patch('ports.time.monotonic', return_value=1000.0):
+            first = api.next_proxy_port(num=2)
+
+        with mock.patch('ports.time.monotonic', return_value=1400.0):
+            second = api.next_proxy_port(num=2)
+            [api.remove_pending_port(p) for p in first]
+
+        # The expired block is dropped without revoking its lapsed lease
+        self.assertEqual(len(second), 2)
+        self.assertEqual(etcd.lease.call_count, 2)
+        etcd.lease.return_value.revoke.assert_not_called()
+        etcd.lease.return_value.refresh.assert_not_called()
+
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_hosts_sucess(self, mock_etcd3, mock_client):
+
+        client = mock_client.return_value
+        client.instances = mock.MagicMock()
+
+        mock_instance = mock.MagicMock(spec=pylxd.models.Instance)
+        mock_instance.location = None
+        client.instances.all.return_value = [mock_instance]
 
         settings = Settings()
         api = LxdApi(config=settings)
@@ -91,7 +288,52 @@ class TestLxdApi(unittest.TestCase):
         self.assertEqual(local.name, 'localhost')
 
     @mock.patch('pylxd.Client', autospec=True)
-    @mock.patch('etcd3.client.Etcd3Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_inventory_cache_serves_instances(self, mock_etcd3, mock_client):
+
+        client = mock_client.return_value
+        client.instances = mock.MagicMock()
+
+        mock_instance = mock.MagicMock(spec=pylxd.models.Instance)
+        mock_instance.name = 'cs135-f23-user0'
+        mock_instance.location = None
+        client.instances.all.return_value = [mock_instance]
+
+        settings = Settings(INVENTORY_CACHE=True)
+        api = LxdApi(config=settings)
+        api.events = mock.Mock()
+        api.inventory.events = api.events
+        api.inventory.load()
+
+        api.hosts()
+        api.instances
+        api.get('cs135-f23-user0')
+
+        client.instances.all.assert_called_once()
+        client.instances.get.assert_not_called()
+
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_permission_check_caches_owner(self, mock_etcd3, mock_client):
+
+        client = mock_client.return_value
+        client.instances = mock.MagicMock()
+
+        mock_instance = mock.MagicMock(spec=pylxd.models.Instance)
+        mock_instance.config = {'environment.LX_USER': 'user0'}
+        client.instances.get.return_value = mock_instance
+
+        settings = Settings()
+        api = LxdApi(config=settings)
+
+        self.assertTrue(api.permission_check('status', 'cs135-f23-user0', 'user0'))
+        self.assertTrue(api.permission_check('start', 'cs135-f23-user0', 'user0'))
+        self.assertFalse(api.permission_check('stop', 'cs135-f23-user0', 'user1'))
+
+        client.instances.get.assert_called_once_with('cs135-f23-user0')
+
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
     def test_handle_create_message_success(self, mock_etcd3, mock_client):
 
         etcd = mock_etcd3.return_value
@@ -114,23 +356,103 @@ class TestLxdApi(unittest.TestCase):
                                             'type': 'proxy'}}
         client.instances.create.return_value = mock_instance
 
-        l = leases.Lease(100, 1)
+        etcd.get_prefix.return_value = []
+        etcd.get.return_value = ('[]', None)
+        etcd.transaction.return_value = (True, [])
 
-        kvm = types.SimpleNamespace()
-        kvm.key = b'/lxd/pending_ports'
-        kvm.create_revision = 3350
-        kvm.mod_revision = 3379
-        kvm.version = 15
-        kvm.lease = l
+        settings = Settings()
+        api = LxdApi(config=settings)
 
-        header = types.SimpleNamespace()
-        header.cluster_id = 14841639068965178418
-        header.member_id = 10276657743932975437
-        header.revision = 3392
-        header.raft_term = 25
+        message = models.CreateMessage.parse_obj({
+            'environment': {
+                'id': f'000000010',
+                'name': 'CS135',
+                'type': 'simple',
+                'instance': {
+                    'name': 'cs135-f23-user0',
+                    'type': 'container',
+                },
+                'user': {
+                    'id': '000000001',
+                    'username': 'user0',
+                    'uid_number': 1000000
+                },
+                'course': {
+                    'subject': 'cs',
+                    'catalog_number': '135',
+                    'semester': 'f23'
+                }
+            }
+        })
 
-        meta = KVMetadata(kvm, header)
-        etcd.get.return_value = ('{}', meta)
+        result = api.handle_create_message(message, 'lxconsumer')
+
+        self.assertEqual(result.instance.devices['novnc'], {'connect': 'tcp:127.0.0.1:5801','listen': 'tcp:127.0.0.1:9000','type': 'proxy'})
+
+        # The three reservations are released in one transaction
+        etcd.transaction.assert_called_once()
+        self.assertEqual(len(etcd.transaction.call_args[1]['success']), 3)
+        etcd.delete.assert_not_called()
+
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_idempotent_create_is_scoped(self, mock_etcd3, mock_client):
+
+        settings = Settings()
+        api = LxdApi(config=settings)
+        api.requests = mock.Mock()
+
+        def message(name):
+            return models.CreateMessage.parse_obj({
+                'environment': {
+                    'id': '000000010',
+                    'name': 'CS135',
+                    'type': 'simple',
+                    'instance': {'name': name, 'type': 'container'},
+                    'user': {'id': '000000001', 'username': 'user0', 'uid_number': 1000000},
+                    'course': {'subject': 'cs', 'catalog_number': '135', 'semester': 'f23'}
+                }
+            })
+
+        api.handle_create_message(message('cs135-f23-user0'), 'lxconsumer', request_id='r1')
+
+        args, kwargs = api.requests.run.call_args
+        self.assertEqual(args[0], 'create/lxconsumer/cs135-f23-user0/r1')
+
+        # A stored result for another instance is never handed back
+        loads = kwargs['loads']
+        self.assertEqual(loads(message('cs135-f23-user0').environment.json()).instance.name,
+                         'cs135-f23-user0')
+        with self.assertRaises(PermissionError):
+            loads(message('cs135-f23-user1').environment.json())
+
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_handle_create_message_failure_rolls_back(self, mock_etcd3, mock_client):
+
+        etcd = mock_etcd3.return_value
+        etcd.get_prefix.return_value = []
+        etcd.get.return_value = ('[]', None)
+        etcd.transaction.return_value = (True, [])
+
+        client = mock_client.return_value
+        client.instances = mock.MagicMock()
+        client.instances.all.return_value = []
+
+        mock_instance = mock.MagicMock(spec=pylxd.models.Instance)
+        mock_instance.name = 'cs135-f23-user0'
+        mock_instance.status = 'Running'
+        mock_instance.location = None
+        mock_instance.devices = {}
+        mock_instance.save.side_effect = RuntimeError('save failed')
+
+        def create(config, wait=False, target=None):
+            mock_instance.config = config['config']
+            return mock_instance
+
+        client.instances.create.side_effect = create
+        client.instances.get.return_value = mock_instance
+        client.instances.exists.return_value = True
 
         settings = Settings()
         api = LxdApi(config=settings)
@@ -157,13 +479,29 @@ class TestLxdApi(unittest.TestCase):
             }
         })
 
-        result = api.handle_create_message(message)
+        with self.assertRaises(RuntimeError):
+            api.handle_create_message(message, 'lxconsumer')
 
-        self.assertEqual(result.instance.devices['novnc'], {'connect': 'tcp:127.0.0.1:5801','listen': 'tcp:127.0.0.1:9000','type': 'proxy'})
+        # The partial instance is removed before its ports are released
+        mock_instance.stop.assert_called_once_with(force=True, wait=True)
+        mock_instance.delete.assert_called_once_with(wait=True)
+        etcd.transaction.assert_called_once()
+        self.assertEqual(len(etcd.transaction.call_args[1]['success']), 3)
+
+        # An instance left by another create is not touched
+        mock_instance.reset_mock()
+        mock_instance.config = {'environment.LX_INSTANCE_ID': 'other'}
+        client.instances.create.side_effect = RuntimeError('already exists')
+
+        with self.assertRaises(RuntimeError):
+            api.handle_create_message(message, 'lxconsumer')
+
+        mock_instance.delete.assert_not_called()
+        self.assertEqual(len(etcd.transaction.call_args[1]['success']), 3)
 
 
     @mock.patch('pylxd.Client', autospec=True)
-    @mock.patch('etcd3.client.Etcd3Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
     def test_handle_operations_message_restart_success(self, mock_etcd3, mock_client):
         etcd = mock_etcd3.return_value
 
@@ -183,7 +521,8 @@ class TestLxdApi(unittest.TestCase):
                                  'vscode': {'connect': 'tcp:127.0.0.1:3300',
                                             'listen': 'tcp:127.0.0.1:9002',
                                             'type': 'proxy'}}
-        mock_instance.state.return_value = { 'status_code': 103, 'status': 'Running' , 'pid': 1234}
+        mock_instance.config = {'environment.LX_INSTANCE_ID': 'abc', 'environment.LX_ENV_ID': '10'}
+        mock_instance.state.return_value = types.SimpleNamespace(status_code=103, status='Running', pid=1234)
         client.instances.get.return_value = mock_instance
 
 
@@ -195,10 +534,183 @@ class TestLxdApi(unittest.TestCase):
 
         settings = Settings()
         api = LxdApi(config=settings)
-        result = api.handle_operation_message(message)
+        api.status_cache.set('cs135-f23-user0', {'status': 'Stopped'})
+        result = api.handle_operation_message(message, 'lxadmin')
 
+        mock_instance.restart.assert_called_once_with(wait=True)
         self.assertEqual(result['status'], 'Running')
+        self.assertEqual(result['environment']['id'], '10')
+        self.assertNotIn('cs135-f23-user0', api.status_cache)
 
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_status_is_cached(self, mock_etcd3, mock_client):
+        client = mock_client.return_value
+        client.instances = mock.MagicMock()
+
+        mock_instance = mock.MagicMock(spec=pylxd.models.Instance)
+        mock_instance.name = 'cs135-f23-user0'
+        mock_instance.config = {'environment.LX_INSTANCE_ID': 'abc', 'environment.LX_ENV_ID': '10'}
+        mock_instance.state.return_value = types.SimpleNamespace(status='Running')
+        client.instances.get.return_value = mock_instance
+
+        message = models.OperationMessage.parse_obj({
+            'username': 'user0',
+            'instance': 'cs135-f23-user0',
+            'operation': 'status'
+        })
+
+        settings = Settings()
+        api = LxdApi(config=settings)
+
+        for i in range(5):
+            result = api.handle_operation_message(message, 'lxadmin')
+
+        self.assertEqual(result['status'], 'Running')
+        self.assertEqual(mock_instance.state.call_count, 1)
+
+
+    @mock.patch('pylxd.Client', autospec=True)
+    @mock.patch('etcd3.client', autospec=True)
+    def test_run_commands_batch(self, mock_etcd3, mock_client):
+        settings = Settings(TEMPLATE_EXEC_MODE='batch')
+        api = LxdApi(config=settings)
+
+        instance = mock.Mock()
+        instance.execute.return_value = types.SimpleNamespace(
+            exit_code=1, stdout='', stderr='adduser: exists\nlxrmq-step-failed 0 1\n')
+        commands = [['bash', '-c', 'adduser user0'], ['bash', '-c', 'systemctl start ttyd@user0']]
+
+        with self.assertRaises(TemplateCommandError) as context:
+            api.run_commands(instance, commands)
+
+        self.assertEqual(context.exception.command, commands[0])
+        instance.execute.assert_called_once()
+        args, kwargs = instance.execute.call_args
+        self.assertEqual(args[0][:2], ['bash', '-c'])
+
+
+class TestLxdTemplateManager(unittest.TestCase):
+
+    def test_render_compiles_once(self):
+        manager = LxdTemplateManager('templates')
+        context = {
+            'environment': models.Environment.parse_obj({
+                'id': '10',
+                'name': 'CS135',
+                'type': 'simple',
+                'instance': {'id': 'abc', 'name': 'cs135-f23-user0', 'type': 'container'},
+                'user': {'id': '1', 'username': 'user0', 'uid_number': '1000000'},
+            }),
+            'ports': [9000, 9001, 9002],
+            'address': '127.0.0.1',
+        }
+
+        with mock.patch.object(manager._env, 'from_string', wraps=manager._env.from_string) as from_string:
+            for i in range(3):
+                config = json.loads(manager.render('cs135-f23', context))
+                command = manager.render_list(['{{ environment.user.username }}', 'ls'], context)
+
+        self.assertEqual(config['name'], 'cs135-f23-user0')
+        self.assertEqual(config['devices']['ttyd']['listen'], 'tcp:127.0.0.1:9001')
+        self.assertEqual(command, ['user0', 'ls'])
+        # The template was compiled at load, the new strings on first use
+        self.assertEqual(from_string.call_count, 2)
+
+    def test_render_config_compiles_at_load(self):
+        manager = LxdTemplateManager('templates')
+        context = {
+            'environment': models.Environment.parse_obj({
+                'id': '10',
+                'name': 'CS135',
+                'type': 'simple',
+                'instance': {'id': 'abc', 'name': 'cs135-f23-user0', 'type': 'container'},
+                'user': {'id': '1', 'username': 'user0', 'uid_number': '1000000'},
+            }),
+            'ports': [9000, 9001, 9002],
+            'address': '127.0.0.1',
+        }
+        template = manager.template('cs135-f23')
+
+        with mock.patch.object(manager._env, 'from_string', wraps=manager._env.from_string) as from_string:
+            for i in range(3):
+                config = manager.render_config('cs135-f23', context)
+
+        # Every string holding an expression was compiled when loaded
+        self.assertEqual(from_string.call_count, 0)
+        self.assertEqual([p for p, _ in template.leaves], list(template_paths(template.config)))
+        self.assertEqual(config['name'], 'cs135-f23-user0')
+        self.assertEqual(config['devices']['ttyd']['listen'], 'tcp:127.0.0.1:9001')
+
+        # The structured render gives the same config without a JSON round trip
+        self.assertEqual(config, json.loads(manager.render('cs135-f23', context)))
+
+        context['environment'].user.username = 'o"brien'
+        config = manager.render_config('cs135-f23', context)
+        self.assertEqual(config['config']['environment.LX_USER'], 'o"brien')
+
+        stored = manager.get('cs135-f23')
+        self.assertEqual(stored['config']['environment.LX_USER'], '{{ environment.user.username }}')
+        self.assertIs(config['template'], stored['template'])
+
+    def test_reload_changed_templates(self):
+        def write(path, ports, mtime):
+            with open(path, 'w') as fd:
+                json.dump({'name': '{{ name }}', 'template': {
+                    'name': 'ex100', 'ports': ports, 'commands': [['echo', f'v{ports}']]}}, fd)
+            os.utime(path, (mtime, mtime))
+
+        with tempfile.TemporaryDirectory() as template_dir:
+            os.mkdir(os.path.join(template_dir, 'f23'))
+            path = os.path.join(template_dir, 'f23', 'ex100.json.j2')
+            write(path, 1, 1000)
+
+            manager = LxdTemplateManager(template_dir, reload_interval=30)
+            loaded = manager.template('ex100')
+            self.assertEqual(manager.get('ex100')['template']['ports'], 1)
+
+            # Within the interval nothing is checked
+            write(path, 2, 2000)
+            self.assertIs(manager.template('ex100'), loaded)
+
+            manager._checked = 0
+            self.assertEqual(manager.get('ex100')['template']['ports'], 2)
+            self.assertEqual(manager.render_config('ex100', {'name': 'a'})['name'], 'a')
+
+            # Only the commands of the current version stay compiled
+            self.assertEqual(set(manager._sources), {'echo', 'v2'})
+
+            # An invalid version keeps the last good one
+            with open(path, 'w') as fd:
+                fd.write('{"template": {"name": "ex100", "ports": "three"}}')
+            manager.reload()
+            self.assertEqual(manager.get('ex100')['template']['ports'], 2)
+
+            os.remove(path)
+            manager.reload()
+            self.assertIsNone(manager.get('ex100'))
+
+    def test_duplicate_template_names(self):
+        def write(path, ports):
+            with open(path, 'w') as fd:
+                json.dump({'name': '{{ name }}', 'template': {'name': 'ex100', 'ports': ports}}, fd)
+
+        with tempfile.TemporaryDirectory() as template_dir:
+            write(os.path.join(template_dir, 'a.json.j2'), 1)
+            write(os.path.join(template_dir, 'b.json.j2'), 2)
+
+            with self.assertLogs('api', level='DEBUG') as logs:
+                manager = LxdTemplateManager(template_dir, reload_interval=30)
+
+            # The first file keeps the name, the second is reported
+            self.assertEqual(manager.get('ex100')['template']['ports'], 1)
+            self.assertTrue(any('b.json.j2' in m and m.startswith('WARNING') for m in logs.output))
+            self.assertTrue(any(m.startswith('DEBUG:api:Template files') for m in logs.output))
+
+            # An unchanged directory is not listed again
+            with mock.patch('api.LOGGER') as logger:
+                manager.reload()
+            logger.debug.assert_not_called()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,135 @@
+import copy
+import json
+import logging
+import os
+import re
+
+import nanoid
+
+from lxrmq.commands import batch_script, check_batch_result
+
+LOGGER = logging.getLogger(__name__)
+
+BUILD_NANOID_SET = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+# Jinja expressions and the instance's environment.LX_* variables
+PER_USER_PATTERN = re.compile(r'{{|{%|\$\{?LX_')
+
+
+def is_user_independent(command):
+    """True when no argument of command depends on the user or instance."""
+    return not any(PER_USER_PATTERN.search(item) for item in command)
+
+
+def bakeable_commands(template):
+    """Returns the leading template commands that are the same for every
+    user. Only a leading run can be baked, since a later command may
+    depend on the per-user steps before it.
+    """
+    commands = template['template'].get('commands', [])
+    count = 0
+
+    while count < len(commands) and is_user_independent(commands[count]):
+        count += 1
+
+    return commands[:count]
+
+
+def baked_template(template, alias):
+    """Returns a copy of template creating from image alias and running
+    only the commands that were not baked into it.
+    """
+    baked = copy.deepcopy(template)
+    count = len(bakeable_commands(template))
+
+    baked['template']['baked_from'] = copy.deepcopy(template['source'])
+    baked['template']['commands'] = template['template']['commands'][count:]
+    baked['source'] = {'type': 'image', 'alias': alias}
+
+    return baked
+
+
+def build_config(template, name):
+    """Config for the build container: the template's image, profiles and
+    limits without its per-instance environment and devices.
+    """
+    config = {k: v for k, v in template.get('config', {}).items()
+              if not k.startswith('environment.')}
+
+    return {
+        'name': name,
+        'type': template.get('type', 'container'),
+        'source': template['source'],
+        'config': config,
+        'profiles': template.get('profiles', ['default']),
+    }
+
+
+def bake_image(client, template, alias):
+    """Runs the user independent commands of template in a build container
+    and publishes it as image alias. Returns the image, or None when there
+    is nothing to bake.
+    """
+    commands = bakeable_commands(template)
+
+    if not commands:
+        LOGGER.info(f'Template ({template["template"]["name"]}) has nothing to bake')
+        return None
+
+    name = f'lxbake-{nanoid.generate(BUILD_NANOID_SET, 8)}'
+    LOGGER.info(f'Baking ({len(commands)}) commands into ({alias}) using ({name})')
+
+    instance = client.instances.create(build_config(template, name), wait=True)
+
+    try:
+        instance.start(wait=True)
+        result = instance.execute(['bash', '-c', batch_script(commands)])
+        check_batch_result(result, commands)
+        instance.stop(wait=True)
+
+        image = instance.publish(wait=True)
+        if client.images.exists(alias, alias=True):
+            client.images.get_by_alias(alias).delete_alias(alias)
+        image.add_alias(alias, f'Baked from {template["template"]["name"]}')
+    finally:
+        if instance.status == 'Running':
+            instance.stop(force=True, wait=True)
+        instance.delete(wait=True)
+
+    return image
+
+
+def bake_template_file(client, path, alias=None):
+    """Bakes the template at path and rewrites it to use the baked image.
+    The original is kept next to it with a .orig suffix, which the template
+    manager does not load. Returns the rewritten template, or None.
+
+    Raises FileExistsError when a .orig is already there: the template
+    has been baked before, and baking it again would lose the original.
+    """
+    backup = f'{path}.orig'
+
+    if os.path.exists(backup):
+        raise FileExistsError(f'({path}) is already baked, restore ({backup}) to bake it again')
+
+    with open(path, 'r') as fd:
+        template = json.load(fd)
+
+    if alias is None:
+        alias = f'{template["template"]["name"]}-baked'
+
+    if bake_image(client, template, alias) is None:
+        return None
+
+    baked = baked_template(template, alias)
+
+    with open(backup, 'w') as fd:
+        json.dump(template, fd, indent=4)
+
+    # Swapped in whole so a reloading consumer never reads half a file
+    with open(f'{path}.tmp', 'w') as fd:
+        json.dump(baked, fd, indent=4)
+    os.replace(f'{path}.tmp', path)
+
+    LOGGER.info(f'Rewrote ({path}) to create from ({alias})')
+    return baked
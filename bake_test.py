@@ -0,0 +1,175 @@
+import json
+import os
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from lxrmq.commands import TemplateCommandError
+from bake import bakeable_commands, baked_template, bake_image, bake_template_file
+
+
+def make_template(commands):
+    return {
+        'name': '{{ environment.instance.name }}',
+        'type': 'container',
+        'source': {'type': 'image', 'alias': 'cs135-f23'},
+        'config': {
+            'limits.cpu': '2',
+            'environment.LX_USER': '{{ environment.user.username }}',
+        },
+        'devices': {},
+        'profiles': ['default'],
+        'template': {'name': 'cs135-f23', 'ports': 3, 'commands': commands},
+    }
+
+
+SHARED = [['apt-get', 'install', '-y', 'code-server'],
+          ['bash', '-c', 'systemctl enable ttyd']]
+PER_USER = [['bash', '-c', 'systemctl enable tigervnc@${LX_USER}'],
+            ['bash', '-c', 'systemctl enable code-server']]
+
+
+class TestBakeableCommands(unittest.TestCase):
+
+    def test_leading_shared_commands(self):
+        template = make_template(SHARED + PER_USER)
+
+        self.assertEqual(bakeable_commands(template), SHARED)
+
+    def test_per_user_references(self):
+        for command in (['bash', '-c', 'adduser $LX_USER'],
+                        ['bash', '-c', 'chown ${LX_UID} /home'],
+                        ['echo', '{{ environment.user.username }}'],
+                        ['echo', '{% if x %}y{% endif %}']):
+            self.assertEqual(bakeable_commands(make_template([command])), [])
+
+    def test_shipped_templates(self):
+        directory = os.path.join(os.path.dirname(__file__), 'templates')
+
+        for filename in os.listdir(directory):
+            if not filename.endswith('.json.j2'):
+                continue
+            with open(os.path.join(directory, filename), 'r') as fd:
+                template = json.load(fd)
+            # Every step of these templates uses LX_USER
+            self.assertEqual(bakeable_commands(template), [])
+
+    def test_baked_template(self):
+        template = make_template(SHARED + PER_USER)
+
+        baked = baked_template(template, 'cs135-f23-baked')
+
+        self.assertEqual(baked['source'], {'type': 'image', 'alias': 'cs135-f23-baked'})
+        self.assertEqual(baked['template']['commands'], PER_USER)
+        self.assertEqual(baked['template']['baked_from']['alias'], 'cs135-f23')
+        self.assertEqual(template['template']['commands'], SHARED + PER_USER)
+
+
+class TestBakeImage(unittest.TestCase):
+
+    def make_client(self, exit_code=0):
+        client = mock.MagicMock()
+        instance = client.instances.create.return_value
+        instance.status = 'Stopped'
+        instance.execute.return_value = types.SimpleNamespace(
+            exit_code=exit_code, stdout='', stderr='lxrmq-step-failed 1 1\n' if exit_code else '')
+        client.images.exists.return_value = False
+        return client, instance
+
+    def test_publishes_image(self):
+        client, instance = self.make_client()
+
+        image = bake_image(client, make_template(SHARED + PER_USER), 'cs135-f23-baked')
+
+        config = client.instances.create.call_args[0][0]
+        self.assertEqual(config['source'], {'type': 'image', 'alias': 'cs135-f23'})
+        self.assertEqual(config['config'], {'limits.cpu': '2'})
+        self.assertNotIn('devices', config)
+
+        script = instance.execute.call_args[0][0][2]
+        self.assertIn('code-server', script)
+        self.assertNotIn('LX_USER', script)
+
+        self.assertIs(image, instance.publish.return_value)
+        image.add_alias.assert_called_once_with('cs135-f23-baked', mock.ANY)
+        instance.delete.assert_called_once_with(wait=True)
+
+    def test_nothing_to_bake(self):
+        client, _ = self.make_client()
+
+        self.assertIsNone(bake_image(client, make_template(PER_USER), 'baked'))
+        client.instances.create.assert_not_called()
+
+    def test_failed_step_removes_build(self):
+        client, instance = self.make_client(exit_code=1)
+
+        with self.assertRaises(TemplateCommandError):
+            bake_image(client, make_template(SHARED + PER_USER), 'baked')
+
+        instance.publish.assert_not_called()
+        instance.delete.assert_called_once_with(wait=True)
+
+    def test_rewrites_template_file(self):
+        client, _ = self.make_client()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cs135-f23.json.j2')
+            with open(path, 'w') as fd:
+                json.dump(make_template(SHARED + PER_USER), fd)
+
+            bake_template_file(client, path)
+
+            with open(path, 'r') as fd:
+                baked = json.load(fd)
+            with open(f'{path}.orig', 'r') as fd:
+                original = json.load(fd)
+
+        self.assertEqual(baked['source']['alias'], 'cs135-f23-baked')
+        self.assertEqual(baked['template']['commands'], PER_USER)
+        self.assertEqual(original['template']['commands'], SHARED + PER_USER)
+
+    def test_bakes_shared_prefix_of_shipped_template(self):
+        client, instance = self.make_client()
+        shipped = os.path.join(os.path.dirname(__file__), 'templates', 'cs135-f23.json.j2')
+
+        with open(shipped, 'r') as fd:
+            template = json.load(fd)
+        per_user = template['template']['commands']
+        template['template']['commands'] = SHARED + per_user
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cs135-f23.json.j2')
+            with open(path, 'w') as fd:
+                json.dump(template, fd)
+
+            baked = bake_template_file(client, path, 'cs135-f23-tools')
+
+        script = instance.execute.call_args[0][0][2]
+        self.assertIn('apt-get install -y code-server', script)
+        self.assertIn('systemctl enable ttyd', script)
+        self.assertEqual(baked['source'], {'type': 'image', 'alias': 'cs135-f23-tools'})
+        self.assertEqual(baked['template']['baked_from'], template['source'])
+        self.assertEqual(baked['template']['commands'], per_user)
+
+    def test_refuses_to_bake_twice(self):
+        client, _ = self.make_client()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cs135-f23.json.j2')
+            with open(path, 'w') as fd:
+                json.dump(make_template(SHARED + PER_USER), fd)
+            with open(f'{path}.orig', 'w') as fd:
+                fd.write('original')
+
+            with self.assertRaises(FileExistsError):
+                bake_template_file(client, path)
+
+            with open(f'{path}.orig', 'r') as fd:
+                self.assertEqual(fd.read(), 'original')
+
+        client.instances.create.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
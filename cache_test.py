@@ -0,0 +1,90 @@
+import unittest
+from unittest import mock
+
+import threading
+import time
+
+from cache import SingleFlight, TTLCache
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_get_set_pop(self):
+        cache = TTLCache(maxsize=4, ttl=60)
+        cache.set('a', 1)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIn('a', cache)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+
+    @mock.patch('cache.time.monotonic')
+    def test_expiry(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        cache = TTLCache(maxsize=2, ttl=10)
+        cache.set('a', 1)
+
+        mock_monotonic.return_value = 111.0
+
+        self.assertEqual(cache.get('a', 'missing'), 'missing')
+        self.assertEqual(len(cache), 0)
+
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_calls_share_result(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'Running'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('i1', fetch)))
+        leader.start()
+        started.wait(5)
+
+        followers = [threading.Thread(target=lambda: results.append(flight.do('i1', fetch)))
+                     for i in range(3)]
+        for t in followers:
+            t.start()
+
+        # Let the followers block on the running call
+        time.sleep(0.2)
+        release.set()
+        for t in [leader] + followers:
+            t.join(5)
+
+        self.assertEqual(results, ['Running'] * 4)
+        self.assertEqual(len(calls), 1)
+
+    def test_exception_is_shared_and_cleared(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise RuntimeError('lxd down')
+
+        with self.assertRaises(RuntimeError):
+            flight.do('i1', fail)
+
+        self.assertEqual(flight.do('i1', lambda: 'ok'), 'ok')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import re
+import shlex
+
+# Written to stderr by batch_script for the step that failed
+FAILED_STEP = 'lxrmq-step-failed'
+FAILED_STEP_PATTERN = re.compile(rf'^{FAILED_STEP} (\d+) (\d+)$', re.MULTILINE)
+
+
+class TemplateCommandError(Exception):
+    """Raised when a template command exits with a non-zero code."""
+
+    def __init__(self, step, command, exit_code, stderr=''):
+        self.step = step
+        self.command = command
+        self.exit_code = exit_code
+        self.stderr = stderr
+        super().__init__(f'Step {step} ({shlex.join(command)}) exited with {exit_code}')
+
+
+def batch_script(commands):
+    """Returns a bash script running commands in order. The script stops
+    at the first command that fails and reports its step on stderr.
+    """
+    lines = []
+
+    for step, command in enumerate(commands):
+        lines.append(
+            f'{shlex.join(command)} || '
+            f'{{ rc=$?; echo "{FAILED_STEP} {step} $rc" >&2; exit $rc; }}')
+
+    return '\n'.join(lines)
+
+
+def check_batch_result(result, commands):
+    """Raises TemplateCommandError for the failed step of a batch_script
+    run, given the result of instance.execute.
+    """
+    if result.exit_code == 0:
+        return
+
+    match = FAILED_STEP_PATTERN.search(result.stderr or '')
+
+    if match is None:
+        # The script itself could not run
+        raise TemplateCommandError(-1, ['bash'], result.exit_code, result.stderr)
+
+    step = int(match.group(1))
+    raise TemplateCommandError(step, commands[step], result.exit_code, result.stderr)
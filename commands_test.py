@@ -0,0 +1,45 @@
+import subprocess
+import types
+import unittest
+
+from commands import TemplateCommandError, batch_script, check_batch_result
+
+
+class TestBatchScript(unittest.TestCase):
+
+    def run_script(self, commands):
+        process = subprocess.run(['bash', '-c', batch_script(commands)],
+                                 capture_output=True, text=True)
+        return types.SimpleNamespace(
+            exit_code=process.returncode, stdout=process.stdout, stderr=process.stderr)
+
+    def test_runs_every_step(self):
+        commands = [['echo', 'one'], ['bash', '-c', 'echo "two $((1 + 1))"']]
+
+        result = self.run_script(commands)
+
+        check_batch_result(result, commands)
+        self.assertEqual(result.stdout, 'one\ntwo 2\n')
+
+    def test_stops_at_failed_step(self):
+        commands = [['true'], ['bash', '-c', 'exit 3'], ['echo', 'never']]
+
+        result = self.run_script(commands)
+
+        with self.assertRaises(TemplateCommandError) as context:
+            check_batch_result(result, commands)
+
+        self.assertEqual(context.exception.step, 1)
+        self.assertEqual(context.exception.command, ['bash', '-c', 'exit 3'])
+        self.assertEqual(context.exception.exit_code, 3)
+        self.assertEqual(result.stdout, '')
+
+    def test_arguments_are_quoted(self):
+        commands = [['echo', "it's $HOME; rm -rf /"]]
+
+        result = self.run_script(commands)
+
+        self.assertEqual(result.stdout, "it's $HOME; rm -rf /\n")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,6 +15,14 @@ class Settings(BaseSettings):
     ETCD_CERT: str = str(pathlib.Path(working_dir,'ssl/lx-client.pem'))
     ETCD_KEY: str = str(pathlib.Path(working_dir, 'ssl/lx-client-key.pem'))
     ETCD_LOCK_NAME: str = 'lxd'
+    ETCD_PENDING_PORTS_PREFIX: str = '/lxd/pending_ports/'
+    ETCD_PENDING_PORTS_TTL: int = 900
+    ETCD_REQUESTS_PREFIX: str = '/lxd/requests/'
+
+    IDEMPOTENT_CREATES: bool = False
+    IDEMPOTENCY_PENDING_TTL: int = 60
+    IDEMPOTENCY_RESULT_TTL: int = 3600
+    IDEMPOTENCY_WAIT_TIMEOUT: float = 900
 
     RMQ_USER_ID: str = 'lxconsumer'
     RMQ_APPLCAITON: str = 'lxd-consumer'
@@ -29,11 +37,39 @@ class Settings(BaseSettings):
     RMQ_HOST_PORT: int =  5671
     RMQ_VHOST: str = '/'
     RMQ_USER_ID: str
+    RMQ_PUBLISHER_CONFIRMS: bool = False
+    RMQ_PUBLISH_RETRIES: int = 3
+    RMQ_RECONNECT_BASE_DELAY: float = 0.5
+    RMQ_RECONNECT_MAX_DELAY: float = 30
+
+    CONSUMER_EXECUTOR: str = 'thread'  # thread, process or inline
+    CONSUMER_WORKERS: int = 4
+    CONSUMER_PREFETCH: int = 8
+    CONSUMER_DRAIN_TIMEOUT: float = 120
+    CREATE_LANE: bool = False  # creates run from lx.api-create-queue, unless API_SHARDS
+    CREATE_WORKERS: int = 2
+    CREATE_PREFETCH: int = 2
+    API_SHARDS: int = 0  # 0 consumes the single lx.api-queue
+    API_SHARD: int = 0
 
     NODES: dict
     PORT_RANGE: set[int] = set(range(9000, 15000))
+    PORT_ALLOCATION_MODE: str = 'lock'  # lock or transaction
+    PORT_ALLOCATION_RETRIES: int = 5
+    PORT_INDEX: bool = False
+    PORT_POOLS_PER_NODE: bool = False
+    PORT_BLOCK_SIZE: int = 0  # 0 disables client-side port blocks
+    PORT_BLOCK_TTL: int = 300
     LXD_ENDPOINT: Optional[str] = None
+    INVENTORY_CACHE: bool = False
+    INVENTORY_RESYNC_INTERVAL: float = 600
+    OWNER_CACHE_SIZE: int = 4096
+    OWNER_CACHE_TTL: float = 300
+    STATUS_CACHE_SIZE: int = 4096
+    STATUS_CACHE_TTL: float = 2  # 0 only coalesces concurrent requests
     HTTPS_ENDPOINT: Optional[str] = None
+    TEMPLATE_RELOAD_INTERVAL: float = 30  # 0 loads templates once
+    TEMPLATE_EXEC_MODE: str = 'each'  # each or batch
 
     class Config:
         case_sensitive=False
@@ -1,3 +1,4 @@
-from .api import LxdApiConsumer, ReconnectingLxdApiConsumer
+from .api import LxdApiConsumer, LxdApiCreateConsumer, LxdApiShardRouter, ReconnectingLxdApiConsumer
 from .simple import LxdSimpleInstanceCreationConsumer, ReconnectingLxdSimpleInstanceCreationConsumer
-from .database import LxdEnvDatabaseConsumer, ReconnectingLxdEnvDatabaseConsumer
\ No newline at end of file
+from .database import LxdEnvDatabaseConsumer, ReconnectingLxdEnvDatabaseConsumer
+from .host import ConsumerHost, ReconnectingConsumerHost
\ No newline at end of file
@@ -3,6 +3,9 @@
 import logging
 import time
 import json
+import uuid
+import functools
+import concurrent.futures
 
 import pika
 from pika import spec as pika_spec
@@ -10,7 +13,9 @@ from pika import channel as pika_channel
 from pika.exchange_type import ExchangeType
 
 from lxrmq import models
-from lxrmq.consumers.base import BaseConsumer, BaseReconnectingConsumer
+from lxrmq.api import LxdApi
+from lxrmq.config import settings
+from lxrmq.consumers.base import BaseConsumer, BaseReconnectingConsumer, make_executor
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
               '-35s %(lineno) -5d: %(message)s')
@@ -18,6 +23,29 @@ LOGGER = logging.getLogger(__name__)
 
 JSON_CONTENT_TYPE = 'application/json'
 
+_worker_lxdapi = None
+
+
+def init_worker(config):
+    """Process pool initializer, giving each worker process its own LxdApi
+    since LXD and etcd clients cannot be shared across processes.
+
+    """
+    global _worker_lxdapi
+    _worker_lxdapi = LxdApi(config=config)
+
+
+def call_lxdapi(method, *args):
+    return getattr(_worker_lxdapi, method)(*args)
+
+
+def make_api_executor(workers=None):
+    if workers is None:
+        workers = settings.CONSUMER_WORKERS
+    return make_executor(settings.CONSUMER_EXECUTOR, workers,
+                         initializer=init_worker, initargs=(settings,))
+
+
 class LxdApiConsumer(BaseConsumer):
     """
     RMQ consumer for manipulating LXD containers.
@@ -29,16 +57,165 @@ class LxdApiConsumer(BaseConsumer):
 
     CREATE_ROUTING_KEY = 'lx.simple'
 
-    def __init__(self, parameters, lxdapi):
-        super().__init__(parameters)
+    SHARD_EXCHANGE = 'lx.api-shards'
+    SHARD_EXCHANGE_TYPE = 'x-consistent-hash'
+    SHARD_HASH_HEADER = 'x-instance'
+    SHARD_WEIGHT = '1'
+
+    # Alternate exchange of the shard exchange, for messages it cannot
+    # hash because they have no x-instance header
+    UNSHARDED_EXCHANGE = 'lx.api-unsharded'
+    UNSHARDED_QUEUE = 'lx.api-unsharded-queue'
+    UNSHARDED_QUEUE_ARGUMENTS = {"x-queue-type": "quorum", "x-single-active-consumer": True}
+
+    FORWARDED_USER_HEADER = 'x-forwarded-user'
+
+    def __init__(self, parameters, lxdapi, executor=None, shards=None, shard=None,
+                 prefetch_count=None, create_lane=None):
+        """With shards set, lx.api messages are spread over that many
+        queues by a consistent hash of their x-instance header, and this
+        consumer only serves the queue numbered shard. Every message for
+        an instance then lands on the same shard, whose queue has a single
+        active consumer, so replicas never handle one instance at once.
+
+        :param pika.ConnectionParameters parameters: The connection parameters
+        :param LxdApi lxdapi: The LXD api
+        :param concurrent.futures.Executor executor: The handler pool
+        :param int shards: Number of shard queues, 0 for the single queue
+        :param int shard: The shard this consumer serves
+        :param int prefetch_count: Unacknowledged message limit
+        :param bool create_lane: Forward creates to LxdApiCreateConsumer,
+            ignored when sharded
+
+        """
+        if executor is None:
+            executor = make_api_executor()
+
+        if prefetch_count is None:
+            prefetch_count = settings.CONSUMER_PREFETCH
+
+        if create_lane is None:
+            create_lane = settings.CREATE_LANE
+
+        if shards is None:
+            shards = settings.API_SHARDS
+
+        # The create queue is shared by every shard, so forwarding would
+        # let a create overtake or race other messages for its instance
+        if create_lane and shards:
+            LOGGER.warning('Create lane is not used with API_SHARDS, creates run on their shard')
+            create_lane = False
+
+        if create_lane:
+            check_forwarding_user()
+
+        # A create is only acknowledged once its forward is confirmed
+        super().__init__(parameters, executor=executor,
+                         prefetch_count=prefetch_count,
+                         publisher_confirms=settings.RMQ_PUBLISHER_CONFIRMS or create_lane,
+                         publish_retries=settings.RMQ_PUBLISH_RETRIES,
+                         drain_timeout=settings.CONSUMER_DRAIN_TIMEOUT)
         self._lxdapi = lxdapi
+        self._create_lane = create_lane
+
+        self._shards = shards
+        self._shard = settings.API_SHARD if shard is None else shard
+
+        if self._shards:
+            if not 0 <= self._shard < self._shards:
+                raise ValueError(f'Shard ({self._shard}) not in range of ({self._shards}) shards')
+
+            self.QUEUE = self.shard_queue(self._shard)
+            self.QUEUE_ARGUMENTS = dict(self.QUEUE_ARGUMENTS)
+            self.QUEUE_ARGUMENTS['x-single-active-consumer'] = True
+
+    def shard_queue(self, shard):
+        return f'{LxdApiConsumer.QUEUE}.{shard}'
+
+    def on_exchange_declareok(self, _unused_frame, userdata):
+        """When sharded, declares the consistent-hash exchange after the
+        lx exchange and binds it to lx.api before any queue is set up.
+
+        :param pika.Frame.Method unused_frame: Exchange.DeclareOk response frame
+        :param str|unicode userdata: Extra user data (exchange name)
+
+        """
+        if not self._shards:
+            super().on_exchange_declareok(_unused_frame, userdata)
+            return
+
+        if userdata == self.EXCHANGE:
+            self.declare_unsharded()
+
+            LOGGER.info('Declaring exchange: %s', self.SHARD_EXCHANGE)
+            self._channel.exchange_declare(
+                exchange=self.SHARD_EXCHANGE,
+                exchange_type=self.SHARD_EXCHANGE_TYPE,
+                durable=True,
+                arguments={'hash-header': self.SHARD_HASH_HEADER,
+                           'alternate-exchange': self.UNSHARDED_EXCHANGE},
+                callback=functools.partial(
+                    self.on_exchange_declareok, userdata=self.SHARD_EXCHANGE))
+            return
+
+        LOGGER.info('Binding %s to %s with %s', self.SHARD_EXCHANGE,
+                    self.EXCHANGE, self.ROUTING_KEY)
+        self._channel.exchange_bind(
+            destination=self.SHARD_EXCHANGE,
+            source=self.EXCHANGE,
+            routing_key=self.ROUTING_KEY,
+            callback=self.on_shard_exchange_bindok)
+
+    def declare_unsharded(self):
+        """Declares the alternate exchange and the queue it feeds, so
+        messages without an x-instance header wait for LxdApiShardRouter
+        rather than being dropped.
+
+        """
+        LOGGER.info('Declaring exchange: %s', self.UNSHARDED_EXCHANGE)
+        self._channel.exchange_declare(
+            exchange=self.UNSHARDED_EXCHANGE,
+            exchange_type=ExchangeType.fanout,
+            durable=True)
+        if self.declare_topology:
+            self._channel.queue_declare(
+                queue=self.UNSHARDED_QUEUE, durable=True,
+                arguments=self.UNSHARDED_QUEUE_ARGUMENTS)
+        self._channel.queue_bind(self.UNSHARDED_QUEUE, self.UNSHARDED_EXCHANGE)
+
+    def on_shard_exchange_bindok(self, _unused_frame):
+        """Declares and binds every shard queue, not just our own, so a
+        message is routed to the same shard whichever replicas are running.
+
+        :param pika.frame.Method _unused_frame: The Exchange.BindOk frame
+
+        """
+        for shard in range(self._shards):
+            queue = self.shard_queue(shard)
+            if queue == self.QUEUE:
+                continue
+
+            if self.declare_topology:
+                self._channel.queue_declare(
+                    queue=queue, durable=True, arguments=self.QUEUE_ARGUMENTS)
+            self._channel.queue_bind(
+                queue, self.SHARD_EXCHANGE, routing_key=self.SHARD_WEIGHT)
+
+        self.setup_queue(self.QUEUE)
+
+    def queue_binding(self):
+        if not self._shards:
+            return super().queue_binding()
+        return (self.SHARD_EXCHANGE, self.SHARD_WEIGHT)
 
 
     def on_message(self, _unused_channel: pika_channel.Channel, 
                    basic_deliver: pika_spec.Basic.Deliver, 
                    properties: pika.BasicProperties, 
                    body: bytes):
-        """Invoked by pika when a message is delivered from RabbitMQ. 
+        """Invoked by pika when a message is delivered from RabbitMQ. The
+        message is validated here and the LXD work is dispatched to the
+        executor; the reply and acknowledgement follow in on_handled.
 
         :param pika.channel.Channel _unused_channel: The channel object
         :param pika.Spec.Basic.Deliver: basic_deliver method
@@ -51,13 +228,11 @@ class LxdApiConsumer(BaseConsumer):
                     properties.reply_to, properties.app_id, properties.user_id, body)
 
         headers: models.MessageHeaders = None
-        result = None
 
         #Check headers
         try:
             headers = models.MessageHeaders.parse_obj(properties.headers)
         except Exception as e:
-            result = e
             LOGGER.info(f'Headers Exception: {e}, Type({type(e)})')
             self.send_error(
                 {'type' : f'{type(e).__name__}', 'message': str(e)},
@@ -75,67 +250,352 @@ class LxdApiConsumer(BaseConsumer):
             self.acknowledge_message(basic_deliver.delivery_tag)
             return
 
-        #Create
-        if headers.x_type == 'create':
+        if self._shards:
             try:
-                self.handle_create_message(body, headers, properties)
+                self.check_shard_header(headers, body)
             except Exception as e:
-                LOGGER.info(f'Failed to create instance: {e}')
-                result = e
+                self.on_handled(basic_deliver, properties, None, e)
+                return
+
+        #Create
+        if headers.x_type == 'create' and self._create_lane:
+            self.forward_create(basic_deliver, properties, headers, body)
+            return
+
+        self.handle_message(basic_deliver, properties, headers, body)
+
+    def check_shard_header(self, headers, body):
+        """Raises ValueError unless the x-instance header names the
+        instance in the body. Sharding only keeps an instance's messages
+        in order if they all hash on its name.
+
+        :param lxrmq.models.MessageHeaders headers: The parsed headers
+        :param bytes body: The message body
+
+        """
+        instance = message_instance(headers, body)
+
+        if instance is not None and headers.x_instance != instance:
+            raise ValueError(f'x-instance ({headers.x_instance}) does not match instance ({instance})')
+
+    def forwarded_properties(self, properties, headers=None):
+        """Properties for republishing a message on the sender's behalf.
+        RabbitMQ only accepts a user_id matching our own connection, which
+        check_forwarding_user() ensures RMQ_USER_ID is, so the sender's goes
+        along in a header.
+
+        :param pika.Spec.BasicProperties properties: The received properties
+        :param dict headers: Headers to add or replace
+
+        """
+        forwarded_headers = dict(properties.headers)
+        forwarded_headers[self.FORWARDED_USER_HEADER] = self.message_user(properties)
+        forwarded_headers.update(headers or {})
+
+        return pika.BasicProperties(
+            content_type=properties.content_type,
+            correlation_id=properties.correlation_id,
+            headers=forwarded_headers,
+            message_id=str(uuid.uuid4()),
+            reply_to=properties.reply_to,
+            timestamp=properties.timestamp,
+            user_id=settings.RMQ_USER_ID
+        )
+
+    def handle_message(self, basic_deliver, properties, headers, body):
+        """Dispatches the LXD work for a validated message.
+
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+        :param lxrmq.models.MessageHeaders headers: The parsed headers
+        :param bytes body: The message body
+
+        """
+        handler = None
+        send_result = None
+
+        if headers.x_type == 'create':
+            handler = self.handle_create_message
+            send_result = self.send_create_result
 
         #Operation
         if headers.x_type == 'operation':
             LOGGER.info(f'Performing instance operation.')
-            try:
-                self.handle_operation_message(body, headers, properties)
-            except Exception as e:
-                result = e
+            handler = self.handle_operation_message
+            send_result = self.send_operation_result
+
+        if handler is None:
+            self.acknowledge_message(basic_deliver.delivery_tag)
+            return
+
+        try:
+            instance, work = handler(body, headers, properties)
+        except Exception as e:
+            self.on_handled(basic_deliver, properties, None, e)
+            return
 
-        if isinstance(result, Exception):
-            LOGGER.info(f'Exception: {result}')
+        # Messages for one instance run in order, e.g. start after create
+        self.dispatch(work, functools.partial(
+            self.on_future_done, basic_deliver, properties, send_result),
+            key=instance, delivery_tag=basic_deliver.delivery_tag)
+
+    def forward_create(self, basic_deliver, properties, headers, body):
+        """Moves a create onto the create lane, so it does not hold up the
+        operations behind it.
+
+        The forward is mandatory and confirmed, and the original is only
+        acknowledged once RabbitMQ has queued the copy. Should the create
+        lane be missing, the create is run here instead.
+
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+        :param lxrmq.models.MessageHeaders headers: The parsed headers
+        :param bytes body: The message body
+
+        """
+        LOGGER.info(f'Forwarding create to ({LxdApiCreateConsumer.ROUTING_KEY})')
+        props = self.forwarded_properties(properties)
+
+        try:
+            self.publish(self.EXCHANGE, LxdApiCreateConsumer.ROUTING_KEY, props, body,
+                         mandatory=True, on_confirmed=functools.partial(
+                             self.on_create_forwarded, basic_deliver, properties, headers, body))
+        except Exception as e:
+            # Left unacknowledged, it is redelivered with the channel
+            LOGGER.error(f'Unable to forward create: {e}')
+
+    def on_create_forwarded(self, basic_deliver, properties, headers, body, confirmed):
+        """Invoked once RabbitMQ has confirmed, returned or nacked a
+        forwarded create.
+
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+        :param lxrmq.models.MessageHeaders headers: The parsed headers
+        :param bytes body: The message body
+        :param bool confirmed: Whether the create lane has the message
+
+        """
+        if not self.can_reply:
+            LOGGER.info(f'Channel closed, message {basic_deliver.delivery_tag} will be redelivered')
+            return
+
+        if confirmed:
+            self.acknowledge_message(basic_deliver.delivery_tag)
+            return
+
+        LOGGER.warning('Create lane did not take the create, running it here')
+        self.handle_message(basic_deliver, properties, headers, body)
+
+    def message_user(self, properties: pika_spec.BasicProperties):
+        """The user a message was sent by. A forwarded message carries it in
+        a header, trusted only when RabbitMQ has validated that we sent it.
+
+        """
+        if properties.user_id == settings.RMQ_USER_ID:
+            headers = properties.headers or {}
+            return headers.get(self.FORWARDED_USER_HEADER, properties.user_id)
+        return properties.user_id
+
+    def lxdapi_call(self, method, *args):
+        """Returns a callable running LxdApi.method(*args) on the executor."""
+        if isinstance(self._executor, concurrent.futures.ProcessPoolExecutor):
+            return functools.partial(call_lxdapi, method, *args)
+        return functools.partial(getattr(self._lxdapi, method), *args)
+
+    def on_future_done(self, basic_deliver, properties, send_result, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            self.on_handled(basic_deliver, properties, None, e)
+            return
+        self.on_handled(basic_deliver, properties,
+                        functools.partial(send_result, result, properties), None)
+
+    def on_handled(self, basic_deliver, properties, reply, error):
+        """Publishes the outcome of a message and acknowledges it. Runs on
+        the ioloop thread.
+
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+        :param callable reply: Publishes the successful result
+        :param Exception error: The exception the handler raised
+
+        """
+        if not self.can_reply:
+            LOGGER.info(f'Channel closed, message {basic_deliver.delivery_tag} will be redelivered')
+            return
+
+        if isinstance(error, Exception):
+            LOGGER.info(f'Exception: {error}')
             self.send_error(
-                    {'type' : f'{type(result).__name__}', 'message': str(result)},
+                    {'type' : f'{type(error).__name__}', 'message': str(error)},
                     properties.reply_to,
                     properties.correlation_id
                     )
+        elif reply is not None:
+            reply()
 
         self.acknowledge_message(basic_deliver.delivery_tag)
 
     def handle_create_message(self, body: bytes, headers: models.MessageHeaders, properties: pika_spec.BasicProperties):
         message = models.CreateMessage.parse_raw(body)
-        result = self._lxdapi.handle_create_message(message, properties.user_id)
+        return (message.environment.instance.name,
+                self.lxdapi_call('handle_create_message', message, self.message_user(properties),
+                                 properties.correlation_id))
 
+    def send_create_result(self, result, properties: pika_spec.BasicProperties):
         LOGGER.info(f'Create completed: {result}')
         create_message = models.CreateMessage(environment=result)
 
         self.send_response(create_message.json(), properties.reply_to, properties.correlation_id)
         self.send_message(create_message.json(), self.CREATE_ROUTING_KEY, 'instance-creation', self.EXCHANGE)
 
-        return result
-
-
     def handle_operation_message(self, body: bytes, headers: models.MessageHeaders, properties: pika_spec.BasicProperties):
         message = models.OperationMessage.parse_raw(body)
-        result = self._lxdapi.handle_operation_message(message, headers.x_user)
+        # Status reads are ordered too, so one started before an operation
+        # cannot cache its result after the operation has finished
+        return (message.instance,
+                self.lxdapi_call('handle_operation_message', message, headers.x_user))
 
+    def send_operation_result(self, result, properties: pika_spec.BasicProperties):
         LOGGER.info(f'Operation completed: {result}')
-
         self.send_response(result, properties.reply_to, properties.correlation_id)
 
-        return result
+
+def check_forwarding_user():
+    """Raises ValueError unless RMQ_USER_ID is the user we connect as.
+    RabbitMQ rejects a published user_id naming any other user, and
+    forwarded messages are trusted by their user_id.
+    """
+    if settings.RMQ_USER_ID != settings.RMQ_USERNAME:
+        raise ValueError(f'RMQ_USER_ID ({settings.RMQ_USER_ID}) must match '
+                         f'RMQ_USERNAME ({settings.RMQ_USERNAME}) to forward messages')
+
+
+def message_instance(headers, body):
+    """Returns the name of the instance a create or operation is for, or
+    None for other message types.
+
+    :param lxrmq.models.MessageHeaders headers: The parsed headers
+    :param bytes body: The message body
+
+    """
+    if headers.x_type == 'create':
+        return models.CreateMessage.parse_raw(body).environment.instance.name
+    if headers.x_type == 'operation':
+        return models.OperationMessage.parse_raw(body).instance
+    return None
+
+
+class LxdApiCreateConsumer(LxdApiConsumer):
+    """
+    RMQ consumer running creates from their own queue, with its own
+    prefetch and workers, so operations never wait behind them.
+    """
+    QUEUE = 'lx.api-create-queue'
+    ROUTING_KEY = 'lx.api.create'
+
+    def __init__(self, parameters, lxdapi, executor=None):
+        if executor is None:
+            executor = make_api_executor(settings.CREATE_WORKERS)
+
+        super().__init__(parameters, lxdapi, executor=executor, shards=0,
+                         prefetch_count=settings.CREATE_PREFETCH, create_lane=False)
+
+
+class LxdApiShardRouter(LxdApiConsumer):
+    """
+    RMQ consumer for lx.api messages the shard exchange could not hash,
+    because their sender did not set x-instance. The header is filled in
+    from the message body and the message is published to its shard. Its
+    queue has a single active consumer, so messages keep their order.
+    """
+    QUEUE = LxdApiConsumer.UNSHARDED_QUEUE
+    QUEUE_ARGUMENTS = LxdApiConsumer.UNSHARDED_QUEUE_ARGUMENTS
+
+    def __init__(self, parameters, lxdapi=None, executor=None):
+        if executor is None:
+            executor = make_api_executor(1)
+
+        check_forwarding_user()
+
+        super().__init__(parameters, lxdapi, executor=executor, shards=0, create_lane=False)
+        # A message is only acknowledged once its shard has it
+        self._publisher_confirms = True
+
+    def on_exchange_declareok(self, _unused_frame, userdata):
+        """Declares the unsharded exchange after the lx exchange.
+
+        :param pika.Frame.Method unused_frame: Exchange.DeclareOk response frame
+        :param str|unicode userdata: Extra user data (exchange name)
+
+        """
+        if userdata == self.EXCHANGE:
+            LOGGER.info('Declaring exchange: %s', self.UNSHARDED_EXCHANGE)
+            self._channel.exchange_declare(
+                exchange=self.UNSHARDED_EXCHANGE,
+                exchange_type=ExchangeType.fanout,
+                durable=True,
+                callback=functools.partial(
+                    self.on_exchange_declareok, userdata=self.UNSHARDED_EXCHANGE))
+            return
+
+        self.setup_queue(self.QUEUE)
+
+    def queue_binding(self):
+        return (self.UNSHARDED_EXCHANGE, '')
+
+    def on_message(self, _unused_channel: pika_channel.Channel,
+                   basic_deliver: pika_spec.Basic.Deliver,
+                   properties: pika.BasicProperties,
+                   body: bytes):
+        """Invoked by pika when a message is delivered from RabbitMQ.
+        Messages whose instance cannot be found get an error reply.
+
+        :param pika.channel.Channel _unused_channel: The channel object
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+        :param bytes body: The message body
+
+        """
+        try:
+            headers = models.MessageHeaders.parse_obj(properties.headers)
+            instance = message_instance(headers, body)
+        except Exception as e:
+            self.on_handled(basic_deliver, properties, None, e)
+            return
+
+        if instance is None:
+            LOGGER.info(f'No instance to shard ({headers.x_type}) on, dropping')
+            self.acknowledge_message(basic_deliver.delivery_tag)
+            return
+
+        LOGGER.info(f'Routing ({headers.x_type}) for ({instance}) to its shard')
+        props = self.forwarded_properties(properties, {self.SHARD_HASH_HEADER: instance})
+
+        try:
+            self.publish(self.SHARD_EXCHANGE, '', props, body, mandatory=True,
+                         on_confirmed=functools.partial(self.on_routed, basic_deliver))
+        except Exception as e:
+            # Left unacknowledged, it is redelivered with the channel
+            LOGGER.error(f'Unable to route message: {e}')
+
+    def on_routed(self, basic_deliver, confirmed):
+        if not self.can_reply:
+            LOGGER.info(f'Channel closed, message {basic_deliver.delivery_tag} will be redelivered')
+            return
+
+        if confirmed:
+            self.acknowledge_message(basic_deliver.delivery_tag)
+        else:
+            LOGGER.warning('Shard exchange did not take the message, requeueing')
+            self._channel.basic_nack(basic_deliver.delivery_tag, requeue=True)
 
 
 class ReconnectingLxdApiConsumer(BaseReconnectingConsumer):
 
     def __init__(self, parameters, lxdapi):
-        super().__init__(parameters)
         self._lxdapi = lxdapi
-        self._consumer = LxdApiConsumer(self._parameters, self._lxdapi)
-
-    def _maybe_reconnect(self):
-        if self._consumer.should_reconnect:
-            self._consumer.stop()
-            reconnect_delay = self._get_reconnect_delay()
-            LOGGER.info('Reconnecting after %d seconds', reconnect_delay)
-            time.sleep(reconnect_delay)
-            self._consumer = LxdApiConsumer(self._parameters, self._lxdapi)
+        self._executor = make_api_executor()
+        super().__init__(parameters, functools.partial(
+            LxdApiConsumer, lxdapi=self._lxdapi, executor=self._executor))
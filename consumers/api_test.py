@@ -4,6 +4,7 @@ import datetime
 import types
 
 import unittest
+import concurrent.futures
 from unittest import mock
 
 import etcd3.leases as leases
@@ -11,8 +12,9 @@ import etcd3.exceptions as exceptions
 from etcd3.client import KVMetadata
 
 import pika
-from api import LxdApiConsumer
+from api import LxdApiConsumer, LxdApiCreateConsumer, LxdApiShardRouter, ReconnectingLxdApiConsumer
 from lxrmq import models
+from lxrmq.config import settings
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
               '-35s %(lineno) -5d: %(message)s')
@@ -31,7 +33,9 @@ class TestLxdApiConsumer(unittest.TestCase):
         mock_channel = mock.Mock()
         mock_channel.basic_ack = mock.Mock()
 
-        consumer = LxdApiConsumer(parameters, lxdapi)
+        consumer = LxdApiConsumer(parameters, lxdapi, executor=mock.Mock())
+        # Run handlers inline on the test thread
+        consumer._executor = None
         consumer._channel = mock_channel
         consumer.send_error = mock.Mock()
         consumer.send_message = mock.Mock()
@@ -65,7 +69,7 @@ class TestLxdApiConsumer(unittest.TestCase):
 
         args, kwargs = consumer.send_error.call_args
 
-        self.assertEqual(args[0].get('error_type'), 'ValidationError')
+        self.assertEqual(args[0].get('type'), 'ValidationError')
 
     @mock.patch('etcd3.client.Etcd3Client', autospec=True)
     @mock.patch('lxrmq.api.LxdApi', autospec=True)
@@ -174,14 +178,488 @@ class TestLxdApiConsumer(unittest.TestCase):
         })
     
 
-        lxdapi.handle_create_message.return_value = message
+        lxdapi.handle_create_message.return_value = message.environment
 
-        # result = consumer.on_message(None, mock_deliver, properties, body)
-        result = consumer.handle_create_message(create_message, properties)
+        result = consumer.on_message(None, mock_deliver, properties, create_message)
 
         args, kwargs = consumer.send_message.call_args
 
-        self.assertEqual(args[0].environment.id, '000000010')
+        self.assertEqual(json.loads(args[0])['environment']['id'], '000000010')
+        lxdapi.handle_create_message.assert_called_once()
+        consumer._channel.basic_ack.assert_called_once_with(12345)
+
+    @mock.patch('lxrmq.api.LxdApi', autospec=True)
+    @mock.patch('pika.adapters.asyncio_connection.AsyncioConnection', autospec=True)
+    def test_dispatch_replies_on_ioloop(self, mock_aioconn, mock_lxdapi):
+
+        consumer, lxdapi = self.setup_mock_consumer(mock_aioconn, mock_lxdapi)
+        consumer._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        consumer._connection = mock.Mock()
+
+        callbacks = []
+        consumer._connection.ioloop.call_soon_threadsafe.side_effect = \
+            lambda fn, *args: callbacks.append((fn, args))
+
+        on_done = mock.Mock()
+        future = consumer.dispatch(lambda: 'created', on_done)
+        future.result()
+        consumer._executor.shutdown(wait=True)
+
+        # Nothing runs on the worker thread except the handler itself
+        on_done.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+
+        fn, args = callbacks[0]
+        fn(*args)
+
+        on_done.assert_called_once_with(future)
+        self.assertEqual(future.result(), 'created')
+
+    @mock.patch('lxrmq.api.LxdApi', autospec=True)
+    @mock.patch('pika.adapters.asyncio_connection.AsyncioConnection', autospec=True)
+    def test_dispatch_orders_work_per_key(self, mock_aioconn, mock_lxdapi):
+
+        consumer, lxdapi = self.setup_mock_consumer(mock_aioconn, mock_lxdapi)
+        consumer._executor = mock.Mock()
+        consumer._connection = mock.Mock()
+
+        submitted = []
+        def submit(fn):
+            future = concurrent.futures.Future()
+            submitted.append((fn, future))
+            return future
+        consumer._executor.submit.side_effect = submit
+
+        callbacks = []
+        consumer._connection.ioloop.call_soon_threadsafe.side_effect = \
+            lambda fn, *args: callbacks.append((fn, args))
+
+        done = []
+        create = consumer.dispatch(lambda: 'create', done.append, key='i1')
+        start = consumer.dispatch(lambda: 'start', done.append, key='i1')
+        other = consumer.dispatch(lambda: 'other', done.append, key='i2')
+
+        # start waits for create, the other instance does not
+        self.assertIsNone(start)
+        self.assertEqual([fn() for fn, f in submitted], ['create', 'other'])
+
+        fn, future = submitted[0]
+        future.set_result(fn())
+        callback, args = callbacks.pop()
+        callback(*args)
+
+        self.assertEqual(done, [future])
+        self.assertEqual(submitted[2][0](), 'start')
+
+        fn, future = submitted[2]
+        future.set_result(fn())
+        callback, args = callbacks.pop()
+        callback(*args)
+
+        self.assertNotIn('i1', consumer._waiting)
+
+    @mock.patch('lxrmq.api.LxdApi', autospec=True)
+    @mock.patch('pika.adapters.asyncio_connection.AsyncioConnection', autospec=True)
+    def test_publisher_confirms_retry_nacks(self, mock_aioconn, mock_lxdapi):
+
+        consumer, lxdapi = self.setup_mock_consumer(mock_aioconn, mock_lxdapi)
+        consumer._publisher_confirms = True
+        consumer._publish_retries = 1
+
+        properties = pika.BasicProperties()
+        for i in range(4):
+            consumer.publish('lx', f'reply-{i}', properties, b'{}')
+
+        def confirm(method, tag, multiple=False):
+            frame = mock.Mock()
+            frame.method = method(delivery_tag=tag, multiple=multiple)
+            consumer.on_delivery_confirmation(frame)
+
+        # One ack covers the first two publishes
+        confirm(pika.spec.Basic.Ack, 2, multiple=True)
+        self.assertEqual(list(consumer._deliveries), [3, 4])
+
+        # A nack is published again as tag 5
+        confirm(pika.spec.Basic.Nack, 3)
+        self.assertEqual(list(consumer._deliveries), [4, 5])
+        args, kwargs = consumer._channel.basic_publish.call_args
+        self.assertEqual(kwargs['routing_key'], 'reply-2')
+
+        # Until its retries run out, 4 is on its first attempt
+        confirm(pika.spec.Basic.Nack, 5, multiple=True)
+        self.assertEqual(list(consumer._deliveries), [6])
+        self.assertEqual(consumer._channel.basic_publish.call_count, 6)
+
+    @mock.patch('lxrmq.api.LxdApi', autospec=True)
+    @mock.patch('pika.adapters.asyncio_connection.AsyncioConnection', autospec=True)
+    def test_message_properties_reuse_headers(self, mock_aioconn, mock_lxdapi):
+
+        consumer, lxdapi = self.setup_mock_consumer(mock_aioconn, mock_lxdapi)
+
+        first = consumer.message_properties('response', 'c1')
+        second = consumer.message_properties('response', 'c2')
+
+        self.assertIs(first.headers, second.headers)
+        self.assertEqual(first.headers['x_type'], 'response')
+        self.assertEqual(first.headers['x_source'], 'lx.api')
+        self.assertEqual(second.correlation_id, 'c2')
+        self.assertEqual(first.content_type, 'application/json')
+
+        # The cached dict still validates as headers on the receiving end
+        headers = models.MessageHeaders.parse_obj(first.headers)
+        self.assertEqual(headers.x_type, 'response')
+
+        with self.assertRaises(Exception):
+            consumer.message_headers('bogus')
+
+    @mock.patch('lxrmq.api.LxdApi', autospec=True)
+    def test_sharded_topology(self, mock_lxdapi):
+
+        parameters = pika.ConnectionParameters('localhost', '5671', '/')
+        consumer = LxdApiConsumer(parameters, mock_lxdapi.return_value,
+                                  executor=mock.Mock(), shards=3, shard=1)
+        consumer._channel = mock.Mock()
+
+        self.assertEqual(consumer.QUEUE, 'lx.api-queue.1')
+        self.assertTrue(consumer.QUEUE_ARGUMENTS['x-single-active-consumer'])
+        self.assertNotIn('x-single-active-consumer', LxdApiConsumer.QUEUE_ARGUMENTS)
+
+        consumer.on_exchange_declareok(None, 'lx')
+        args, kwargs = consumer._channel.exchange_declare.call_args
+        self.assertEqual(kwargs['exchange_type'], 'x-consistent-hash')
+        self.assertEqual(kwargs['arguments'], {'hash-header': 'x-instance',
+                                               'alternate-exchange': 'lx.api-unsharded'})
+        consumer._channel.queue_bind.assert_called_once_with(
+            'lx.api-unsharded-queue', 'lx.api-unsharded')
+
+        consumer.on_exchange_declareok(None, 'lx.api-shards')
+        consumer._channel.exchange_bind.assert_called_once_with(
+            destination='lx.api-shards', source='lx', routing_key='lx.api',
+            callback=consumer.on_shard_exchange_bindok)
+
+        consumer.on_shard_exchange_bindok(None)
+        declared = [c.kwargs['queue'] for c in consumer._channel.queue_declare.call_args_list]
+        self.assertEqual(declared, ['lx.api-unsharded-queue', 'lx.api-queue.0',
+                                    'lx.api-queue.2', 'lx.api-queue.1'])
+
+        consumer.on_queue_declareok(None, 'lx.api-queue.1')
+        args, kwargs = consumer._channel.queue_bind.call_args
+        self.assertEqual(args, ('lx.api-queue.1', 'lx.api-shards'))
+        self.assertEqual(kwargs['routing_key'], '1')
+
+        with self.assertRaises(ValueError):
+            LxdApiConsumer(parameters, mock_lxdapi.return_value,
+                           executor=mock.Mock(), shards=3, shard=3)
+
+        # Creates stay on their shard, in order with the instance's operations
+        consumer = LxdApiConsumer(parameters, mock_lxdapi.return_value,
+                                  executor=mock.Mock(), shards=3, shard=1, create_lane=True)
+        self.assertFalse(consumer._create_lane)
+
+    @mock.patch('lxrmq.api.LxdApi', autospec=True)
+    def test_shard_router_sets_instance_header(self, mock_lxdapi):
+
+        parameters = pika.ConnectionParameters('localhost', '5671', '/')
+
+        # RabbitMQ would reject the forwarded user_id
+        with mock.patch.object(settings, 'RMQ_USER_ID', 'lxconsumer'), \
+                mock.patch.object(settings, 'RMQ_USERNAME', 'lxapi'):
+            with self.assertRaises(ValueError):
+                LxdApiShardRouter(parameters, executor=mock.Mock())
+
+        with mock.patch.object(settings, 'RMQ_USERNAME', settings.RMQ_USER_ID):
+            router = LxdApiShardRouter(parameters, executor=mock.Mock())
+        router._channel = mock.Mock()
+
+        self.assertEqual(router.QUEUE, 'lx.api-unsharded-queue')
+        self.assertEqual(router.queue_binding(), ('lx.api-unsharded', ''))
+
+        mock_deliver = mock.Mock()
+        mock_deliver.delivery_tag = 12345
+
+        # Sent without x-instance by a publisher that predates sharding
+        properties = pika.BasicProperties(
+            user_id='frontend',
+            content_type='application/json',
+            headers={
+                'x-type': 'operation',
+                'x-application': 're-enroll',
+                'x-user': 'user0',
+                'x-source': 'host'
+            }
+        )
+        body = json.dumps({'username': 'user0', 'instance': 'cs135-f23-user0', 'operation': 'start'})
+
+        router.on_message(None, mock_deliver, properties, body)
+
+        args, kwargs = router._channel.basic_publish.call_args
+        self.assertEqual(kwargs['exchange'], 'lx.api-shards')
+        self.assertTrue(kwargs['mandatory'])
+        self.assertEqual(kwargs['properties'].headers['x-instance'], 'cs135-f23-user0')
+        self.assertEqual(kwargs['properties'].headers['x-forwarded-user'], 'frontend')
+
+        router._channel.basic_ack.assert_not_called()
+        frame = mock.Mock()
+        frame.method = pika.spec.Basic.Ack(delivery_tag=1)
+        router.on_delivery_confirmation(frame)
+        router._channel.basic_ack.assert_called_once_with(12345)
+
+    @mock.patch('lxrmq.api.LxdApi', autospec=True)
+    @mock.patch('pika.adapters.asyncio_connection.AsyncioConnection', autospec=True)
+    def test_shard_rejects_mismatched_instance(self, mock_aioconn, mock_lxdapi):
+
+        consumer, lxdapi = self.setup_mock_consumer(mock_aioconn, mock_lxdapi)
+        consumer._shards = 3
+
+        mock_deliver = mock.Mock()
+        mock_deliver.delivery_tag = 12345
+
+        properties = pika.BasicProperties(
+            user_id='frontend',
+            content_type='application/json',
+            headers={
+                'x-type': 'operation',
+                'x-application': 're-enroll',
+                'x-user': 'user0',
+                'x-source': 'host',
+                'x-instance': 'cs135-f23-user1'
+            }
+        )
+        body = json.dumps({'username': 'user0', 'instance': 'cs135-f23-user0', 'operation': 'start'})
+
+        consumer.on_message(None, mock_deliver, properties, body)
+
+        lxdapi.handle_operation_message.assert_not_called()
+        consumer.send_error.assert_called_once()
+        self.assertEqual(consumer.send_error.call_args[0][0]['type'], 'ValueError')
+        consumer._channel.basic_ack.assert_called_once_with(12345)
+
+    @mock.patch('lxrmq.api.LxdApi', autospec=True)
+    @mock.patch('pika.adapters.asyncio_connection.AsyncioConnection', autospec=True)
+    def test_status_is_ordered_per_instance(self, mock_aioconn, mock_lxdapi):
+
+        consumer, lxdapi = self.setup_mock_consumer(mock_aioconn, mock_lxdapi)
+        consumer.lxdapi_call = mock.Mock()
+        headers = models.MessageHeaders.parse_obj({
+            'x-type': 'operation', 'x-application': 're-enroll',
+            'x-user': 'user0', 'x-source': 'host'})
+
+        for operation in ('status', 'stop'):
+            body = json.dumps({'username': 'user0', 'instance': 'cs135-f23-user0',
+                               'operation': operation})
+            key, _ = consumer.handle_operation_message(body, headers, None)
+
+            # A status read queues behind the stop it was sent after
+            self.assertEqual(key, 'cs135-f23-user0')
+
+    @mock.patch('lxrmq.api.LxdApi', autospec=True)
+    @mock.patch('pika.adapters.asyncio_connection.AsyncioConnection', autospec=True)
+    def test_create_lane_forwards_creates(self, mock_aioconn, mock_lxdapi):
+
+        consumer, lxdapi = self.setup_mock_consumer(mock_aioconn, mock_lxdapi)
+        consumer._create_lane = True
+        consumer._publisher_confirms = True
+
+        mock_deliver = mock.Mock()
+        mock_deliver.delivery_tag = 12345
+
+        properties = pika.BasicProperties(
+            user_id='frontend',
+            content_type='application/json',
+            reply_to='amq.rabbitmq.reply-to.abc',
+            correlation_id='correlation_id',
+            headers={
+                'x-type': 'create',
+                'x-application': 're-enroll',
+                'x-user': 'user0',
+                'x-source': 'host'
+            }
+        )
+
+        consumer.on_message(None, mock_deliver, properties, b'{}')
+
+        lxdapi.handle_create_message.assert_not_called()
+        args, kwargs = consumer._channel.basic_publish.call_args
+        self.assertEqual(kwargs['routing_key'], 'lx.api.create')
+        self.assertTrue(kwargs['mandatory'])
+        forwarded = kwargs['properties']
+
+        # Acknowledged only once the forward is confirmed
+        consumer._channel.basic_ack.assert_not_called()
+        frame = mock.Mock()
+        frame.method = pika.spec.Basic.Ack(delivery_tag=1)
+        consumer.on_delivery_confirmation(frame)
+        consumer._channel.basic_ack.assert_called_once_with(12345)
+        self.assertEqual(forwarded.reply_to, 'amq.rabbitmq.reply-to.abc')
+        self.assertEqual(forwarded.correlation_id, 'correlation_id')
+
+        # The create lane acts for the original sender
+        create_consumer = LxdApiCreateConsumer(
+            pika.ConnectionParameters('localhost', '5671', '/'), lxdapi, executor=mock.Mock())
+        self.assertEqual(create_consumer.QUEUE, 'lx.api-create-queue')
+        self.assertEqual(create_consumer.message_user(forwarded), 'frontend')
+
+        # But only if the header came from us
+        properties.headers['x-forwarded-user'] = 'lxadmin'
+        self.assertEqual(create_consumer.message_user(properties), 'frontend')
+
+    @mock.patch('lxrmq.api.LxdApi', autospec=True)
+    @mock.patch('pika.adapters.asyncio_connection.AsyncioConnection', autospec=True)
+    def test_unroutable_forward_runs_create_here(self, mock_aioconn, mock_lxdapi):
+
+        consumer, lxdapi = self.setup_mock_consumer(mock_aioconn, mock_lxdapi)
+        consumer._create_lane = True
+        consumer._publisher_confirms = True
+        consumer.handle_message = mock.Mock()
+
+        mock_deliver = mock.Mock()
+        mock_deliver.delivery_tag = 12345
+
+        properties = pika.BasicProperties(
+            user_id='frontend',
+            content_type='application/json',
+            headers={
+                'x-type': 'create',
+                'x-application': 're-enroll',
+                'x-user': 'user0',
+                'x-source': 'host'
+            }
+        )
+
+        consumer.on_message(None, mock_deliver, properties, b'{}')
+
+        # No create queue is bound yet, so RabbitMQ returns then acks it
+        args, kwargs = consumer._channel.basic_publish.call_args
+        method = pika.spec.Basic.Return(reply_code=312, reply_text='NO_ROUTE',
+                                        exchange='lx', routing_key='lx.api.create')
+        consumer.on_message_returned(None, method, kwargs['properties'], b'{}')
+
+        frame = mock.Mock()
+        frame.method = pika.spec.Basic.Ack(delivery_tag=1)
+        consumer.on_delivery_confirmation(frame)
+
+        consumer._channel.basic_ack.assert_not_called()
+        consumer.handle_message.assert_called_once()
+        self.assertEqual(consumer.handle_message.call_args[0][0], mock_deliver)
+
+    @mock.patch('api.make_api_executor')
+    @mock.patch('lxrmq.api.LxdApi', autospec=True)
+    @mock.patch('time.sleep')
+    def test_reconnect_reuses_lxdapi_and_skips_topology(self, mock_sleep, mock_lxdapi, mock_executor):
+
+        parameters = pika.ConnectionParameters('localhost', '5671', '/')
+        lxdapi = mock_lxdapi.return_value
+        reconnecting = ReconnectingLxdApiConsumer(parameters, lxdapi)
+
+        first = reconnecting._consumer
+        first.stop = mock.Mock()
+        first.should_reconnect = True
+        first.was_consuming = True
+
+        reconnecting._maybe_reconnect()
+
+        second = reconnecting._consumer
+        self.assertIsNot(second, first)
+        self.assertIs(second._lxdapi, lxdapi)
+        self.assertIs(second._executor, first._executor)
+        self.assertFalse(second.declare_topology)
+        self.assertLessEqual(mock_sleep.call_args.args[0], 0.5)
+
+        # The exchange and binding are declared again, only the queue is skipped
+        second._channel = mock.Mock()
+        second.setup_topology()
+        args, kwargs = second._channel.exchange_declare.call_args
+        self.assertEqual(kwargs['exchange'], 'lx')
+        self.assertTrue(kwargs['durable'])
+
+        second.on_exchange_declareok(None, 'lx')
+        second._channel.queue_declare.assert_not_called()
+        args, kwargs = second._channel.queue_bind.call_args
+        self.assertEqual(args, ('lx.api-queue', 'lx'))
+
+        second.on_bindok(None, 'lx.api-queue')
+        second._channel.basic_qos.assert_called_once()
+
+        # A missing queue is declared again on the next connection
+        second.close_connection = mock.Mock()
+        second.on_channel_closed(1, pika.exceptions.ChannelClosedByBroker(404, 'NOT_FOUND'))
+        self.assertTrue(second.topology_missing)
+
+        second.stop = mock.Mock()
+        second.should_reconnect = True
+        reconnecting._maybe_reconnect()
+
+        self.assertEqual(mock_sleep.call_args.args[0], 0)
+        self.assertTrue(reconnecting._consumer.declare_topology)
+
+    @mock.patch('lxrmq.api.LxdApi', autospec=True)
+    def test_reconnect_delay_backs_off(self, mock_lxdapi):
+
+        parameters = pika.ConnectionParameters('localhost', '5671', '/')
+        reconnecting = ReconnectingLxdApiConsumer(parameters, mock_lxdapi.return_value)
+
+        with mock.patch('random.uniform', side_effect=lambda low, high: high):
+            delays = [reconnecting._get_reconnect_delay() for i in range(10)]
+
+        self.assertEqual(delays[:4], [0.5, 1, 2, 4])
+        self.assertEqual(delays[-1], 30)
+
+    @mock.patch('lxrmq.api.LxdApi', autospec=True)
+    @mock.patch('pika.adapters.asyncio_connection.AsyncioConnection', autospec=True)
+    def test_drain_acks_in_flight_before_closing(self, mock_aioconn, mock_lxdapi):
+
+        consumer, lxdapi = self.setup_mock_consumer(mock_aioconn, mock_lxdapi)
+        consumer._executor = mock.Mock()
+        consumer._connection = mock.Mock()
+
+        futures = []
+        def submit(fn):
+            futures.append(concurrent.futures.Future())
+            return futures[-1]
+        consumer._executor.submit.side_effect = submit
+
+        callbacks = []
+        consumer._connection.ioloop.call_soon_threadsafe.side_effect = \
+            lambda fn, *args: callbacks.append((fn, args))
+
+        ack = lambda tag: lambda f: consumer.acknowledge_message(tag)
+        consumer.dispatch(lambda: None, ack(1), key='i1', delivery_tag=1)
+        consumer.dispatch(lambda: None, ack(2), key='i1', delivery_tag=2)
+        consumer.dispatch(lambda: None, ack(3), key='i2', delivery_tag=3)
+
+        consumer.on_cancelok(None, 'ctag')
+
+        # Waiting work goes back to the queue, running work is awaited
+        consumer._channel.basic_nack.assert_called_once_with(2, requeue=True)
+        consumer._connection.ioloop.call_later.assert_called_once()
+        consumer._channel.close.assert_not_called()
+
+        for future in futures:
+            future.set_result(None)
+        for fn, args in callbacks:
+            fn(*args)
+
+        self.assertEqual([c.args[0] for c in consumer._channel.basic_ack.call_args_list], [1, 3])
+        self.assertEqual(len(futures), 2)
+        consumer._channel.close.assert_called_once()
+        consumer._connection.ioloop.call_later.return_value.cancel.assert_called_once()
+
+    @mock.patch('lxrmq.api.LxdApi', autospec=True)
+    @mock.patch('pika.adapters.asyncio_connection.AsyncioConnection', autospec=True)
+    def test_drain_timeout_closes_channel(self, mock_aioconn, mock_lxdapi):
+
+        consumer, lxdapi = self.setup_mock_consumer(mock_aioconn, mock_lxdapi)
+        consumer._executor = mock.Mock()
+        consumer._connection = mock.Mock()
+
+        consumer.dispatch(lambda: None, mock.Mock(), key='i1', delivery_tag=1)
+        consumer.on_cancelok(None, 'ctag')
+
+        timeout, on_timeout = consumer._connection.ioloop.call_later.call_args.args
+        on_timeout()
+
+        consumer._channel.close.assert_called_once()
+        consumer._channel.basic_ack.assert_not_called()
 
 if __name__ == '__main__':
     runner = unittest.TextTestRunner(warnings=None)
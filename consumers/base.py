@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
 # pylint: disable=C0111,C0103,R0205
 import functools
-import datetime
 import logging
+import collections
+import concurrent.futures
 import time
 import json
+import random
+import signal
+import threading
 import uuid
 
 import pika
 
 from .. import models
+from ..config import settings
 
 from pika.adapters.asyncio_connection import AsyncioConnection
 from pika.exchange_type import ExchangeType
@@ -20,6 +25,26 @@ LOGGER = logging.getLogger(__name__)
 
 JSON_CONTENT_TYPE = 'application/json'
 
+
+def make_executor(kind, workers, initializer=None, initargs=()):
+    """Builds the pool message handlers are dispatched to: 'thread',
+    'process' or 'inline' (None, handlers run on the ioloop).
+
+    :param str kind: The kind of pool
+    :param int workers: Maximum number of concurrent handlers
+    :param callable initializer: Run once in each process pool worker
+    :param tuple initargs: Arguments for initializer
+
+    """
+    if kind == 'thread':
+        return concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='lxrmq-worker')
+    if kind == 'process':
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=initializer, initargs=initargs)
+    return None
+
+
 class BaseConsumer(object):
     """
     RMQ consumer for manipulating LXD containers.
@@ -29,16 +54,30 @@ class BaseConsumer(object):
     QUEUE = 'lx.api'
     ROUTING_KEY = 'lx.cluster'
     CREATE_ROUTING_KEY = 'lx'
+    QUEUE_ARGUMENTS = {"x-queue-type": "quorum"}
 
-    def __init__(self, parameters):
+    def __init__(self, parameters, executor=None, prefetch_count=1,
+                 publisher_confirms=False, publish_retries=3, drain_timeout=30.0):
         """Create a new instance of the consumer class, passing in the AMQP
         URL used to connect to RabbitMQ.
 
         :param str amqp_url: The AMQP url to connect with
+        :param concurrent.futures.Executor executor: Pool that blocking
+            handlers are dispatched to, None runs them on the ioloop
+        :param int prefetch_count: Maximum number of unacknowledged
+            messages, and so of messages in progress at once
+        :param bool publisher_confirms: Put the channel in confirm mode and
+            track every publish until the broker confirms it
+        :param int publish_retries: Times a nacked publish is sent again
+        :param float drain_timeout: Seconds to wait on stop for running
+            handlers to finish so their messages can be acknowledged
 
         """
         self.should_reconnect = False
         self.was_consuming = False
+        # Cleared when the broker is known to have our queue already
+        self.declare_topology = True
+        self.topology_missing = False
 
         self._connection = None
         self._channel = None
@@ -46,7 +85,26 @@ class BaseConsumer(object):
         self._consumer_tag = None
         self._parameters = parameters
         self._consuming = False
-        self._prefetch_count = 1
+        self._prefetch_count = prefetch_count
+        self._executor = executor
+        # Work waiting behind an earlier message with the same key
+        self._waiting = {}
+        self._in_flight = 0
+        self._draining = False
+        self._drain_timeout = drain_timeout
+        self._drain_timer = None
+
+        self._publisher_confirms = publisher_confirms
+        self._publish_retries = publish_retries
+        self._message_number = 0
+        # Unconfirmed publishes by delivery tag, in publish order
+        self._deliveries = collections.OrderedDict()
+        # Message ids of mandatory publishes RabbitMQ could not route
+        self._returned = set()
+        # Outbound headers by x-type, see message_headers
+        self._headers = {}
+        # Set when attached to a connection owned by someone else
+        self._on_closed = None
 
     def connect(self):
         """This method connects to RabbitMQ, returning the connection handle.
@@ -64,6 +122,33 @@ class BaseConsumer(object):
             on_open_error_callback=self.on_connection_open_error,
             on_close_callback=self.on_connection_closed,)
 
+    def attach(self, connection, on_closed):
+        """Run this consumer on its own channel of a connection that is
+        opened, closed and reconnected by the caller, such as a
+        ConsumerHost. The consumer declares its own topology and QoS on
+        that channel.
+
+        :param pika.adapters.asyncio_connection.AsyncioConnection connection:
+           The open connection
+        :param callable on_closed: Invoked with this consumer once its
+           channel has closed
+
+        """
+        self._connection = connection
+        self._on_closed = on_closed
+        self.open_channel()
+
+    def detach(self):
+        """Stop an attached consumer, closing its channel but not the
+        shared connection. on_closed is invoked once the channel is closed.
+
+        """
+        self._closing = True
+        if self._consuming:
+            self.stop_consuming()
+        elif self.can_reply:
+            self.close_channel()
+
     def close_connection(self):
         self._consuming = False
         if self._connection.is_closing or self._connection.is_closed:
@@ -143,8 +228,116 @@ class BaseConsumer(object):
         LOGGER.info('Channel opened')
         self._channel = channel
         self.add_on_channel_close_callback()
+
+        if self._publisher_confirms:
+            self._channel.add_on_return_callback(self.on_message_returned)
+            self.enable_delivery_confirmations()
+        else:
+            self.setup_topology()
+
+    def setup_topology(self):
+        """Declare the exchange, queue and binding. Exchanges and bindings
+        are declared on every connect, as a broker restart can drop them
+        while the durable queue survives. Only the queue declaration is
+        skipped when it was declared before this reconnect; should the queue
+        have gone meanwhile, binding it fails and the next reconnect
+        declares it again.
+
+        """
         self.setup_exchange(self.EXCHANGE)
 
+    def enable_delivery_confirmations(self):
+        """Send the Confirm.Select RPC method to RabbitMQ to enable delivery
+        confirmations on the channel. Once RabbitMQ confirms, the exchange
+        is declared. Every publish is then acked or nacked asynchronously
+        through on_delivery_confirmation.
+
+        """
+        LOGGER.info('Issuing Confirm.Select RPC command')
+        self._channel.confirm_delivery(
+            ack_nack_callback=self.on_delivery_confirmation,
+            callback=self.on_confirm_selectok)
+
+    def on_confirm_selectok(self, _unused_frame):
+        """Invoked by pika when RabbitMQ has put the channel in confirm mode.
+
+        :param pika.frame.Method _unused_frame: The Confirm.SelectOk frame
+
+        """
+        LOGGER.info('Delivery confirmations enabled')
+        self.setup_topology()
+
+    def on_delivery_confirmation(self, method_frame):
+        """Invoked by pika when RabbitMQ responds to a Basic.Publish RPC
+        command, passing in either a Basic.Ack or Basic.Nack frame with
+        the delivery tag of the message that was published. With the
+        multiple flag set, the frame covers every delivery up to and
+        including that tag. Nacked messages are published again until
+        publish_retries is exhausted.
+
+        :param pika.frame.Method method_frame: Basic.Ack or Basic.Nack frame
+
+        """
+        confirmation_type = method_frame.method.NAME.split('.')[1].lower()
+        delivery_tag = method_frame.method.delivery_tag
+
+        if method_frame.method.multiple:
+            tags = []
+            for tag in self._deliveries:
+                if tag > delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [delivery_tag]
+
+        for tag in tags:
+            delivery = self._deliveries.pop(tag, None)
+
+            if delivery is None:
+                continue
+
+            exchange, routing_key, properties, body, attempt, mandatory, on_confirmed = delivery
+
+            if confirmation_type == 'ack':
+                # RabbitMQ acks an unroutable message after returning it
+                returned = properties.message_id in self._returned
+                self._returned.discard(properties.message_id)
+                if returned:
+                    LOGGER.error(f'Publish to ({routing_key}) was returned unroutable')
+                if on_confirmed is not None:
+                    on_confirmed(not returned)
+                continue
+
+            if attempt >= self._publish_retries:
+                LOGGER.error(f'Publish to ({routing_key}) nacked {attempt + 1} times, dropping')
+                if on_confirmed is not None:
+                    on_confirmed(False)
+                continue
+
+            LOGGER.warning(f'Publish to ({routing_key}) nacked, retrying')
+            try:
+                self.publish(exchange, routing_key, properties, body, attempt + 1,
+                             mandatory=mandatory, on_confirmed=on_confirmed)
+            except Exception as e:
+                LOGGER.error(f'Unable to republish to ({routing_key}): {e}')
+                if on_confirmed is not None:
+                    on_confirmed(False)
+
+    def on_message_returned(self, _unused_channel, method, properties, _unused_body):
+        """Invoked by pika when RabbitMQ returns a mandatory publish it could
+        not route. The Basic.Ack for it follows, which then reports the
+        publish as failed.
+
+        :param pika.channel.Channel _unused_channel: The channel object
+        :param pika.Spec.Basic.Return method: The Basic.Return method
+        :param pika.Spec.BasicProperties properties: The returned properties
+        :param bytes _unused_body: The returned body
+
+        """
+        LOGGER.warning(f'Publish to ({method.routing_key}) returned: {method.reply_text}')
+        if properties.message_id is not None:
+            self._returned.add(properties.message_id)
+
     def add_on_channel_close_callback(self):
         """This method tells pika to call the on_channel_closed method if
         RabbitMQ unexpectedly closes the channel.
@@ -158,14 +351,29 @@ class BaseConsumer(object):
         Channels are usually closed if you attempt to do something that
         violates the protocol, such as re-declare an exchange or queue with
         different parameters. In this case, we'll close the connection
-        to shutdown the object.
+        to shutdown the object. A consumer attached to a shared connection
+        leaves that to the connection's owner.
 
         :param pika.channel.Channel: The closed channel
         :param Exception reason: why the channel was closed
 
         """
         LOGGER.warning('Channel %i was closed: %s', channel, reason)
-        self.close_connection()
+
+        if not self.declare_topology and getattr(reason, 'reply_code', None) == 404:
+            LOGGER.warning('Queue not found, topology will be declared again')
+            self.topology_missing = True
+
+        if self._deliveries:
+            LOGGER.error(f'Channel closed with ({len(self._deliveries)}) unconfirmed publishes')
+            self._deliveries.clear()
+        self._returned.clear()
+
+        if self._on_closed is not None:
+            self._consuming = False
+            self._on_closed(self)
+        else:
+            self.close_connection()
 
     def setup_exchange(self, exchange_name):
         """Setup the exchange on RabbitMQ by invoking the Exchange.Declare RPC
@@ -183,6 +391,7 @@ class BaseConsumer(object):
         self._channel.exchange_declare(
             exchange=exchange_name,
             exchange_type=self.EXCHANGE_TYPE,
+            durable=True,
             callback=cb)
 
     def on_exchange_declareok(self, _unused_frame, userdata):
@@ -204,12 +413,17 @@ class BaseConsumer(object):
         :param str|unicode queue_name: The name of the queue to declare.
 
         """
+        if not self.declare_topology:
+            LOGGER.info('Queue %s already declared, binding', queue_name)
+            self.on_queue_declareok(None, queue_name)
+            return
+
         LOGGER.info('Declaring queue %s', queue_name)
         cb = functools.partial(self.on_queue_declareok, userdata=queue_name)
         self._channel.queue_declare(
             queue=queue_name,
             durable=True,
-            arguments={"x-queue-type": "quorum"}, 
+            arguments=self.QUEUE_ARGUMENTS,
             callback=cb)
 
     def on_queue_declareok(self, _unused_frame, userdata):
@@ -224,15 +438,24 @@ class BaseConsumer(object):
 
         """
         queue_name = userdata
-        LOGGER.info('Binding %s to %s with %s', self.EXCHANGE, queue_name,
-                    self.ROUTING_KEY)
+        exchange, routing_key = self.queue_binding()
+        LOGGER.info('Binding %s to %s with %s', exchange, queue_name,
+                    routing_key)
         cb = functools.partial(self.on_bindok, userdata=queue_name)
         self._channel.queue_bind(
             queue_name,
-            self.EXCHANGE,
-            routing_key=self.ROUTING_KEY,
+            exchange,
+            routing_key=routing_key,
             callback=cb)
 
+    def queue_binding(self):
+        """Returns the exchange and routing key the queue is bound with.
+
+        :rtype: tuple(str, str)
+
+        """
+        return (self.EXCHANGE, self.ROUTING_KEY)
+
     def on_bindok(self, _unused_frame, userdata):
         """Invoked by pika when the Queue.Bind method has completed. At this
         point we will set the prefetch count for the channel.
@@ -245,10 +468,9 @@ class BaseConsumer(object):
         self.set_qos()
 
     def set_qos(self):
-        """This method sets up the consumer prefetch to only be delivered
-        one message at a time. The consumer must acknowledge this message
-        before RabbitMQ will deliver another one. You should experiment
-        with different prefetch values to achieve desired performance.
+        """This method sets up the consumer prefetch, the number of
+        messages RabbitMQ will deliver before waiting for an
+        acknowledgement. It bounds how many messages are processed at once.
 
         """
         self._channel.basic_qos(
@@ -322,39 +544,176 @@ class BaseConsumer(object):
 
         self.acknowledge_message(basic_deliver.delivery_tag)
 
-    def send_error(self, error, reply_to, correlation_id, exchange=''):
-        LOGGER.info(f'Sending error response to: ({reply_to})')
-        timestamp = int(datetime.datetime.now().strftime('%s'))
+    def dispatch(self, fn, on_done, key=None, delivery_tag=None):
+        """Run fn on the executor so blocking work does not stall the
+        ioloop (and with it heartbeats and other deliveries). When fn
+        finishes, on_done is invoked with its concurrent.futures.Future back
+        on the ioloop thread, where it is safe to publish and acknowledge.
 
-        headers = models.MessageHeaders.parse_obj({
-                'x-type': 'error',
-                'x-user': '',
-                'x-source': self.ROUTING_KEY,
-                'x-application': ''
-        })
+        Work sharing a key runs one at a time in the order it was
+        dispatched; work with different keys runs concurrently.
 
-        LOGGER.info(f'Error headers: ({dict(headers)})')
+        :param callable fn: The blocking work, called without arguments
+        :param callable on_done: Callback receiving the finished future
+        :param str key: Orders fn after earlier work with the same key
+        :param int delivery_tag: The delivery fn handles, requeued if it is
+            still waiting when the consumer drains
+        :rtype: concurrent.futures.Future or None if fn is waiting
 
-        props = pika.BasicProperties(
-            content_type='application/json',
+        """
+        if key is not None:
+            if key in self._waiting:
+                LOGGER.info(f'Queued behind in-progress work for ({key})')
+                self._waiting[key].append((fn, on_done, delivery_tag))
+                return None
+
+            self._waiting[key] = collections.deque()
+            on_done = functools.partial(self.on_keyed_done, key, on_done)
+
+        return self.submit(fn, on_done)
+
+    def on_keyed_done(self, key, on_done, future):
+        """Invoked on the ioloop thread when work for key has finished,
+        dispatching the next work waiting for that key.
+
+        """
+        try:
+            on_done(future)
+        finally:
+            waiting = self._waiting.get(key, None)
+
+            if waiting and self.can_reply:
+                fn, next_done, _ = waiting.popleft()
+                self.submit(fn, functools.partial(self.on_keyed_done, key, next_done))
+            else:
+                if waiting:
+                    LOGGER.info(f'Channel closed, dropping ({len(waiting)}) waiting for ({key})')
+                self._waiting.pop(key, None)
+
+    def submit(self, fn, on_done):
+        self._in_flight += 1
+        on_done = functools.partial(self.on_work_done, on_done)
+
+        if self._executor is None:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+            on_done(future)
+            return future
+
+        ioloop = self._connection.ioloop
+        future = self._executor.submit(fn)
+        future.add_done_callback(
+            lambda f: ioloop.call_soon_threadsafe(on_done, f))
+        return future
+
+    def on_work_done(self, on_done, future):
+        try:
+            on_done(future)
+        finally:
+            self._in_flight -= 1
+            if self._draining and self._in_flight == 0:
+                self.finish_drain()
+
+    def drain(self):
+        """Invoked once no new messages are delivered. Work still waiting
+        on an earlier message is requeued for someone else, while running
+        handlers get drain_timeout seconds to finish, reply and acknowledge
+        before the channel is closed. Messages unacknowledged by then are
+        redelivered by RabbitMQ.
+
+        """
+        self._draining = True
+
+        for key, waiting in self._waiting.items():
+            for fn, on_done, delivery_tag in waiting:
+                if delivery_tag is not None and self.can_reply:
+                    self._channel.basic_nack(delivery_tag, requeue=True)
+            waiting.clear()
+
+        if self._in_flight == 0:
+            self.finish_drain()
+            return
+
+        LOGGER.info(f'Draining ({self._in_flight}) in-flight messages for up to {self._drain_timeout} seconds')
+        self._drain_timer = self._connection.ioloop.call_later(
+            self._drain_timeout, self.on_drain_timeout)
+
+    def on_drain_timeout(self):
+        LOGGER.warning(f'Drain timed out, ({self._in_flight}) messages will be redelivered')
+        self._drain_timer = None
+        self.finish_drain()
+
+    def finish_drain(self):
+        self._draining = False
+
+        if self._drain_timer is not None:
+            self._drain_timer.cancel()
+            self._drain_timer = None
+
+        if self.can_reply:
+            self.close_channel()
+
+    @property
+    def can_reply(self):
+        """False once the channel a delivery arrived on has gone away, in
+        which case its delivery tag can no longer be acknowledged.
+
+        """
+        return self._channel is not None and self._channel.is_open
+
+    def message_headers(self, x_type):
+        """Returns the headers for outbound messages of x_type. They only
+        depend on the consumer and the type, so they are validated once
+        and the dict is reused for every later message.
+
+        :param str x_type: The x-type header value
+        :rtype: dict
+
+        """
+        headers = self._headers.get(x_type, None)
+
+        if headers is None:
+            headers = models.MessageHeaders.parse_obj({
+                    'x-type': x_type,
+                    'x-user': '',
+                    'x-source': self.ROUTING_KEY,
+                    'x-application': ''
+            }).dict(exclude_none=True)
+            self._headers[x_type] = headers
+
+        return headers
+
+    def message_properties(self, x_type, correlation_id):
+        """Builds the properties of an outbound message from the cached
+        headers, filling in only the correlation id and timestamp.
+
+        :param str x_type: The x-type header value
+        :param str correlation_id: The correlation id
+        :rtype: pika.BasicProperties
+
+        """
+        return pika.BasicProperties(
+            content_type=JSON_CONTENT_TYPE,
             correlation_id=correlation_id,
-            headers=dict(headers),
+            headers=self.message_headers(x_type),
             reply_to=self.QUEUE,
-            timestamp=timestamp
+            timestamp=int(time.time())
         )
 
+    def send_error(self, error, reply_to, correlation_id, exchange=''):
+        LOGGER.info(f'Sending error response to: ({reply_to})')
+        props = self.message_properties('error', correlation_id)
+
         try:
         
             body = json.dumps({'error': error})
-            self._channel.basic_publish(
-                exchange=exchange,
-                routing_key=reply_to,
-                properties=props,
-                body=body
-                )
+            self.publish(exchange, reply_to, props, body)
         
         except Exception as e:
-            LOGGER.info(f'Unable to send error response: {e}')
+            LOGGER.error(f'Unable to send error response: {e}')
 
     def send_response(self, message, reply_to, corr_id, exchange=''):
         LOGGER.info(f'Sending response to: ({reply_to})')
@@ -363,63 +722,53 @@ class BaseConsumer(object):
             LOGGER.info(f'No reply_to for message.')
             return
 
-        timestamp = int(datetime.datetime.now().strftime('%s'))
-
-        headers = models.MessageHeaders.parse_obj({
-                'x-type': 'response',
-                'x-user': '',
-                'x-source': self.ROUTING_KEY,
-                'x-application': ''
-        })
-
-        LOGGER.info(f'Response headers: ({dict(headers)})')
-        props = pika.BasicProperties(
-            content_type='application/json',
-            correlation_id=corr_id,
-            headers=dict(headers),
-            reply_to=self.QUEUE,
-            timestamp=timestamp
-        )
+        props = self.message_properties('response', corr_id)
 
         try:
         
             body = json.dumps(message)
-            self._channel.basic_publish(
-                exchange=exchange,
-                routing_key=reply_to,
-                properties=props,
-                body=body
-                )
+            self.publish(exchange, reply_to, props, body)
         
         except Exception as e:
-            LOGGER.info(f'Unable to send response: {e}')
+            LOGGER.error(f'Unable to send response: {e}')
 
     def send_message(self, message, routing_key, x_type, exchange):
         LOGGER.info(f'Sending ({x_type}) message to ({routing_key}) via ({exchange})')
-        timestamp = int(datetime.datetime.now().strftime('%s'))
-        headers = models.MessageHeaders.parse_obj({
-                'x-type': x_type,
-                'x-user': '',
-                'x-source': self.ROUTING_KEY,
-                'x-application': ''
-        })
-
-
-        props = pika.BasicProperties(
-            content_type='application/json',
-            correlation_id=str(uuid.uuid4()),
-            headers=dict(headers),
-            reply_to=self.QUEUE,
-            timestamp=timestamp
-        )
+        props = self.message_properties(x_type, str(uuid.uuid4()))
+
+        self.publish(exchange, routing_key, props, message)
+
+    def publish(self, exchange, routing_key, properties, body, attempt=0,
+                mandatory=False, on_confirmed=None):
+        """Publish body and, in confirm mode, track it by delivery tag
+        until RabbitMQ acks or nacks it. Confirms are handled as they
+        arrive, so publishing never waits on the broker.
+
+        :param str exchange: The exchange to publish to
+        :param str routing_key: The routing key
+        :param pika.BasicProperties properties: The message properties
+        :param str|bytes body: The message body
+        :param int attempt: Number of earlier nacked attempts
+        :param bool mandatory: Have RabbitMQ return the message if no queue
+            is bound for it, which needs a message_id to be recognised
+        :param callable on_confirmed: Called with True once RabbitMQ has
+            taken the message, or False if it was returned or nacked past
+            publish_retries. Needs confirm mode.
 
+        """
         self._channel.basic_publish(
             exchange=exchange,
             routing_key=routing_key,
-            properties=props,
-            body=message
+            properties=properties,
+            body=body,
+            mandatory=mandatory
         )
 
+        if self._publisher_confirms:
+            self._message_number += 1
+            self._deliveries[self._message_number] = (
+                exchange, routing_key, properties, body, attempt, mandatory, on_confirmed)
+
     def acknowledge_message(self, delivery_tag):
         """Acknowledge the message delivery from RabbitMQ by sending a
         Basic.Ack RPC method for the delivery tag.
@@ -443,9 +792,10 @@ class BaseConsumer(object):
 
     def on_cancelok(self, _unused_frame, userdata):
         """This method is invoked by pika when RabbitMQ acknowledges the
-        cancellation of a consumer. At this point we will close the channel.
-        This will invoke the on_channel_closed method once the channel has been
-        closed, which will in-turn close the connection.
+        cancellation of a consumer. At this point we will drain in-flight
+        work and then close the channel. This will invoke the
+        on_channel_closed method once the channel has been closed, which
+        will in-turn close the connection.
 
         :param pika.frame.Method _unused_frame: The Basic.CancelOk frame
         :param str|unicode userdata: Extra user data (consumer tag)
@@ -455,7 +805,7 @@ class BaseConsumer(object):
         LOGGER.info(
             'RabbitMQ acknowledged the cancellation of the consumer: %s',
             userdata)
-        self.close_channel()
+        self.drain()
 
     def close_channel(self):
         """Call to close the channel with RabbitMQ cleanly by issuing the
@@ -495,17 +845,30 @@ class BaseConsumer(object):
             LOGGER.info('Stopped')
 
 
+def raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
 class BaseReconnectingConsumer(object):
     """
-    Base reconnecting consumer
+    Base reconnecting consumer. A new consumer is built with factory after
+    each disconnect, waiting a jittered, exponentially growing delay
+    between failed attempts. Whatever the factory closes over, such as an
+    LxdApi or executor, is reused across reconnects, so work still in
+    flight when the connection drops is not abandoned.
     """
 
-    def __init__(self, parameters):
-        self._reconnect_delay = 0
+    def __init__(self, parameters, factory=None):
+        self._reconnect_attempts = 0
         self._parameters = parameters
-        self._consumer = BaseConsumer(self._parameters)
+        self._factory = factory or BaseConsumer
+        self._consumer = self._factory(self._parameters)
 
     def run(self):
+        # Rolling restarts send SIGTERM, drain as on CTRL-C
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+
         while True:
             try:
                 self._consumer.run()
@@ -517,16 +880,27 @@ class BaseReconnectingConsumer(object):
     def _maybe_reconnect(self):
         if self._consumer.should_reconnect:
             self._consumer.stop()
+            previous = self._consumer
             reconnect_delay = self._get_reconnect_delay()
-            LOGGER.info('Reconnecting after %d seconds', reconnect_delay)
+            LOGGER.info('Reconnecting after %.1f seconds', reconnect_delay)
             time.sleep(reconnect_delay)
-            self._consumer = LxConsumer(self._parameters, self._lxdapi)
+            self._consumer = self._factory(self._parameters)
+
+            # The broker still has the queue the last consumer declared,
+            # unless binding or consuming found it missing
+            if previous.was_consuming and not previous.topology_missing:
+                self._consumer.declare_topology = False
 
     def _get_reconnect_delay(self):
+        if self._consumer.topology_missing:
+            return 0
+
         if self._consumer.was_consuming:
-            self._reconnect_delay = 0
-        else:
-            self._reconnect_delay += 1
-        if self._reconnect_delay > 30:
-            self._reconnect_delay = 30
-        return self._reconnect_delay
+            self._reconnect_attempts = 0
+
+        # Full jitter keeps replicas from reconnecting in lockstep
+        ceiling = min(settings.RMQ_RECONNECT_MAX_DELAY,
+                      settings.RMQ_RECONNECT_BASE_DELAY * 2 ** self._reconnect_attempts)
+        self._reconnect_attempts += 1
+
+        return random.uniform(0, ceiling)
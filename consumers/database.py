@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 # pylint: disable=C0111,C0103,R0205
+import functools
 import logging
 import time
 
@@ -11,7 +12,7 @@ from pika import channel as pika_channel
 from pika.exchange_type import ExchangeType
 
 from ..config import settings
-from .base import BaseConsumer, BaseReconnectingConsumer
+from .base import BaseConsumer, BaseReconnectingConsumer, make_executor
 
 from reenrolldb.database import SessionLocal
 from reenrolldb.models import User, Environment
@@ -32,8 +33,13 @@ class LxdEnvDatabaseConsumer(BaseConsumer):
     QUEUE = 'lx.db-queue'
     ROUTING_KEY = 'lx.db'
 
-    def __init__(self, parameters):
-        super().__init__(parameters)
+    def __init__(self, parameters, executor=None):
+        # The session is only used from the executor, and a single worker
+        # keeps it to one thread
+        if executor is None:
+            executor = make_executor('thread', 1)
+
+        super().__init__(parameters, executor=executor)
 
         self.session = SessionLocal()
 
@@ -61,35 +67,72 @@ class LxdEnvDatabaseConsumer(BaseConsumer):
                 LOGGER.info('Parsing instance environment message')
 
                 message = models.CreateMessage.parse_raw(body)
-                env = message.environment
 
-                LOGGER.info(f'Environment {env.id}')
+                # Database sessions block, so they run on the executor
+                self.dispatch(functools.partial(self.save_environment, message.environment),
+                              functools.partial(self.on_environment_saved, basic_deliver))
+                return
 
-                # Find User
-                user = self.session.query(User).filter(User.id == env.user.id).first()
+        except Exception as e:
+            LOGGER.error(f'Error: {e}')
 
-                if user is not None:
-                    LOGGER.info(f'Found user: ({user.id}:{user.username}) ')
+        self.acknowledge_message(basic_deliver.delivery_tag)
 
-                # Find Env
+    def save_environment(self, env):
+        """Creates or updates the database record of env. Runs on the
+        executor.
 
-                LOGGER.info(f'Search for environment: ({env.id}) ')
-                db_env = self.session.query(Environment).filter(Environment.id == env.id).first()
+        :param lxrmq.models.Environment env: The environment
 
-                if db_env is None:
-                    LOGGER.info(f'Creating new Environment: ({env.id}) ')
-                    new_env = Environment()
-                    new_env.id = env.id
-                    new_env.user = user
-                    new_env.document = env.dict()
-                    self.session.add(new_env)
-                    self.session.commit()
-                else:
-                    db_env.document = env.dict()
-                    self.session.add(db_env)
-                    self.session.commit()
-                    LOGGER.info(f'Environment already exists: ({env.id}) ')
+        """
+        LOGGER.info(f'Environment {env.id}')
 
+        try:
+            self.store_environment(env)
+        except Exception:
+            # Leave the session usable for the next message
+            self.session.rollback()
+            raise
+
+    def store_environment(self, env):
+        # Find User
+        user = self.session.query(User).filter(User.id == env.user.id).first()
+
+        if user is not None:
+            LOGGER.info(f'Found user: ({user.id}:{user.username}) ')
+
+        # Find Env
+
+        LOGGER.info(f'Search for environment: ({env.id}) ')
+        db_env = self.session.query(Environment).filter(Environment.id == env.id).first()
+
+        if db_env is None:
+            LOGGER.info(f'Creating new Environment: ({env.id}) ')
+            new_env = Environment()
+            new_env.id = env.id
+            new_env.user = user
+            new_env.document = env.dict()
+            self.session.add(new_env)
+            self.session.commit()
+        else:
+            db_env.document = env.dict()
+            self.session.add(db_env)
+            self.session.commit()
+            LOGGER.info(f'Environment already exists: ({env.id}) ')
+
+    def on_environment_saved(self, basic_deliver, future):
+        """Invoked on the ioloop thread once save_environment has finished.
+
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param concurrent.futures.Future future: The finished work
+
+        """
+        if not self.can_reply:
+            LOGGER.info(f'Channel closed, message {basic_deliver.delivery_tag} will be redelivered')
+            return
+
+        try:
+            future.result()
         except Exception as e:
             LOGGER.error(f'Error: {e}')
 
@@ -102,13 +145,6 @@ class ReconnectingLxdEnvDatabaseConsumer(BaseReconnectingConsumer):
     """
 
     def __init__(self, parameters):
-        super().__init__(parameters)
-        self._consumer = LxdEnvDatabaseConsumer(self._parameters)
-
-    def _maybe_reconnect(self):
-        if self._consumer.should_reconnect:
-            self._consumer.stop()
-            reconnect_delay = self._get_reconnect_delay()
-            LOGGER.info('Reconnecting after %d seconds', reconnect_delay)
-            time.sleep(reconnect_delay)
-            self._consumer = LxdEnvDatabaseConsumer(self._parameters)
+        self._executor = make_executor('thread', 1)
+        super().__init__(parameters, functools.partial(
+            LxdEnvDatabaseConsumer, executor=self._executor))
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=C0111,C0103,R0205
+import functools
+import logging
+
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from lxrmq.consumers.base import BaseReconnectingConsumer
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+
+
+class ConsumerHost(object):
+    """
+    Runs several consumers over one RabbitMQ connection, each on its own
+    channel with its own queue and QoS.
+    """
+
+    def __init__(self, parameters, factories):
+        """Create the consumers for a single connection. Each factory is
+        called with the connection parameters and returns a BaseConsumer.
+
+        :param pika.ConnectionParameters parameters: The connection parameters
+        :param list factories: Callables building the consumers to host
+
+        """
+        self.should_reconnect = False
+
+        self._connection = None
+        self._closing = False
+        self._parameters = parameters
+        self._consumers = [factory(parameters) for factory in factories]
+
+    @property
+    def was_consuming(self):
+        # Queue declarations are only skipped once every consumer got going
+        return all(c.was_consuming for c in self._consumers)
+
+    @property
+    def topology_missing(self):
+        return any(c.topology_missing for c in self._consumers)
+
+    @property
+    def declare_topology(self):
+        return any(c.declare_topology for c in self._consumers)
+
+    @declare_topology.setter
+    def declare_topology(self, value):
+        for consumer in self._consumers:
+            consumer.declare_topology = value
+
+    def connect(self):
+        """Connect to RabbitMQ once for every hosted consumer.
+
+        :rtype: pika.adapters.asyncio_connection.AsyncioConnection
+
+        """
+        LOGGER.info('Connecting to %s', self._parameters)
+
+        return AsyncioConnection(
+            parameters=self._parameters,
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_open_error,
+            on_close_callback=self.on_connection_closed,)
+
+    def on_connection_open(self, connection):
+        """Invoked by pika once the connection is established. Every hosted
+        consumer opens its channel on it.
+
+        :param pika.adapters.asyncio_connection.AsyncioConnection connection:
+           The connection
+
+        """
+        LOGGER.info(f'Connection opened, attaching ({len(self._consumers)}) consumers')
+        for consumer in self._consumers:
+            consumer.attach(connection, self.on_consumer_closed)
+
+    def on_connection_open_error(self, _unused_connection, err):
+        LOGGER.error('Connection open failed: %s', err)
+        self.reconnect()
+
+    def on_connection_closed(self, _unused_connection, reason):
+        """Invoked by pika when the connection is closed. Unless we are
+        stopping, every hosted consumer is reconnected together.
+
+        :param pika.connection.Connection connection: The closed connection obj
+        :param Exception reason: exception representing reason for loss of
+            connection.
+
+        """
+        if self._closing:
+            self._connection.ioloop.stop()
+        else:
+            LOGGER.warning('Connection closed, reconnect necessary: %s', reason)
+            self.reconnect()
+
+    def on_consumer_closed(self, consumer):
+        """Invoked when a hosted consumer's channel has closed. The
+        connection is closed once the last channel is, when stopping,
+        or straight away if the channel closed unexpectedly.
+
+        :param BaseConsumer consumer: The consumer whose channel closed
+
+        """
+        if self._closing:
+            if not any(c.can_reply for c in self._consumers):
+                self.close_connection()
+            return
+
+        LOGGER.warning(f'Channel of ({type(consumer).__name__}) closed, reconnecting all consumers')
+        self.close_connection()
+
+    def close_connection(self):
+        if self._connection.is_closing or self._connection.is_closed:
+            LOGGER.info('Connection is closing or already closed')
+        else:
+            LOGGER.info('Closing connection')
+            self._connection.close()
+
+    def reconnect(self):
+        self.should_reconnect = True
+        self.stop()
+
+    def run(self):
+        self._connection = self.connect()
+        self._connection.ioloop.run_forever()
+
+    def stop(self):
+        """Detach every consumer that still has an open channel, then close
+        the connection. As in BaseConsumer.stop, the ioloop is run again
+        until the connection has closed.
+
+        """
+        if not self._closing:
+            self._closing = True
+            LOGGER.info('Stopping')
+
+            attached = [c for c in self._consumers if c.can_reply]
+            for consumer in attached:
+                consumer.detach()
+
+            if attached:
+                self._connection.ioloop.run_forever()
+            elif self._connection.is_open:
+                self.close_connection()
+                self._connection.ioloop.run_forever()
+            else:
+                self._connection.ioloop.stop()
+            LOGGER.info('Stopped')
+
+
+class ReconnectingConsumerHost(BaseReconnectingConsumer):
+    """
+    This host reconnects all of its consumers if the connection is lost.
+    """
+
+    def __init__(self, parameters, factories):
+        super().__init__(parameters, functools.partial(ConsumerHost, factories=factories))
@@ -0,0 +1,85 @@
+import logging
+
+import unittest
+from unittest import mock
+
+import pika
+from host import ConsumerHost
+from lxrmq.consumers.base import BaseConsumer
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+
+
+class TestConsumerHost(unittest.TestCase):
+
+    def setup_host(self):
+        parameters = pika.ConnectionParameters('localhost', '5671', '/')
+        factories = [mock.Mock(return_value=mock.Mock(spec=BaseConsumer)) for i in range(3)]
+
+        host = ConsumerHost(parameters, factories)
+        host._connection = mock.Mock()
+        host._connection.is_closing = False
+        host._connection.is_closed = False
+
+        for consumer in host._consumers:
+            consumer.can_reply = False
+
+        return (host, host._consumers)
+
+    def test_consumers_share_connection(self):
+        host, consumers = self.setup_host()
+
+        host.on_connection_open(host._connection)
+
+        for consumer in consumers:
+            consumer.attach.assert_called_once_with(host._connection, host.on_consumer_closed)
+
+    def test_stop_closes_connection_after_last_channel(self):
+        host, consumers = self.setup_host()
+
+        for consumer in consumers:
+            consumer.can_reply = True
+
+        host.stop()
+
+        for consumer in consumers:
+            consumer.detach.assert_called_once()
+        host._connection.ioloop.run_forever.assert_called_once()
+
+        for consumer in consumers:
+            host._connection.close.assert_not_called()
+            consumer.can_reply = False
+            host.on_consumer_closed(consumer)
+
+        host._connection.close.assert_called_once()
+
+    def test_unexpected_channel_close_reconnects(self):
+        host, consumers = self.setup_host()
+
+        host.on_consumer_closed(consumers[1])
+
+        host._connection.close.assert_called_once()
+        self.assertFalse(host.should_reconnect)
+
+        host.on_connection_closed(host._connection, Exception('closed'))
+
+        self.assertTrue(host.should_reconnect)
+
+    def test_declares_queues_until_every_consumer_consumed(self):
+        host, consumers = self.setup_host()
+
+        consumers[0].was_consuming = True
+        consumers[1].was_consuming = True
+        consumers[2].was_consuming = False
+
+        # The third never got its queue declared
+        self.assertFalse(host.was_consuming)
+
+        consumers[2].was_consuming = True
+        self.assertTrue(host.was_consuming)
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(warnings=None)
+    unittest.main(testRunner=runner)
@@ -24,7 +24,7 @@ from pika import channel as pika_channel
 from pika.exchange_type import ExchangeType
 
 from ..config import settings
-from .base import BaseConsumer, BaseReconnectingConsumer
+from .base import BaseConsumer, BaseReconnectingConsumer, make_executor
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
               '-35s %(lineno) -5d: %(message)s')
@@ -49,18 +49,31 @@ class LxdSimpleInstanceCreationConsumer(BaseConsumer):
         'cs135-f23': 'cs135-apache2.conf.j2'
     }
 
-    def __init__(self, parameters):
-        super().__init__(parameters)
+    def __init__(self, parameters, env=None, executor=None):
+        # A single worker keeps config writes and apache reloads in order
+        if executor is None:
+            executor = make_executor('thread', 1)
+
+        super().__init__(parameters, executor=executor)
+
+        if env is None:
+            env = self.template_environment()
+
+        self._env = env
 
-        self._env = jinja2.Environment(
+    @staticmethod
+    def template_environment():
+        env = jinja2.Environment(
             loader=jinja2.FileSystemLoader("templates"),
             autoescape=jinja2.select_autoescape()
         )
 
-        templates = self._env.list_templates()
+        templates = env.list_templates()
 
         LOGGER.info(f'Listing templates {templates}')
 
+        return env
+
     def on_message(self, _unused_channel: pika_channel.Channel,
                    basic_deliver: pika_spec.Basic.Deliver,
                    properties: pika.BasicProperties,
@@ -88,46 +101,79 @@ class LxdSimpleInstanceCreationConsumer(BaseConsumer):
                 env = message.environment
 
                 if env.type == 'simple':
-                    LOGGER.info(
-                    f'Instance Creation Message: Env.id={env.id} Inst.id={env.instance.id} Course={env.course}')
-                    ttyd_address = env.instance.get_listen_address('ttyd')
-                    vscode_address = env.instance.get_listen_address('vscode')
-                    novnc_address = env.instance.get_listen_address('novnc')
-
-                    env.instance.services = [
-                        {'display_name': 'Terminal', 'name':'ttyd', 'address': f'{settings.HTTPS_ENDPOINT}/{env.id}/ttyd/'},
-                        {'display_name': 'Visual Studio Code', 'name':'vscode', 'address': f'{settings.HTTPS_ENDPOINT}/{env.id}/vscode/'},
-                        {'display_name': 'Desktop', 'name':'novnc', 'address': f'{settings.HTTPS_ENDPOINT}/{env.id}/novnc/vnc.html?path={env.id}/novnc/websockify&autoconnect=true&resize=remote&quality=8&compression=2'}
-                    ]
-
-                    context = {
-                        'env_id': env.id,
-                        'novnc_address': novnc_address,
-                        'vscode_address': vscode_address,
-                        'ttyd_address': ttyd_address,
-                        'username': env.user.username
-                    }
-
-                    template = self._env.get_template('simple-apache2.conf.j2')
-                    rendered_template = template.render(context)
-
-                    output_file = pathlib.Path(
-                        self.APACHE2_CONF_DIR, f'{env.id}.conf')
-                    
-                    with open(output_file, 'w') as f:
-                        f.write(rendered_template)
-
-                    subprocess.run(
-                        'sudo /usr/sbin/apache2ctl graceful', shell=True)
-                    
-                    LOGGER.info(
-                        f'Rendered template ({template}) to ({output_file})')
-                    
-                    env.instance.control = True
-
-                    outbound_message = models.CreateMessage(environment=env)
-                    
-                    self.send_message(outbound_message.json(), 'lx.db','environment-creation', 'lx')
+                    # Writing the config and reloading apache block, so they
+                    # run on the executor rather than the shared ioloop
+                    self.dispatch(functools.partial(self.configure_proxy, env),
+                                  functools.partial(self.on_proxy_configured, basic_deliver))
+                    return
+        except Exception as e:
+            LOGGER.error(f'Exception: {e}')
+
+        self.acknowledge_message(basic_deliver.delivery_tag)
+
+    def configure_proxy(self, env):
+        """Renders and installs the apache2 proxy config for env, returning
+        env with its services filled in. Runs on the executor.
+
+        :param lxrmq.models.Environment env: The created environment
+
+        """
+        LOGGER.info(
+        f'Instance Creation Message: Env.id={env.id} Inst.id={env.instance.id} Course={env.course}')
+        ttyd_address = env.instance.get_listen_address('ttyd')
+        vscode_address = env.instance.get_listen_address('vscode')
+        novnc_address = env.instance.get_listen_address('novnc')
+
+        env.instance.services = [
+            {'display_name': 'Terminal', 'name':'ttyd', 'address': f'{settings.HTTPS_ENDPOINT}/{env.id}/ttyd/'},
+            {'display_name': 'Visual Studio Code', 'name':'vscode', 'address': f'{settings.HTTPS_ENDPOINT}/{env.id}/vscode/'},
+            {'display_name': 'Desktop', 'name':'novnc', 'address': f'{settings.HTTPS_ENDPOINT}/{env.id}/novnc/vnc.html?path={env.id}/novnc/websockify&autoconnect=true&resize=remote&quality=8&compression=2'}
+        ]
+
+        context = {
+            'env_id': env.id,
+            'novnc_address': novnc_address,
+            'vscode_address': vscode_address,
+            'ttyd_address': ttyd_address,
+            'username': env.user.username
+        }
+
+        template = self._env.get_template('simple-apache2.conf.j2')
+        rendered_template = template.render(context)
+
+        output_file = pathlib.Path(
+            self.APACHE2_CONF_DIR, f'{env.id}.conf')
+
+        with open(output_file, 'w') as f:
+            f.write(rendered_template)
+
+        subprocess.run(
+            'sudo /usr/sbin/apache2ctl graceful', shell=True)
+
+        LOGGER.info(
+            f'Rendered template ({template}) to ({output_file})')
+
+        env.instance.control = True
+
+        return env
+
+    def on_proxy_configured(self, basic_deliver, future):
+        """Invoked on the ioloop thread once configure_proxy has finished,
+        passing the environment on to the database consumer.
+
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param concurrent.futures.Future future: The finished work
+
+        """
+        if not self.can_reply:
+            LOGGER.info(f'Channel closed, message {basic_deliver.delivery_tag} will be redelivered')
+            return
+
+        try:
+            env = future.result()
+            outbound_message = models.CreateMessage(environment=env)
+
+            self.send_message(outbound_message.json(), 'lx.db','environment-creation', 'lx')
         except Exception as e:
             LOGGER.error(f'Exception: {e}')
 
@@ -140,14 +186,7 @@ class ReconnectingLxdSimpleInstanceCreationConsumer(BaseReconnectingConsumer):
     """
 
     def __init__(self, parameters):
-        super().__init__(parameters)
-        self._consumer = LxdSimpleInstanceCreationConsumer(self._parameters)
-
-    def _maybe_reconnect(self):
-        if self._consumer.should_reconnect:
-            self._consumer.stop()
-            reconnect_delay = self._get_reconnect_delay()
-            LOGGER.info('Reconnecting after %d seconds', reconnect_delay)
-            time.sleep(reconnect_delay)
-            self._consumer = LxdSimpleInstanceCreationConsumer(
-                self._parameters)
+        env = LxdSimpleInstanceCreationConsumer.template_environment()
+        self._executor = make_executor('thread', 1)
+        super().__init__(parameters, functools.partial(
+            LxdSimpleInstanceCreationConsumer, env=env, executor=self._executor))
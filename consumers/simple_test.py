@@ -0,0 +1,80 @@
+import json
+import logging
+
+import unittest
+import concurrent.futures
+from unittest import mock
+
+import pika
+from lxrmq.consumers.simple import LxdSimpleInstanceCreationConsumer
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+
+
+class TestLxdSimpleInstanceCreationConsumer(unittest.TestCase):
+
+    def test_proxy_config_runs_off_ioloop(self):
+        parameters = pika.ConnectionParameters('localhost', '5671', '/')
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        consumer = LxdSimpleInstanceCreationConsumer(parameters, env=mock.Mock(), executor=executor)
+        consumer._channel = mock.Mock()
+        consumer._connection = mock.Mock()
+        consumer.send_message = mock.Mock()
+        consumer.configure_proxy = mock.Mock(side_effect=lambda env: env)
+
+        callbacks = []
+        consumer._connection.ioloop.call_soon_threadsafe.side_effect = \
+            lambda fn, *args: callbacks.append((fn, args))
+
+        body = json.dumps({
+            'environment': {
+                'id': '000000010',
+                'name': 'CS135',
+                'type': 'simple',
+                'instance': {'name': 'cs135-f23-user0', 'type': 'container'},
+                'user': {'id': '000000001', 'username': 'user0', 'uid_number': 1000000},
+                'course': {'subject': 'cs', 'catalog_number': '135', 'semester': 'f23'}
+            }
+        })
+        properties = pika.BasicProperties(headers={
+            'x-type': 'instance-creation', 'x-user': 'lxfrontend',
+            'x-source': 'lxfrontend', 'x-application': 'lxfrontend'})
+        basic_deliver = mock.Mock(delivery_tag=7)
+
+        consumer.on_message(None, basic_deliver, properties, body)
+        executor.shutdown(wait=True)
+
+        # Nothing is published or acknowledged until back on the ioloop
+        consumer.configure_proxy.assert_called_once()
+        consumer._channel.basic_ack.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+
+        fn, args = callbacks[0]
+        fn(*args)
+
+        consumer.send_message.assert_called_once()
+        self.assertEqual(consumer.send_message.call_args[0][1:], ('lx.db', 'environment-creation', 'lx'))
+        consumer._channel.basic_ack.assert_called_once_with(7)
+
+    def test_closed_channel_is_not_acknowledged(self):
+        parameters = pika.ConnectionParameters('localhost', '5671', '/')
+
+        consumer = LxdSimpleInstanceCreationConsumer(parameters, env=mock.Mock())
+        consumer._channel = mock.Mock(is_open=False)
+        consumer.send_message = mock.Mock()
+        future = concurrent.futures.Future()
+        future.set_result(mock.Mock())
+
+        consumer.on_proxy_configured(mock.Mock(delivery_tag=7), future)
+
+        # Redelivered on the next channel instead
+        consumer.send_message.assert_not_called()
+        consumer._channel.basic_ack.assert_not_called()
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(warnings=None)
+    unittest.main(testRunner=runner)
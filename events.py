@@ -0,0 +1,161 @@
+import json
+import logging
+import threading
+
+from pylxd.client import EventType
+from ws4py.client import WebSocketBaseClient
+
+LOGGER = logging.getLogger(__name__)
+
+
+class LxdEventClient(WebSocketBaseClient):
+    """Websocket client for /1.0/events that forwards each decoded event
+    to its listener.
+    """
+    listener = None
+
+    def __init__(self, *args, **kwargs):
+        # LXD rejects the Origin header ws4py derives from unix socket urls
+        kwargs.setdefault('exclude_headers', ['origin'])
+        super().__init__(*args, **kwargs)
+
+    def received_message(self, message):
+        try:
+            event = json.loads(message.data.decode('utf-8'))
+        except Exception as e:
+            LOGGER.info(f'Cannot decode LXD event: {e}')
+            return
+
+        self.listener.dispatch(event)
+
+
+class LxdEventListener(object):
+    """Follows the LXD lifecycle event stream in a background thread.
+
+    Callbacks registered with subscribe() receive every lifecycle event.
+    Callbacks registered with on_resync() run whenever the stream is
+    (re)connected, since events may have been missed while it was down,
+    and every resync_interval seconds as a safety net. Callbacks
+    registered with on_disconnect() run whenever the stream fails or
+    ends, so state kept from events can stop being trusted until the
+    next resync.
+    """
+    client: object
+    retry_delay: float
+    resync_interval: float
+
+    def __init__(self, client, retry_delay=5.0, resync_interval=None):
+        self.client = client
+        self.retry_delay = retry_delay
+        self.resync_interval = resync_interval
+
+        self._callbacks = []
+        self._resync_callbacks = []
+        self._disconnect_callbacks = []
+        self._connected = False
+        self._stopped = threading.Event()
+        self._thread = None
+        self._resync_thread = None
+        self._websocket = None
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+
+    def on_resync(self, callback):
+        self._resync_callbacks.append(callback)
+
+    def on_disconnect(self, callback):
+        self._disconnect_callbacks.append(callback)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='lxd-events', daemon=True)
+        self._thread.start()
+
+        if self.resync_interval:
+            self._resync_thread = threading.Thread(
+                target=self._run_resync, name='lxd-resync', daemon=True)
+            self._resync_thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._websocket is not None:
+            self._websocket.close()
+
+    def dispatch(self, event):
+        if event.get('type') != EventType.Lifecycle.value:
+            return
+
+        for callback in self._callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                LOGGER.info(f'LXD event callback failed: {e}')
+
+    def resync(self):
+        for callback in self._resync_callbacks:
+            try:
+                callback()
+            except Exception as e:
+                LOGGER.info(f'LXD resync callback failed: {e}')
+
+    def disconnected(self):
+        self._connected = False
+
+        for callback in self._disconnect_callbacks:
+            try:
+                callback()
+            except Exception as e:
+                LOGGER.info(f'LXD disconnect callback failed: {e}')
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._websocket = self.client.events(
+                    websocket_client=LxdEventClient,
+                    event_types={EventType.Lifecycle})
+                self._websocket.listener = self
+                self._websocket.connect()
+                LOGGER.info('Subscribed to LXD lifecycle events')
+                self._connected = True
+                self.resync()
+                self._websocket.run()
+            except Exception as e:
+                LOGGER.warning(f'LXD event stream failed: {e}')
+
+            # Events are missed until the stream is back and resynced
+            self.disconnected()
+
+            if not self._stopped.is_set():
+                LOGGER.info(f'Reconnecting to LXD events in {self.retry_delay} seconds')
+                self._stopped.wait(self.retry_delay)
+
+    def _run_resync(self):
+        while not self._stopped.wait(self.resync_interval):
+            # A listing taken while the stream is down goes stale at once,
+            # the reconnect resyncs instead
+            if not self._connected:
+                continue
+
+            LOGGER.info('Periodic LXD resync')
+            self.resync()
+
+
+def event_instance_name(event):
+    """Returns the instance name an LXD lifecycle event refers to."""
+    metadata = event.get('metadata', {})
+    source = metadata.get('source', '')
+
+    if not source.startswith('/1.0/instances/'):
+        return None
+
+    return source.split('/')[3].split('?')[0]
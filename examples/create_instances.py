@@ -76,7 +76,8 @@ def main():
             'x-type': 'create',
             'x-application': 'basic-provisioner',
             'x-user': 'username',
-            'x-source': hostname
+            'x-source': hostname,
+            'x-instance': 'example-username'
         }
     )
 
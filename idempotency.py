@@ -0,0 +1,129 @@
+import json
+import logging
+import threading
+import time
+
+import etcd3.exceptions
+
+LOGGER = logging.getLogger(__name__)
+
+IN_PROGRESS = 'in-progress'
+COMPLETED = 'completed'
+
+
+class RequestInProgress(Exception):
+    """Raised when another worker is still handling the same request."""
+
+
+class IdempotencyStore(object):
+    """Records the state and result of requests in etcd, keyed by a
+    request id, so a redelivered request is not carried out twice.
+
+    The first worker to claim a request marks it in-progress under a
+    lease it keeps alive while it works; should the worker die, the lease
+    lapses and the request can be claimed again. A completed request
+    keeps its result for result_ttl seconds. A worker that finds the
+    request in progress waits, up to wait_timeout seconds, for the result
+    or for the claim to go away.
+    """
+    etcd: object
+    prefix: str
+    pending_ttl: int
+    result_ttl: int
+    wait_timeout: float
+
+    def __init__(self, etcd, prefix, pending_ttl=60, result_ttl=3600, wait_timeout=900):
+        self.etcd = etcd
+        self.prefix = prefix
+        self.pending_ttl = pending_ttl
+        self.result_ttl = result_ttl
+        self.wait_timeout = wait_timeout
+
+    def key(self, request_id):
+        return f'{self.prefix}{request_id}'
+
+    def get(self, request_id):
+        value, _ = self.etcd.get(self.key(request_id))
+
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def run(self, request_id, action, dumps=json.dumps, loads=json.loads):
+        """Runs action() once for request_id and returns its result, or
+        returns the stored result of an earlier run. If action raises, the
+        claim is dropped so the request can be retried.
+
+        :param str request_id: The request id
+        :param callable action: The work, called without arguments
+        :param callable dumps: Serializes the result to a string
+        :param callable loads: Deserializes a stored result
+
+        """
+        key = self.key(request_id)
+        deadline = time.monotonic() + self.wait_timeout
+
+        while True:
+            lease = self.etcd.lease(self.pending_ttl)
+
+            if self.claim(key, lease):
+                break
+
+            lease.revoke()
+            record = self.get(request_id)
+
+            if record is not None and record['state'] == COMPLETED:
+                LOGGER.info(f'Request ({request_id}) already completed')
+                return loads(record['result'])
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RequestInProgress(f'Request ({request_id}) is still in progress')
+
+            if record is not None:
+                LOGGER.info(f'Request ({request_id}) in progress, waiting')
+                self.wait(key, min(remaining, self.pending_ttl))
+
+        stopped = threading.Event()
+        threading.Thread(target=self._keep_alive, args=(lease, stopped),
+                         name='lxrmq-idempotency', daemon=True).start()
+
+        try:
+            result = action()
+        except Exception:
+            stopped.set()
+            lease.revoke()
+            raise
+
+        stopped.set()
+        self.complete(key, dumps(result))
+        # The record has moved to the result lease
+        lease.revoke()
+
+        return result
+
+    def claim(self, key, lease):
+        record = json.dumps({'state': IN_PROGRESS})
+        succeeded, _ = self.etcd.transaction(
+            compare=[self.etcd.transactions.version(key) == 0],
+            success=[self.etcd.transactions.put(key, record, lease)],
+            failure=[]
+        )
+        return succeeded
+
+    def complete(self, key, result):
+        lease = self.etcd.lease(self.result_ttl)
+        self.etcd.put(key, json.dumps({'state': COMPLETED, 'result': result}), lease=lease)
+
+    def wait(self, key, timeout):
+        try:
+            self.etcd.watch_once(key, timeout=timeout)
+        except etcd3.exceptions.WatchTimedOut:
+            pass
+
+    def _keep_alive(self, lease, stopped):
+        while not stopped.wait(self.pending_ttl / 3):
+            try:
+                lease.refresh()
+            except Exception as e:
+                LOGGER.info(f'Unable to refresh request lease: {e}')
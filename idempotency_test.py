@@ -0,0 +1,72 @@
+import json
+import unittest
+from unittest import mock
+
+import etcd3.exceptions
+
+from idempotency import IdempotencyStore, RequestInProgress
+
+
+class TestIdempotencyStore(unittest.TestCase):
+
+    def setup_store(self, **kwargs):
+        etcd = mock.Mock()
+        etcd.transactions.version.return_value = mock.MagicMock()
+        store = IdempotencyStore(etcd, '/lxd/requests/', **kwargs)
+        return (store, etcd)
+
+    def test_first_run_stores_result(self):
+        store, etcd = self.setup_store()
+        etcd.transaction.return_value = (True, [])
+
+        result = store.run('create/1', lambda: {'id': '1'})
+
+        self.assertEqual(result, {'id': '1'})
+        key, value = etcd.put.call_args.args
+        self.assertEqual(key, '/lxd/requests/create/1')
+        self.assertEqual(json.loads(value), {'state': 'completed', 'result': '{"id": "1"}'})
+        # The in-progress lease is dropped once the result is stored
+        etcd.lease.return_value.revoke.assert_called_once()
+
+    def test_completed_request_returns_stored_result(self):
+        store, etcd = self.setup_store()
+        etcd.transaction.return_value = (False, [])
+        etcd.get.return_value = (json.dumps({'state': 'completed', 'result': '{"id": "1"}'}), None)
+        action = mock.Mock()
+
+        result = store.run('create/1', action)
+
+        self.assertEqual(result, {'id': '1'})
+        action.assert_not_called()
+
+    def test_failed_action_releases_claim(self):
+        store, etcd = self.setup_store()
+        etcd.transaction.return_value = (True, [])
+
+        def fail():
+            raise RuntimeError('create failed')
+
+        with self.assertRaises(RuntimeError):
+            store.run('create/1', fail)
+
+        etcd.lease.return_value.revoke.assert_called_once()
+        etcd.put.assert_not_called()
+
+    def test_waits_for_request_in_progress(self):
+        store, etcd = self.setup_store(wait_timeout=0)
+        etcd.transaction.return_value = (False, [])
+        etcd.get.return_value = (json.dumps({'state': 'in-progress'}), None)
+
+        with self.assertRaises(RequestInProgress):
+            store.run('create/1', mock.Mock())
+
+        # Claimed again once the other worker's claim lapses
+        store.wait_timeout = 10
+        etcd.watch_once.side_effect = etcd3.exceptions.WatchTimedOut()
+        etcd.transaction.side_effect = [(False, []), (True, [])]
+
+        self.assertEqual(store.run('create/1', lambda: 'done'), 'done')
+        etcd.watch_once.assert_called_once()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+import logging
+import threading
+
+from lxrmq.cache import TTLCache
+from lxrmq.events import LxdEventListener, event_instance_name
+
+LOGGER = logging.getLogger(__name__)
+
+# Lifecycle actions after which the cached instance is fetched again
+REFRESH_ACTIONS = {
+    'instance-created',
+    'instance-updated',
+    'instance-started',
+    'instance-stopped',
+    'instance-restarted',
+    'instance-shutdown',
+    'instance-paused',
+    'instance-resumed',
+}
+
+
+class LxdInventory(object):
+    """Local copy of the cluster's instances, kept current from the LXD
+    lifecycle event stream.
+
+    The full listing is fetched when the event stream (re)connects and
+    every resync_interval seconds by the listener; in between, only the
+    instance named by an event is fetched again. Observers are kept in
+    step with load(instances), update_instance(instance), remove(name),
+    rename(old_name, new_name) and invalidate() calls. While the event
+    stream is down the inventory and its observers are not ready, and
+    become ready again with the load() of the next resync.
+    """
+    client: object
+    events: LxdEventListener
+    ready: bool
+
+    def __init__(self, client, events):
+        self.client = client
+        self.events = events
+        self.ready = False
+
+        self._instances = {}
+        self._observers = []
+        self._lock = threading.Lock()
+
+        self.events.subscribe(self.on_event)
+        self.events.on_resync(self.load)
+        self.events.on_disconnect(self.invalidate)
+
+    def subscribe(self, observer):
+        self._observers.append(observer)
+
+        if self.ready:
+            observer.load(self.all())
+
+    def start(self):
+        self.events.start()
+
+    def load(self):
+        instances = self.client.instances.all()
+
+        with self._lock:
+            self._instances = {i.name: i for i in instances}
+            self.ready = True
+
+        LOGGER.info(f'Inventory loaded ({len(instances)}) instances')
+        self._notify('load', instances)
+
+    def invalidate(self):
+        with self._lock:
+            self.ready = False
+
+        LOGGER.info('Inventory invalidated until the next resync')
+        self._notify('invalidate')
+
+    def all(self):
+        return list(self._instances.values())
+
+    def get(self, name):
+        instance = self._instances.get(name, None)
+
+        if instance is None:
+            instance = self.client.instances.get(name)
+            self.update_instance(instance)
+
+        return instance
+
+    def update_instance(self, instance):
+        with self._lock:
+            self._instances[instance.name] = instance
+        self._notify('update_instance', instance)
+
+    def remove(self, name):
+        with self._lock:
+            self._instances.pop(name, None)
+        self._notify('remove', name)
+
+    def rename(self, old_name, new_name):
+        with self._lock:
+            if old_name in self._instances:
+                self._instances[new_name] = self._instances.pop(old_name)
+        self._notify('rename', old_name, new_name)
+
+    def on_event(self, event):
+        action = event['metadata'].get('action', '')
+        name = event_instance_name(event)
+
+        if name is None:
+            return
+
+        if action == 'instance-deleted':
+            self.remove(name)
+        elif action == 'instance-renamed':
+            old_name = event['metadata'].get('context', {}).get('old_name')
+            self.rename(old_name, name)
+            # The cached object still carries the old name
+            self.update_instance(self.client.instances.get(name))
+        elif action in REFRESH_ACTIONS:
+            self.update_instance(self.client.instances.get(name))
+
+    def _notify(self, method, *args):
+        for observer in self._observers:
+            try:
+                getattr(observer, method)(*args)
+            except Exception as e:
+                LOGGER.info(f'Inventory observer {method} failed: {e}')
+
+
+def instance_owner(instance):
+    """Returns the LX_USER an instance was created for, or ''."""
+    return dict(instance.config).get('environment.LX_USER', None) or ''
+
+
+class InstanceOwners(object):
+    """Index of instance name -> owning user.
+
+    As an inventory observer the index holds every instance and is kept
+    current from lifecycle events. Owners learned any other way, such as
+    from a create or a direct lookup, go into a bounded TTL/LRU cache that
+    also answers while the inventory is not loaded.
+    """
+    ready: bool
+
+    def __init__(self, maxsize=4096, ttl=300.0):
+        self.ready = False
+
+        self._owners = {}
+        self._fallback = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, name):
+        owner = self._owners.get(name, None) if self.ready else None
+
+        if owner is None:
+            owner = self._fallback.get(name, None)
+
+        return owner
+
+    def remember(self, name, owner):
+        self._fallback.set(name, owner or '')
+
+    def forget(self, name):
+        self._owners.pop(name, None)
+        self._fallback.pop(name)
+
+    def load(self, instances):
+        self._owners = {i.name: instance_owner(i) for i in instances}
+        self.ready = True
+
+    def invalidate(self):
+        self.ready = False
+
+    def update_instance(self, instance):
+        self._owners[instance.name] = instance_owner(instance)
+
+    def remove(self, name):
+        self.forget(name)
+
+    def rename(self, old_name, new_name):
+        owner = self._owners.pop(old_name, None)
+        self._fallback.pop(old_name)
+
+        if owner is not None:
+            self._owners[new_name] = owner
@@ -0,0 +1,141 @@
+import types
+import unittest
+from unittest import mock
+
+from events import LxdEventListener
+from inventory import InstanceOwners, LxdInventory
+from ports import PortIndex
+
+
+def make_instance(name, status='Running', owner='user0'):
+    return types.SimpleNamespace(name=name, status=status, location='lx1',
+                                 devices={}, config={'environment.LX_USER': owner})
+
+
+def make_event(action, name, **context):
+    return {
+        'type': 'lifecycle',
+        'location': 'lx1',
+        'metadata': {
+            'action': action,
+            'source': f'/1.0/instances/{name}',
+            'context': context
+        }
+    }
+
+
+class TestLxdInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.MagicMock()
+        self.client.instances.all.return_value = [make_instance('a'), make_instance('b')]
+        self.events = mock.Mock()
+        self.inventory = LxdInventory(self.client, self.events)
+        self.inventory.load()
+
+    def test_load_registers_with_events(self):
+        self.events.subscribe.assert_called_once_with(self.inventory.on_event)
+        self.events.on_resync.assert_called_once_with(self.inventory.load)
+        self.assertTrue(self.inventory.ready)
+        self.assertEqual(sorted(i.name for i in self.inventory.all()), ['a', 'b'])
+
+    def test_events_update_cache(self):
+        self.client.instances.get.return_value = make_instance('a', status='Stopped')
+
+        self.inventory.on_event(make_event('instance-stopped', 'a'))
+        self.inventory.on_event(make_event('instance-deleted', 'b'))
+        self.inventory.on_event(make_event('instance-exec', 'a'))
+
+        self.assertEqual(self.inventory.get('a').status, 'Stopped')
+        self.assertEqual([i.name for i in self.inventory.all()], ['a'])
+        self.client.instances.get.assert_called_once_with('a')
+
+    def test_rename_and_observers(self):
+        observer = mock.Mock()
+        self.inventory.subscribe(observer)
+        self.client.instances.get.return_value = make_instance('c')
+
+        self.inventory.on_event(make_event('instance-renamed', 'c', old_name='a'))
+
+        observer.load.assert_called_once()
+        observer.rename.assert_called_once_with('a', 'c')
+        self.client.instances.get.assert_called_once_with('c')
+        self.assertEqual(self.inventory.get('c').name, 'c')
+        self.assertNotIn('a', [i.name for i in self.inventory.all()])
+
+    def test_get_miss_fetches_instance(self):
+        self.client.instances.get.return_value = make_instance('d')
+
+        instance = self.inventory.get('d')
+
+        self.assertEqual(instance.name, 'd')
+        self.assertIn(instance, self.inventory.all())
+
+    def test_not_ready_until_resync(self):
+        owners = InstanceOwners()
+        port_index = PortIndex(set(range(5900, 5910)))
+        self.inventory.subscribe(owners)
+        self.inventory.subscribe(port_index)
+
+        self.events.on_disconnect.assert_called_once_with(self.inventory.invalidate)
+        self.inventory.invalidate()
+
+        self.assertFalse(self.inventory.ready)
+        self.assertFalse(owners.ready)
+        self.assertFalse(port_index.ready)
+        # The stale index no longer answers for owners
+        self.assertIsNone(owners.get('a'))
+
+        self.inventory.load()
+
+        self.assertTrue(self.inventory.ready)
+        self.assertTrue(owners.ready)
+        self.assertTrue(port_index.ready)
+        self.assertEqual(owners.get('a'), 'user0')
+
+
+class TestLxdEventListener(unittest.TestCase):
+
+    def test_failed_stream_disconnects(self):
+        client = mock.Mock()
+        listener = LxdEventListener(client, retry_delay=0)
+        disconnected = mock.Mock()
+        listener.on_disconnect(disconnected)
+
+        def fail(**kwargs):
+            listener.stop()
+            raise ConnectionError('gone')
+
+        client.events.side_effect = fail
+        listener._run()
+
+        disconnected.assert_called_once_with()
+        self.assertFalse(listener._connected)
+
+
+class TestInstanceOwners(unittest.TestCase):
+
+    def test_index_and_fallback(self):
+        owners = InstanceOwners(maxsize=2, ttl=60)
+        owners.load([make_instance('a', owner='user0')])
+        owners.remember('b', 'user1')
+
+        self.assertEqual(owners.get('a'), 'user0')
+        self.assertEqual(owners.get('b'), 'user1')
+        self.assertIsNone(owners.get('c'))
+
+    def test_events_keep_index_current(self):
+        owners = InstanceOwners()
+        owners.load([make_instance('a', owner='user0')])
+
+        owners.update_instance(make_instance('b', owner=None))
+        owners.rename('a', 'c')
+        owners.remove('b')
+
+        self.assertIsNone(owners.get('a'))
+        self.assertIsNone(owners.get('b'))
+        self.assertEqual(owners.get('c'), 'user0')
+
+
+if __name__ == '__main__':
+    unittest.main()
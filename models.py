@@ -99,6 +99,7 @@ class MessageHeaders(BaseModel):
     x_user: str= Field(alias='x-user')
     x_source: str= Field(alias='x-source')
     x_application: str= Field(alias='x-application')
+    x_instance: Optional[str]= Field(alias='x-instance')
 
     class Config:  
         use_enum_values = True 
@@ -0,0 +1,221 @@
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+def proxy_listen_ports(devices):
+    """Returns the tcp listen ports of the proxy devices in devices."""
+    ports = []
+
+    for name, device in devices.items():
+        if device.get('type', None) != 'proxy':
+            continue
+
+        listen = device.get('listen', '')
+        if listen.startswith('tcp'):
+            ports.append(int(listen.split(':')[2]))
+
+    return ports
+
+
+class PortIndex(object):
+    """Occupancy of a port range kept as one counter byte per port and
+    cluster member.
+
+    The index is loaded once from the full instance list and then kept
+    current with update() and remove() as instances change, so lookups
+    do not depend on the number of instances. Passing node to the lookup
+    methods restricts them to instances on that member; without it a port
+    counts as allocated if it is used on any member.
+    """
+    ports: set[int]
+    base: int
+    ready: bool
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.base = min(ports)
+        self.ready = False
+
+        self._size = max(ports) - self.base + 1
+        self._occupied = bytearray(self._size)
+        self._nodes = {}
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def _in_range(self, port):
+        return 0 <= port - self.base < self._size
+
+    def _mark(self, occupied, ports, delta):
+        for p in ports:
+            if self._in_range(p):
+                index = p - self.base
+                occupied[index] = max(0, min(255, occupied[index] + delta))
+
+    def _node(self, nodes, location):
+        if location not in nodes:
+            nodes[location] = bytearray(self._size)
+        return nodes[location]
+
+    def load(self, instances):
+        occupied = bytearray(self._size)
+        nodes = {}
+        by_instance = {}
+
+        for i in instances:
+            location = str(i.location)
+            ports = proxy_listen_ports(i.devices)
+            by_instance[i.name] = (location, ports)
+            self._mark(occupied, ports, 1)
+            self._mark(self._node(nodes, location), ports, 1)
+
+        with self._lock:
+            self._occupied = occupied
+            self._nodes = nodes
+            self._instances = by_instance
+            self.ready = True
+
+        LOGGER.info(f'Port index loaded from ({len(by_instance)}) instances')
+
+    def _release(self, name):
+        location, ports = self._instances.pop(name, (None, []))
+        self._mark(self._occupied, ports, -1)
+        if location in self._nodes:
+            self._mark(self._nodes[location], ports, -1)
+
+    def update(self, name, devices, location=None):
+        location = str(location)
+        ports = proxy_listen_ports(devices)
+
+        with self._lock:
+            self._release(name)
+            self._mark(self._occupied, ports, 1)
+            self._mark(self._node(self._nodes, location), ports, 1)
+            self._instances[name] = (location, ports)
+
+    def update_instance(self, instance):
+        self.update(instance.name, instance.devices, instance.location)
+
+    def remove(self, name):
+        with self._lock:
+            self._release(name)
+
+    def rename(self, old_name, new_name):
+        with self._lock:
+            if old_name in self._instances:
+                self._instances[new_name] = self._instances.pop(old_name)
+
+    def invalidate(self):
+        self.ready = False
+
+    def _occupancy(self, node=None):
+        if node is None:
+            return self._occupied
+        return self._nodes.get(str(node), bytearray(self._size))
+
+    def is_allocated(self, port, node=None):
+        occupied = self._occupancy(node)
+        return self._in_range(port) and occupied[port - self.base] > 0
+
+    def allocated(self, node=None):
+        occupied = self._occupancy(node)
+        return [self.base + i for i, count in enumerate(occupied) if count]
+
+    def available(self, node=None):
+        occupied = self._occupancy(node)
+        return [p for p in self.ports if not occupied[p - self.base]]
+
+
+class PortBlock(object):
+    """A block of ports reserved in etcd under one lease and handed out
+    locally.
+
+    Ports taken from the block stay outstanding until they are released,
+    and a background thread refreshes the lease every ttl / 3 seconds
+    while any are. A retired block hands out no more ports, and its lease
+    is revoked once nothing is outstanding, which returns its unused
+    ports. An idle block is left to expire, and is treated as expired
+    well before its lease could lapse on the etcd side.
+    """
+    lease: object
+    node: str
+    ttl: int
+    retired: bool
+
+    def __init__(self, lease, ports, ttl, node=None):
+        self.lease = lease
+        self.node = node
+        self.ttl = ttl
+        self.retired = False
+
+        self._free = list(ports)
+        self._outstanding = set()
+        self._refreshed = time.monotonic()
+        self._closed = threading.Event()
+        self._keeper = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, port):
+        return port in self._outstanding
+
+    def __len__(self):
+        return len(self._free)
+
+    @property
+    def expired(self):
+        return time.monotonic() - self._refreshed > self.ttl * 0.8
+
+    @property
+    def idle(self):
+        return not self._outstanding
+
+    def take(self, num):
+        if self.retired or self.expired or len(self._free) < num:
+            return None
+
+        ports = self._free[:num]
+        del self._free[:num]
+
+        with self._lock:
+            self._outstanding.update(ports)
+
+            if self._keeper is None:
+                self._keeper = threading.Thread(
+                    target=self._keep_alive_while_outstanding,
+                    name='port-block-keeper', daemon=True)
+                self._keeper.start()
+
+        return ports
+
+    def release(self, port, used=True):
+        with self._lock:
+            self._outstanding.discard(port)
+
+        if not used:
+            self._free.append(port)
+
+    def keep_alive(self):
+        if time.monotonic() - self._refreshed > self.ttl / 3:
+            self.refresh()
+
+    def refresh(self):
+        self.lease.refresh()
+        self._refreshed = time.monotonic()
+
+    def close(self):
+        """Stops the background refresh."""
+        self._closed.set()
+
+    def _keep_alive_while_outstanding(self):
+        while not self._closed.wait(self.ttl / 3):
+            with self._lock:
+                if not self._outstanding:
+                    self._keeper = None
+                    return
+
+            try:
+                self.refresh()
+            except Exception as e:
+                LOGGER.warning(f'Unable to refresh port block lease: {e}')
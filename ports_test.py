@@ -0,0 +1,117 @@
+import time
+import types
+import unittest
+from unittest import mock
+
+from ports import PortBlock, PortIndex, proxy_listen_ports
+
+
+def make_instance(name, *ports, location='lx1'):
+    devices = {f'proxy{i}': {'type': 'proxy',
+                             'connect': 'tcp:127.0.0.1:5801',
+                             'listen': f'tcp:127.0.0.1:{p}'}
+               for i, p in enumerate(ports)}
+    devices['root'] = {'type': 'disk', 'path': '/'}
+    return types.SimpleNamespace(name=name, devices=devices, location=location)
+
+
+class TestPortIndex(unittest.TestCase):
+
+    def test_proxy_listen_ports(self):
+        instance = make_instance('cs135-f23-user0', 9000, 9001)
+
+        self.assertEqual(proxy_listen_ports(instance.devices), [9000, 9001])
+
+    def test_load_update_remove(self):
+        index = PortIndex(set(range(9000, 9010)))
+        index.load([make_instance('a', 9000, 9001), make_instance('b', 9002)])
+
+        self.assertTrue(index.ready)
+        self.assertEqual(index.allocated(), [9000, 9001, 9002])
+
+        index.update('a', make_instance('a', 9005).devices)
+        index.remove('b')
+
+        self.assertEqual(index.allocated(), [9005])
+        self.assertNotIn(9005, index.available())
+        self.assertIn(9000, index.available())
+
+    def test_shared_port_released_once(self):
+        index = PortIndex(set(range(9000, 9010)))
+        index.load([make_instance('a', 9000), make_instance('b', 9000)])
+
+        index.remove('a')
+
+        self.assertTrue(index.is_allocated(9000))
+
+    def test_rename_keeps_ports(self):
+        index = PortIndex(set(range(9000, 9010)))
+        index.load([make_instance('a', 9000)])
+
+        index.rename('a', 'c')
+        index.remove('c')
+
+        self.assertEqual(index.allocated(), [])
+
+    def test_node_pools_are_independent(self):
+        index = PortIndex(set(range(9000, 9010)))
+        index.load([make_instance('a', 9000, location='lx1'),
+                    make_instance('b', 9001, location='lx2')])
+
+        self.assertEqual(index.allocated(node='lx1'), [9000])
+        self.assertIn(9001, index.available(node='lx1'))
+        self.assertEqual(index.allocated(), [9000, 9001])
+
+        index.update('c', make_instance('c', 9000).devices, location='lx2')
+
+        self.assertEqual(index.allocated(node='lx2'), [9000, 9001])
+        self.assertEqual(index.available(node='lx3'), list(index.ports))
+
+
+class TestPortBlock(unittest.TestCase):
+
+    def test_take_and_release(self):
+        block = PortBlock(mock.Mock(), [9000, 9001, 9002], ttl=300)
+
+        ports = block.take(2)
+
+        self.assertEqual(ports, [9000, 9001])
+        self.assertIsNone(block.take(2))
+        self.assertIn(9000, block)
+        self.assertFalse(block.idle)
+
+        block.release(9000)
+        block.release(9001, used=False)
+
+        self.assertTrue(block.idle)
+        self.assertEqual(block.take(2), [9002, 9001])
+
+    def test_expired_block_hands_out_nothing(self):
+        block = PortBlock(mock.Mock(), [9000], ttl=0)
+
+        self.assertTrue(block.expired)
+        self.assertIsNone(block.take(1))
+
+    def test_refreshed_while_outstanding(self):
+        lease = mock.Mock()
+        block = PortBlock(lease, [9000, 9001], ttl=0.06)
+
+        block.take(1)
+        time.sleep(0.1)
+
+        self.assertGreaterEqual(lease.refresh.call_count, 1)
+        self.assertFalse(block.expired)
+
+        block.release(9000)
+        time.sleep(0.1)
+        count = lease.refresh.call_count
+        time.sleep(0.1)
+
+        # Nothing outstanding, the lease is left to expire
+        self.assertEqual(lease.refresh.call_count, count)
+        self.assertIsNone(block._keeper)
+        block.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
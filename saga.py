@@ -0,0 +1,53 @@
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Saga(object):
+    """Tracks the completed steps of a multi-step operation so they can be
+    undone in reverse order if a later step fails.
+
+    Used as a context manager: an exception leaving the block rolls back
+    every registered compensation and is then re-raised. A compensation
+    that fails is logged and recorded in failed, and the rollback carries
+    on with the remaining ones.
+    """
+    name: str
+    failed: list[str]
+
+    def __init__(self, name):
+        self.name = name
+        self.failed = []
+        self._compensations = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if exception_type is not None:
+            LOGGER.info(f'Saga ({self.name}) failed with {exception_type.__name__}')
+            self.rollback()
+        return False
+
+    def add(self, name, compensate):
+        """Registers compensate() to undo step name."""
+        self._compensations.append((name, compensate))
+
+    def run(self, name, action, compensate=None):
+        """Runs action() and, once it succeeds, registers compensate(result)."""
+        result = action()
+
+        if compensate is not None:
+            self.add(name, lambda: compensate(result))
+
+        return result
+
+    def rollback(self):
+        while self._compensations:
+            name, compensate = self._compensations.pop()
+            LOGGER.info(f'Saga ({self.name}) undoing step ({name})')
+            try:
+                compensate()
+            except Exception as e:
+                LOGGER.error(f'Saga ({self.name}) unable to undo ({name}): {e}')
+                self.failed.append(name)
@@ -0,0 +1,47 @@
+import unittest
+from unittest import mock
+
+from saga import Saga
+
+
+class TestSaga(unittest.TestCase):
+
+    def test_rollback_in_reverse_order(self):
+        undone = []
+
+        with self.assertRaises(RuntimeError):
+            with Saga('test') as saga:
+                saga.run('one', lambda: 1, lambda result: undone.append(result))
+                saga.add('two', lambda: undone.append(2))
+                raise RuntimeError('step three failed')
+
+        self.assertEqual(undone, [2, 1])
+        self.assertEqual(saga.failed, [])
+
+    def test_failed_compensation_continues(self):
+        compensate = mock.Mock()
+
+        def fail():
+            raise RuntimeError('cannot undo')
+
+        with self.assertRaises(ValueError):
+            with Saga('test') as saga:
+                saga.add('one', compensate)
+                saga.add('two', fail)
+                raise ValueError('failed')
+
+        compensate.assert_called_once()
+        self.assertEqual(saga.failed, ['two'])
+
+    def test_success_keeps_steps(self):
+        compensate = mock.Mock()
+
+        with Saga('test') as saga:
+            result = saga.run('one', lambda: 'ok', compensate)
+
+        self.assertEqual(result, 'ok')
+        compensate.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()